@@ -0,0 +1,12 @@
+"""
+Benchmarks
+
+Each module can be run from the repository root, e.g.:
+
+    python -m benchmarks.connection_pool
+
+They all run against a local stub server, so no credentials are needed.
+benchmarks.suite runs the main operations together and can compare the
+results with a previous run (see its docstring).
+"""
+__author__ = "Tirino"
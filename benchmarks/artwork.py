@@ -0,0 +1,70 @@
+"""
+Fetching the artwork of a playlist
+
+Gets the cover of every song of a synthetic playlist (where many songs share
+an album, and so a cover) from a stub server that adds latency to each
+request: one request per song, as a UI would do, then with fetch_artwork,
+cold and with the disk cache warm.
+
+    python -m benchmarks.artwork [songs] [latency_ms]
+"""
+__author__ = "Tirino"
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from googlemusic.client import Client
+from googlemusic.model import Song
+from tests.library import make_song
+from tests.stub import StubServer
+
+IMAGE_SIZE = 20 * 1024
+
+def main(songs=600, latency_ms=20):
+    """Run the benchmark and print the results"""
+    server = StubServer(latency=latency_ms / 1000.0)
+    images = {}
+    def image(handler):
+        path = handler.path.split('?')[0]
+        if path not in images:
+            images[path] = os.urandom(IMAGE_SIZE)
+        return 200, {'Content-Type': 'image/jpeg'}, images[path]
+    server.start()
+    playlist = []
+    for index in xrange(songs):
+        song = Song(make_song(index))
+        # point the artwork to the stub
+        song.artwork_url = '%s/%s' % (server.url[len('http:'):],
+                                      song.artwork_url.rsplit('/', 1)[1])
+        server.add_route('/' + song.artwork_url.rsplit('/', 1)[1], image)
+        playlist.append(song)
+    folder = tempfile.mkdtemp()
+    try:
+        client = Client()
+        started = time.time()
+        for song in playlist:
+            response = client.web.open(song.get_artwork_url())
+            response.read()
+            response.close()
+        print 'one by one   %6.2fs  %4d requests' % (
+            time.time() - started, len(playlist))
+
+        artwork = client.open_artwork_cache(folder)
+        for label in ('cold cache', 'warm cache'):
+            started = time.time()
+            files = client.fetch_artwork(playlist)
+            elapsed = time.time() - started
+            print '%-12s %6.2fs  %4d requests so far, %d images on disk ' \
+                '(%d KB)' % (label, elapsed, artwork.fetched, len(set(files)),
+                             artwork.cache.total / 1024)
+        artwork.close()
+        client.pool.close()
+    finally:
+        server.stop()
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,124 @@
+"""
+Many accounts on a ClientPool
+
+Runs searches for a growing number of accounts on one ClientPool, against a
+stub server with the login endpoints, and reports logins, TCP connections
+and the memory held by the pool. Then checks that an account with a long
+queue doesn't delay another one.
+
+    python -m benchmarks.client_pool [max_accounts] [max_clients]
+"""
+__author__ = "Tirino"
+
+import gc
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+from googlemusic.client import Client
+from googlemusic.clientpool import ClientPool
+from googlemusic import protocol
+from tests.stub import StubServer
+
+PAYLOAD = '{"results": {"albums": [], "songs": []}}'
+SEARCHES_PER_ACCOUNT = 3
+
+def held_size(root):
+    """
+    Return the size in bytes of root and the objects it references, leaving
+    out the code shared by every instance (modules, functions, classes)
+    """
+    shared = (types.ModuleType, types.FunctionType, types.ClassType, type,
+              types.BuiltinFunctionType)
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, shared):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+def start_server():
+    """Start a stub with the login and search endpoints"""
+    server = StubServer(latency=0.001)
+    server.add_route('/accounts/ClientLogin', lambda handler: (
+        200, {}, 'SID=sid\nLSID=lsid\nAuth=auth\n'))
+    server.add_route('/accounts/IssueAuthToken',
+                     lambda handler: (200, {}, 'token'))
+    server.add_route('/accounts/TokenAuth', lambda handler: (
+        200, {'Set-Cookie': 'xt=stub; Path=/'}, 'ok'))
+    server.add_route('/music/services/search',
+                     lambda handler: (200, {}, PAYLOAD))
+    server.start()
+    protocol.Protocol.LOGIN_ENDPOINT = server.url + '/accounts/ClientLogin'
+    protocol.Protocol.SERVICE_ENDPOINT = server.url + '/music/services'
+    protocol.MusicManagerClient.ISSUE_AUTH_URL = \
+        server.url + '/accounts/IssueAuthToken'
+    protocol.MusicManagerClient.TOKEN_AUTH_URL = \
+        server.url + '/accounts/TokenAuth'
+    return server
+
+def scale(server, accounts, max_clients, session_dir):
+    """Run searches for the given number of accounts"""
+    server.connections = 0
+    pool = ClientPool(workers=16, max_clients=max_clients,
+                      session_dir=session_dir)
+    started = time.time()
+    tasks = []
+    for index in xrange(accounts):
+        username = 'user%d@gmail.com' % index
+        pool.add_account(username, 'p4ssw0rd')
+        for search in xrange(SEARCHES_PER_ACCOUNT):
+            tasks.append(pool.submit(username, Client.search, 'query'))
+    for task in tasks:
+        task.result()
+    elapsed = time.time() - started
+    stats = pool.stats()
+    size = held_size(pool)
+    pool.close()
+    print '%5d accounts  %.2fs  %4d logins  %4d restores  %3d clients  ' \
+        '%3d sockets  %6.1f KB held' % (
+            accounts, elapsed, stats['logins'], stats['restores'],
+            stats['clients'], server.connections, size / 1024.0)
+
+def fairness(server):
+    """Time a short queue submitted after a long one"""
+    with ClientPool(workers=4) as pool:
+        pool.add_account('busy@gmail.com', 'p4ssw0rd')
+        pool.add_account('quiet@gmail.com', 'p4ssw0rd')
+        started = time.time()
+        busy = [pool.submit('busy@gmail.com', Client.search, 'query')
+                for _ in xrange(400)]
+        quiet = [pool.submit('quiet@gmail.com', Client.search, 'query')
+                 for _ in xrange(4)]
+        for task in quiet:
+            task.result()
+        quiet_done = time.time() - started
+        for task in busy:
+            task.result()
+        busy_done = time.time() - started
+    print 'fairness: 4 tasks queued after 400 others done in %.2fs ' \
+        '(the 400 in %.2fs)' % (quiet_done, busy_done)
+
+def main(max_accounts=1000, max_clients=50):
+    """Run the benchmark and print the results"""
+    server = start_server()
+    session_dir = tempfile.mkdtemp()
+    try:
+        accounts = 10
+        while accounts <= max_accounts:
+            scale(server, accounts, max_clients, session_dir)
+            accounts *= 10
+        fairness(server)
+    finally:
+        server.stop()
+        shutil.rmtree(session_dir)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,96 @@
+"""
+Compressed responses and JSON decoding
+
+For loadplaylist responses of growing libraries, prints their size plain and
+gzipped and the time to decode them: from a unicode copy of the body (what
+WebRequest used to do), straight from the bytes, and with ujson if it's
+installed. Then times get_all_playlists from a stub server that sends
+responses at a limited rate (a slow link), without and with compression.
+
+    python -m benchmarks.compression [max_songs] [kb_per_sec]
+"""
+__author__ = "Tirino"
+
+import sys
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.client import Client
+from googlemusic.codec import CODECS, get_codec
+from googlemusic.compression import gzip_data
+from tests.library import make_payload
+from tests.service import FakeGoogleMusic
+from tests.stub import throttled
+
+SONGS_PER_PLAYLIST = 500
+
+def best_time(func, repeat=3):
+    """Return the best time of a few calls of func()"""
+    best = None
+    for _ in xrange(repeat):
+        started = time.time()
+        func()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def decoding(max_songs):
+    """Print payload sizes and decoding times"""
+    codecs = []
+    for name in sorted(CODECS):
+        try:
+            codecs.append(get_codec(name))
+        except ImportError:
+            print '(%s is not installed)' % name
+    songs = 1000
+    while songs <= max_songs:
+        payload = make_payload(songs // SONGS_PER_PLAYLIST or 1,
+                               min(songs, SONGS_PER_PLAYLIST))
+        line = '%6d songs  %7.1f KB  gzip %6.1f KB  unicode copy %6.1fms' % (
+            songs, len(payload) / 1024.0, len(gzip_data(payload)) / 1024.0,
+            best_time(lambda: json.loads(unicode(payload, 'utf8'))) * 1000)
+        for codec in codecs:
+            line += '  %s %6.1fms' % (codec.name, best_time(
+                lambda: codec.loads(payload)) * 1000)
+        print line
+        songs *= 4
+
+def transfer(songs, rate):
+    """Time get_all_playlists over a slow link, plain and compressed"""
+    service = FakeGoogleMusic(songs // SONGS_PER_PLAYLIST or 1,
+                              min(songs, SONGS_PER_PLAYLIST), compress=True)
+    route = service.routes['/music/services/loadplaylist']
+    sent = [0]
+    def counted(handler):
+        response = throttled(route, rate)(handler)
+        sent[0] += int(response[1]['Content-Length'])
+        return response
+    service.add_route('/music/services/loadplaylist', counted)
+    service.start()
+    service.install()
+    try:
+        client = Client()
+        client.login('bench@gmail.com', 'p4ssw0rd')
+        for label, compressed in (('plain', False), ('gzip', True)):
+            client.set_compression(compressed)
+            sent[0] = 0
+            started = time.time()
+            client.get_all_playlists()
+            print '%-6s %6.2fs  %8.1f KB received' % (
+                label, time.time() - started, sent[0] / 1024.0)
+        client.pool.close()
+    finally:
+        service.stop()
+
+def main(max_songs=64000, kb_per_sec=2048):
+    """Run the benchmark and print the results"""
+    decoding(max_songs)
+    print
+    print 'get_all_playlists, 16000 songs at %d KB/s:' % kb_per_sec
+    transfer(16000, kb_per_sec * 1024)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,80 @@
+"""
+Sequential vs. parallel loading of many playlists
+
+Loads every playlist of a synthetic library, whose playlists share songs,
+from a stub server that adds latency to each request: one load_playlist
+call after another, then load_playlists with a growing number of workers.
+
+    python -m benchmarks.load_playlists [playlists] [songs] [latency_ms]
+"""
+__author__ = "Tirino"
+
+import ast
+import sys
+import time
+import urlparse
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.client import Client
+from googlemusic.model import Playlist
+from tests.library import make_library
+from tests.stub import StubServer
+
+def make_client(server):
+    """Return a Client talking to the stub server"""
+    client = Client()
+    client.protocol.SERVICE_ENDPOINT = '%s/music/services' % server.url
+    client.protocol.get_xt_for_url = lambda: 'stub'
+    return client
+
+def unique_songs(playlists):
+    """Return how many distinct Song objects the playlists hold"""
+    return len(set(id(song) for playlist in playlists
+                   for song in playlist.songs))
+
+def main(playlists=64, songs=100, latency_ms=50):
+    """Run the benchmark and print the results"""
+    library = make_library(playlists, songs, playlists * songs // 4)
+    responses = dict((data['playlistId'], json.dumps(data))
+                     for data in library)
+    def loadplaylist(handler):
+        # the client sends the payload dict's repr
+        payload = ast.literal_eval(urlparse.parse_qs(handler.body)['json'][0])
+        return 200, {}, responses[payload['id']]
+    server = StubServer(latency=latency_ms / 1000.0)
+    server.add_route('/music/services/loadplaylist', loadplaylist)
+    server.start()
+    try:
+        client = make_client(server)
+        targets = [Playlist({'playlistId': data['playlistId'],
+                             'title': data['title']}) for data in library]
+        started = time.time()
+        for playlist in targets:
+            playlist.songs = []
+            client.load_playlist(playlist)
+        print 'sequential    %6.2fs  %5d Song objects' % (
+            time.time() - started, unique_songs(targets))
+
+        for workers in (4, 16, 32):
+            started = time.time()
+            loaded = client.load_playlists(targets, workers)
+            print 'workers=%-4d  %6.2fs  %5d Song objects' % (
+                workers, time.time() - started, unique_songs(loaded))
+
+        started = time.time()
+        stream = client.load_playlists(targets, 16, ordered=False)
+        next(stream)
+        first = time.time() - started
+        for playlist in stream:
+            pass
+        print 'streamed      %6.2fs  (first playlist after %.3fs)' % (
+            time.time() - started, first)
+        client.pool.close()
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
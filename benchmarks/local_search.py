@@ -0,0 +1,63 @@
+"""
+Local search index over a large synthetic library
+
+Indexes a synthetic library and times exact, prefix (autocomplete) and fuzzy
+(typo) queries against it.
+
+    python -m benchmarks.local_search [songs] [queries]
+"""
+__author__ = "Tirino"
+
+import random
+import sys
+import time
+
+from googlemusic.model import Song
+from googlemusic.search import SearchIndex
+from tests.library import make_song
+
+def percentile(values, percent):
+    """Return the given percentile of a list of numbers"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def typo(word, rand):
+    """Replace a random character of word"""
+    position = rand.randrange(len(word))
+    return word[:position] + 'x' + word[position + 1:]
+
+def main(songs=200000, queries=1000):
+    """Run the benchmark and print the results"""
+    library = [Song(make_song(index)) for index in xrange(songs)]
+    index = SearchIndex()
+    started = time.time()
+    index.add_songs(library)
+    print 'indexed %d songs, %d albums in %.2fs' % (
+        len(index), len(index.albums), time.time() - started)
+
+    rand = random.Random(0)
+    picks = [rand.choice(library) for _ in xrange(queries)]
+    kinds = [
+      ('exact', lambda song: '%s %s' % (song.artist, song.title)),
+      ('prefix', lambda song: song.album[:len(song.album) - 1]),
+      ('keystroke', lambda song: song.artist.split()[0][:2]),
+      ('fuzzy', lambda song: '%s %s' % (typo(song.artist.split()[0], rand),
+                                        song.title)),
+    ]
+    for name, make_query in kinds:
+        timings = []
+        found = 0
+        for song in picks:
+            query = make_query(song)
+            # time the index, not the cache of recent results
+            index.results.clear()
+            started = time.time()
+            result = index.search(query, limit=20)
+            timings.append((time.time() - started) * 1e6)
+            found += bool(result['Songs'] or result['Albums'])
+        print '%-9s p50 %8.0fus  p99 %8.0fus  (%d/%d found)' % (
+            name, percentile(timings, 50), percentile(timings, 99), found,
+            len(picks))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,56 @@
+"""
+Cost of the request instrumentation
+
+Times keep-alive API calls against the stub server with metrics disabled and
+enabled, and prints the collected stats.
+
+    python -m benchmarks.metrics [requests]
+"""
+__author__ = "Tirino"
+
+import sys
+import time
+
+from googlemusic.client import Client
+from tests.stub import StubServer
+
+PAYLOAD = '{"settings": {"labs": []}}'
+
+def make_client(server):
+    """Return a Client talking to the stub server"""
+    client = Client()
+    client.protocol.SERVICE_ENDPOINT = '%s/music/services' % server.url
+    client.protocol.get_xt_for_url = lambda: 'stub'
+    return client
+
+def run(client, requests):
+    """Make the requests and return the time they took"""
+    started = time.time()
+    for _ in xrange(requests):
+        client.get_settings()
+    return time.time() - started
+
+def main(requests=5000):
+    """Run the benchmark and print the results"""
+    server = StubServer()
+    server.add_route('/music/services/loadsettings',
+                     lambda handler: (200, {}, PAYLOAD))
+    server.start()
+    try:
+        client = make_client(server)
+        run(client, 100)
+        disabled = run(client, requests)
+        metrics = client.enable_metrics()
+        enabled = run(client, requests)
+        client.pool.close()
+    finally:
+        server.stop()
+    print 'disabled: %6.1fus per request' % (disabled / requests * 1e6)
+    print 'enabled:  %6.1fus per request' % (enabled / requests * 1e6)
+    for name, stats in sorted(metrics.snapshot().items()):
+        print '%-18s count %d  p50 %.0fus  p99 %.0fus  in %d  out %d' % (
+            name, stats['count'], stats['latency_p50'] * 1e6,
+            stats['latency_p99'] * 1e6, stats['bytes_in'], stats['bytes_out'])
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
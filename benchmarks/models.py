@@ -0,0 +1,97 @@
+"""
+Memory and construction time of the models over a large library
+
+Builds Playlist and Song objects out of a synthetic loadplaylist payload
+(parsed with json, like the client does) and reports how long it took and
+how much memory the resulting objects hold once the raw response is gone:
+
+* legacy: the former plain classes with a __dict__ per instance
+* eager:  the current __slots__ models, with shared strings
+* lazy:   like eager, but Playlist.songs is only built when accessed (the
+          song fields are kept as compact tuples until then)
+* shared: like eager, with a SongRegistry so songs that appear in several
+          playlists are a single object
+
+    python -m benchmarks.models [playlists] [songs_per_playlist]
+"""
+__author__ = "Tirino"
+
+import gc
+import sys
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.model import Playlist, SongRegistry
+from tests.library import make_payload
+
+class LegacySong(object):
+    """The Song model before __slots__ (used as a baseline)"""
+    def __init__(self, data):
+        self.id = str(data['id'])
+        self.name = data['name']
+        self.title = data['title']
+        self.artist = data['artist']
+        self.album = data['album']
+        self.track = data['track']
+        self.artwork_url = data.get('albumArtUrl')
+
+class LegacyPlaylist(object):
+    """The Playlist model before __slots__ (used as a baseline)"""
+    def __init__(self, data):
+        self.id = str(data['playlistId'])
+        self.title = data['title']
+        self.songs = [LegacySong(song) for song in data['playlist']]
+
+def deep_size(root):
+    """Return the size in bytes of root and every object it references"""
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+def build(variant, payload):
+    """Parse the payload, build the models of a variant and time it"""
+    started = time.time()
+    playlists_data = json.loads(payload)['playlists']
+    if variant == 'legacy':
+        models = [LegacyPlaylist(data) for data in playlists_data]
+    elif variant == 'shared':
+        registry = SongRegistry()
+        models = [Playlist(data, registry=registry)
+                  for data in playlists_data]
+    else:
+        models = [Playlist(data, lazy=(variant == 'lazy'))
+                  for data in playlists_data]
+    return models, time.time() - started
+
+def main(playlists=500, songs_per_playlist=200):
+    """Run the benchmark and print the results"""
+    payload = make_payload(playlists, songs_per_playlist,
+                           playlists * songs_per_playlist // 4)
+    print 'library: %d playlists x %d songs, %.1f MB payload' % (
+        playlists, songs_per_playlist, len(payload) / 1048576.0)
+    for variant in ('legacy', 'eager', 'lazy', 'shared'):
+        models, elapsed = build(variant, payload)
+        gc.collect()
+        print '%-7s %6.2fs parse+build, %7.1f MB held' % (
+            variant, elapsed, deep_size(models) / 1048576.0)
+        if variant == 'lazy':
+            started = time.time()
+            songs = sum(len(playlist.songs) for playlist in models)
+            elapsed = time.time() - started
+            print '%-7s %6.2fs to materialize %d songs, %7.1f MB held' % (
+                '', elapsed, songs, deep_size(models) / 1048576.0)
+        del models
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,86 @@
+"""
+Request policies against a faulty, throttling service
+
+Runs concurrent searches against a stub server that fails a share of the
+requests (5xx and dropped connections) and throttles clients above a rate,
+without a policy and with rate limiting, retries and a circuit breaker. Then
+takes the service down to show the circuit breaker sparing it.
+
+    python -m benchmarks.retry_policy [requests] [threads] [error_percent]
+"""
+__author__ = "Tirino"
+
+import sys
+import time
+
+from benchmarks.metrics import make_client
+from googlemusic.concurrency import WorkerPool
+from googlemusic.policy import Backoff, CircuitBreaker, RequestPolicy
+from tests.stub import StubServer, faulty, rate_limited
+
+PAYLOAD = '{"results": {"albums": [], "songs": []}}'
+# requests per second the stub accepts before answering 429
+SERVER_RATE = 300
+
+def run(client, requests, threads):
+    """Make the searches and return (succeeded, failed, elapsed)"""
+    started = time.time()
+    with WorkerPool(threads) as pool:
+        tasks = [pool.submit(client.search, 'query %d' % index)
+                 for index in xrange(requests)]
+    elapsed = time.time() - started
+    errors = [task.exception() for task in tasks if task.exception()]
+    for error in errors:
+        if hasattr(error, 'close'):
+            # release the connection of HTTP errors
+            error.close()
+    return len(tasks) - len(errors), len(errors), elapsed
+
+def main(requests=2000, threads=16, error_percent=10):
+    """Run the benchmark and print the results"""
+    calls = [0]
+    def counted(route):
+        def handle(handler):
+            calls[0] += 1
+            return route(handler)
+        return handle
+    search = rate_limited(faulty(lambda handler: (200, {}, PAYLOAD),
+                                 error_percent / 100.0,
+                                 (500, 502, 503, None)), SERVER_RATE)
+    server = StubServer()
+    server.add_route('/music/services/search', counted(search))
+    server.start()
+    try:
+        policies = [
+          ('no policy', None),
+          ('policy', RequestPolicy(rate=SERVER_RATE * 0.9, burst=threads,
+                                   retries=5, backoff=Backoff(0.05),
+                                   breaker=CircuitBreaker(50, 1))),
+        ]
+        for label, policy in policies:
+            client = make_client(server)
+            client.set_policy(policy)
+            calls[0] = 0
+            succeeded, failed, elapsed = run(client, requests, threads)
+            print '%-10s %4d ok %4d failed  %5d server calls  %.2fs' % (
+                label, succeeded, failed, calls[0], elapsed)
+            client.pool.close()
+
+        server.add_route('/music/services/search',
+                         counted(lambda handler: (503, {}, 'Down')))
+        for label, breaker in [('down, no breaker', None),
+                               ('down, breaker', CircuitBreaker(5, 60))]:
+            client = make_client(server)
+            client.set_policy(RequestPolicy(retries=2,
+                                            backoff=Backoff(0.001),
+                                            breaker=breaker))
+            calls[0] = 0
+            succeeded, failed, elapsed = run(client, requests / 10, threads)
+            print '%-16s %4d failed  %5d server calls  %.2fs' % (
+                label, failed, calls[0], elapsed)
+            client.pool.close()
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,56 @@
+"""
+Serial vs. segmented download of a single large file
+
+Downloads a file from a local range-capable stub server that throttles every
+connection (like a CDN would), first over a single connection and then split
+in parallel byte ranges.
+
+    python -m benchmarks.segmented_download [size_mb] [segments] [kb_per_sec]
+"""
+__author__ = "Tirino"
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from googlemusic.request import CookieManager, WebRequest
+from tests.stub import StubServer, serve_bytes
+
+def main(size_mb=16, segments=8, kb_per_sec=8192):
+    """Run the benchmark and print the results"""
+    data = os.urandom(size_mb * 1024 * 1024)
+    rate = kb_per_sec * 1024
+    server = StubServer()
+    server.add_route('/song.mp3', lambda handler: serve_bytes(handler, data,
+                                                              rate))
+    server.add_route('/noranges.mp3', lambda handler: serve_bytes(
+        handler, data, rate, ranges=False))
+    server.start()
+    folder = tempfile.mkdtemp()
+    web = WebRequest(CookieManager())
+    web.segment_size = 0
+    try:
+        for label, path, count in [('serial', '/song.mp3', 1),
+                                   ('segmented x%d' % segments, '/song.mp3',
+                                    segments),
+                                   ('no ranges (fallback)', '/noranges.mp3',
+                                    segments)]:
+            filename = os.path.join(folder, '%s.mp3' % count)
+            if os.path.exists(filename):
+                os.remove(filename)
+            started = time.time()
+            web.download_file(server.url + path, filename, segments=count)
+            elapsed = time.time() - started
+            with open(filename, 'rb') as downloaded:
+                verified = downloaded.read() == data
+            print '%-22s %.2fs (%.1f MB/s) verified=%s' % (
+                label, elapsed, size_mb / elapsed, verified)
+    finally:
+        web.get_pool().close()
+        server.stop()
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
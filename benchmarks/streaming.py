@@ -0,0 +1,92 @@
+"""
+Streaming songs
+
+Time to the first 64 KB of a song (enough to start playing) served by
+FakeGoogleMusic over a throttled link with latency: downloading the whole
+file first, opening a SongStream, and opening the next song of a SongQueue
+(prefetched while the previous one played). Then times seeks to random
+positions and checks how many bytes a stream kept buffered.
+
+    python -m benchmarks.streaming [songs] [song_kb] [rate_kb] [latency_ms]
+"""
+__author__ = "Tirino"
+
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from googlemusic.client import Client
+from tests.service import FakeGoogleMusic
+
+FIRST_BYTES = 64 * 1024
+
+def report(label, latencies):
+    """Print the average and worst of some latencies"""
+    print '%-22s avg %8.1fms  max %8.1fms' % (
+        label, sum(latencies) / len(latencies) * 1000, max(latencies) * 1000)
+
+def main(songs=5, song_kb=4096, rate_kb=2048, latency_ms=30):
+    """Run the benchmark and print the results"""
+    service = FakeGoogleMusic(playlists=1, songs_per_playlist=songs,
+                              song_bytes=song_kb * 1024,
+                              stream_rate=rate_kb * 1024,
+                              latency=latency_ms / 1000.0).start()
+    service.install()
+    client = Client()
+    client.login('bench@gmail.com', 'p4ssw0rd')
+    playlist = client.get_all_playlists()[0]
+    folder = tempfile.mkdtemp()
+    try:
+        latencies = []
+        for song in playlist.songs:
+            started = time.time()
+            client.download_song(song, folder)
+            latencies.append(time.time() - started)
+        report('download_song', latencies)
+
+        latencies = []
+        for song in playlist.songs:
+            started = time.time()
+            with client.open_song(song) as stream:
+                stream.read(FIRST_BYTES)
+                latencies.append(time.time() - started)
+        report('open_song', latencies)
+
+        # the time a player spends on each song before moving to the next
+        playing = 0.5
+        latencies = []
+        queue = client.queue_songs(playlist.songs)
+        time.sleep(playing)
+        for stream in queue:
+            started = time.time()
+            stream.read(FIRST_BYTES)
+            latencies.append(time.time() - started)
+            time.sleep(playing)
+        queue.close()
+        report('queue_songs (next)', latencies)
+        print '  streamer %s' % client.streamer.stats()
+
+        rnd = random.Random(0)
+        latencies = []
+        peak = 0
+        with client.open_song(playlist.songs[0]) as stream:
+            size = stream.get_size()
+            for _ in xrange(20):
+                stream.seek(rnd.randrange(size))
+                started = time.time()
+                stream.read(FIRST_BYTES)
+                latencies.append(time.time() - started)
+                time.sleep(0.1)
+                peak = max(peak, stream.buffered)
+        report('seek + read', latencies)
+        print '  peak buffered %d KB (buffer %d KB)' % (
+            peak / 1024, stream.buffer_size / 1024)
+    finally:
+        shutil.rmtree(folder)
+        client.pool.close()
+        service.stop()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
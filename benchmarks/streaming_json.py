@@ -0,0 +1,88 @@
+"""
+Peak memory of get_all_playlists vs. iter_all_playlists
+
+Serves a synthetic loadplaylist response from a local stub server and walks
+every playlist and song, either loading the whole response at once or
+streaming it. Each variant runs in its own process, since peak memory can
+only grow, and the response is served from a file so it doesn't count.
+
+    python -m benchmarks.streaming_json [playlists] [songs_per_playlist]
+"""
+__author__ = "Tirino"
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from googlemusic.client import Client
+from tests.library import make_payload
+from tests.stub import StubServer
+
+def peak_memory():
+    """Return the peak resident memory of the process, in MB (Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def serve_file(path):
+    """Route that streams a file in 64 KiB pieces"""
+    def route(handler):
+        def pieces():
+            with open(path, 'rb') as source:
+                for piece in iter(lambda: source.read(65536), ''):
+                    yield piece
+        return 200, {'Content-Length': str(os.path.getsize(path))}, pieces()
+    return route
+
+def run_variant(variant, path):
+    """Measure a single variant (in the current process)"""
+    server = StubServer()
+    server.add_route('/music/services/loadplaylist', serve_file(path))
+    server.start()
+    client = Client()
+    client.protocol.SERVICE_ENDPOINT = '%s/music/services' % server.url
+    client.protocol.get_xt_for_url = lambda: 'stub'
+    baseline = peak_memory()
+    started = time.time()
+    if variant == 'full':
+        playlists = client.get_all_playlists()
+    else:
+        playlists = client.iter_all_playlists()
+    songs = 0
+    for playlist in playlists:
+        songs += len(playlist.songs)
+    print '%-9s %6.2fs, peak %6.1f MB (+%.1f MB) for %d songs, %.1f MB' % (
+        variant, time.time() - started, peak_memory(),
+        peak_memory() - baseline, songs, os.path.getsize(path) / 1048576.0)
+    client.pool.close()
+    server.stop()
+
+def main(playlists=200, songs_per_playlist=500):
+    """Run every variant in a separate process"""
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        # generated in another process, peak memory survives fork/exec
+        subprocess.check_call([sys.executable, '-m',
+                               'benchmarks.streaming_json', 'generate', path,
+                               str(playlists), str(songs_per_playlist)])
+        for variant in ('full', 'streaming'):
+            subprocess.check_call([sys.executable, '-m',
+                                   'benchmarks.streaming_json', variant,
+                                   path])
+    finally:
+        os.remove(path)
+
+def generate(path, playlists, songs_per_playlist):
+    """Write the synthetic response to path"""
+    with open(path, 'wb') as payload:
+        payload.write(make_payload(playlists, songs_per_playlist))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'generate':
+        generate(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    elif len(sys.argv) > 1 and sys.argv[1] in ('full', 'streaming'):
+        run_variant(sys.argv[1], sys.argv[2])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
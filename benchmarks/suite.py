@@ -0,0 +1,318 @@
+"""
+Benchmark suite
+
+Times the main Client operations (login, get_all_playlists over synthetic
+libraries, library exports, search, get_stream_url and downloads) against
+FakeGoogleMusic, and reports throughput, latency percentiles and peak
+memory. Every scenario runs in its own process (and the server in another
+one), so peak memory only counts the client side.
+
+    python -m benchmarks.suite [--latency MS] [--error-rate RATE]
+        [--compress] [--song-kb KB] [--scale N] [--only NAME,...]
+        [--json FILE] [--compare BASELINE [--tolerance 0.25]]
+
+With --compare, the results are checked against a previous --json file and
+the suite exits with status 1 if a scenario got slower (p50 latency or
+throughput) or used more memory than the tolerance allows, e.g. in CI:
+
+    python -m benchmarks.suite --json baseline.json
+    python -m benchmarks.suite --compare baseline.json
+"""
+__author__ = "Tirino"
+
+import multiprocessing
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from googlemusic.client import Client
+from googlemusic.export import Exporter, JSONLinesWriter, song_columns
+from googlemusic.metrics import Histogram
+from googlemusic.policy import Backoff, RequestPolicy
+from tests.library import SYLLABLES
+from tests.service import FakeGoogleMusic, install
+
+USERNAME = 'bench@gmail.com'
+PASSWORD = 'p4ssw0rd'
+
+def logged_in_client():
+    """Return a Client logged in to the FakeGoogleMusic server"""
+    client = Client()
+    client.login(USERNAME, PASSWORD)
+    return client
+
+def all_songs(client):
+    """Return every song of the library"""
+    songs = {}
+    for playlist in client.get_all_playlists():
+        for song in playlist.songs:
+            songs[song.id] = song
+    return sorted(songs.values(), key=lambda song: song.id)
+
+def timed_calls(func, args_list):
+    """Call func(*args) for each args and return the latency of every call"""
+    latencies = []
+    for args in args_list:
+        started = time.time()
+        func(*args)
+        latencies.append(time.time() - started)
+    return latencies
+
+# Scenarios #
+# each one gets the repeat count and returns (latencies, bytes transferred)
+def run_login(repeat):
+    """Full login (ClientLogin, IssueAuthToken, TokenAuth)"""
+    clients = []
+    def login():
+        client = Client(clients and clients[0].pool)
+        client.login(USERNAME, PASSWORD)
+        clients.append(client)
+    latencies = timed_calls(login, [()] * repeat)
+    clients[0].pool.close()
+    return latencies, 0
+
+def run_playlists(repeat):
+    """get_all_playlists, building every Playlist and Song"""
+    client = logged_in_client()
+    latencies = timed_calls(client.get_all_playlists, [()] * repeat)
+    client.pool.close()
+    return latencies, 0
+
+def run_export(repeat):
+    """Library exports to a JSON lines file, streamed from the response"""
+    client = logged_in_client()
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'library.jsonl')
+    def export():
+        with open(path, 'wb') as output:
+            writer = JSONLinesWriter(output, song_columns())
+            Exporter(client.protocol, writer).export(output)
+    try:
+        latencies = timed_calls(export, [()] * repeat)
+    finally:
+        shutil.rmtree(folder)
+        client.pool.close()
+    return latencies, 0
+
+def run_search(repeat):
+    """Server side searches"""
+    client = logged_in_client()
+    queries = [(SYLLABLES[index % len(SYLLABLES)],)
+               for index in xrange(repeat)]
+    latencies = timed_calls(client.search, queries)
+    client.pool.close()
+    return latencies, 0
+
+def run_search_faults(repeat):
+    """Searches retried by a RequestPolicy on injected errors"""
+    client = logged_in_client()
+    client.set_policy(RequestPolicy(retries=8,
+                                    backoff=Backoff(base=0.005, maximum=0.1)))
+    queries = [(SYLLABLES[index % len(SYLLABLES)],)
+               for index in xrange(repeat)]
+    latencies = timed_calls(client.search, queries)
+    client.pool.close()
+    return latencies, 0
+
+def run_stream_url(repeat):
+    """get_stream_url of different songs, without the URL cache"""
+    client = logged_in_client()
+    songs = all_songs(client)
+    ids = [(songs[index % len(songs)].id, True) for index in xrange(repeat)]
+    latencies = timed_calls(client.protocol.get_stream_url, ids)
+    client.pool.close()
+    return latencies, 0
+
+def run_download(repeat):
+    """Song downloads, one after another"""
+    client = logged_in_client()
+    songs = all_songs(client)[:repeat]
+    folder = tempfile.mkdtemp()
+    try:
+        latencies = timed_calls(client.download_song,
+                                [(song, folder) for song in songs])
+        transferred = sum(os.path.getsize(os.path.join(folder, name))
+                          for name in os.listdir(folder))
+    finally:
+        shutil.rmtree(folder)
+        client.pool.close()
+    return latencies, transferred
+
+# name, scenario, repeat, FakeGoogleMusic arguments
+SCENARIOS = [
+  ('login', run_login, 50, {}),
+  ('playlists_1k', run_playlists, 20,
+   {'playlists': 10, 'songs_per_playlist': 100}),
+  ('playlists_20k', run_playlists, 3,
+   {'playlists': 40, 'songs_per_playlist': 500}),
+  ('export_20k', run_export, 3,
+   {'playlists': 40, 'songs_per_playlist': 500}),
+  ('search', run_search, 200,
+   {'playlists': 20, 'songs_per_playlist': 250}),
+  ('search_faults', run_search_faults, 200,
+   {'playlists': 20, 'songs_per_playlist': 250, 'error_rate': 0.1}),
+  ('stream_url', run_stream_url, 500, {}),
+  ('download', run_download, 20, {'song_bytes': 4 * 1024 * 1024}),
+]
+
+# Processes #
+def peak_memory():
+    """Return the peak resident memory of this process in MB, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on Mac OS X, kilobytes elsewhere
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+def serve(settings, queue):
+    """Run a FakeGoogleMusic server (in its own process)"""
+    service = FakeGoogleMusic(**settings)
+    queue.put(service.url)
+    service.serve_forever()
+
+def measure(name, url, repeat, queue):
+    """Run a scenario (in its own process) and put its results in queue"""
+    try:
+        install(url)
+        scenario = dict((item[0], item[1]) for item in SCENARIOS)[name]
+        started = time.time()
+        latencies, transferred = scenario(repeat)
+        elapsed = time.time() - started
+        histogram = Histogram()
+        for latency in latencies:
+            histogram.record(latency)
+        queue.put({
+          'name': name, 'operations': len(latencies), 'elapsed': elapsed,
+          'throughput': len(latencies) / elapsed,
+          'mb_per_s': transferred / elapsed / (1024 * 1024),
+          'p50_ms': histogram.percentile(50) * 1000,
+          'p90_ms': histogram.percentile(90) * 1000,
+          'p99_ms': histogram.percentile(99) * 1000,
+          'max_ms': max(latencies) * 1000,
+          'peak_mb': peak_memory()
+        })
+    except Exception:
+        queue.put({'name': name, 'error': traceback.format_exc()})
+
+def run(name, repeat, settings):
+    """Run a scenario against its own server and return its results"""
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(settings, queue))
+    server.start()
+    try:
+        url = queue.get(timeout=120)
+        worker = multiprocessing.Process(target=measure,
+                                         args=(name, url, repeat, queue))
+        worker.start()
+        result = queue.get()
+        worker.join()
+        return result
+    finally:
+        server.terminate()
+        server.join()
+
+# Reports #
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against a baseline, as strings"""
+    regressions = []
+    for result in results:
+        base = baseline.get(result['name'])
+        if not base or 'error' in result or 'error' in base:
+            continue
+        limit = 1 + tolerance
+        checks = [('p50_ms', result['p50_ms'] > base['p50_ms'] * limit),
+                  ('throughput',
+                   result['throughput'] * limit < base['throughput'])]
+        if result['peak_mb'] and base['peak_mb']:
+            checks.append(('peak_mb',
+                           result['peak_mb'] > base['peak_mb'] * limit))
+        for key, regressed in checks:
+            if regressed:
+                regressions.append('%s: %s %.2f (baseline %.2f)' % (
+                    result['name'], key, result[key], base[key]))
+    return regressions
+
+def print_result(result):
+    """Print a line of the results table"""
+    if 'error' in result:
+        print '%-14s FAILED\n%s' % (result['name'], result['error'])
+        return
+    line = '%-14s %6d ops %8.1f/s  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms' \
+        % (result['name'], result['operations'], result['throughput'],
+           result['p50_ms'], result['p90_ms'], result['p99_ms'])
+    if result['peak_mb'] is not None:
+        line += '  peak %6.1f MB' % result['peak_mb']
+    if result['mb_per_s']:
+        line += '  %6.1f MB/s' % result['mb_per_s']
+    print line
+
+def main(argv=None):
+    """Run the suite and print the results"""
+    parser = optparse.OptionParser(usage='python -m benchmarks.suite '
+                                   '[options]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='latency the server adds to requests, in ms')
+    parser.add_option('--error-rate', type='float', default=None,
+                      help='fraction of API requests that fail')
+    parser.add_option('--compress', action='store_true', default=False,
+                      help='gzip the API responses')
+    parser.add_option('--song-kb', type='int', default=None,
+                      help='size of the stream files, in KB')
+    parser.add_option('--scale', type='float', default=1,
+                      help='multiply the operations of every scenario')
+    parser.add_option('--only', default=None,
+                      help='comma separated scenarios to run')
+    parser.add_option('--json', default=None,
+                      help='write the results to this file')
+    parser.add_option('--compare', default=None,
+                      help='results file to check for regressions')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='allowed regression, as a fraction')
+    options, args = parser.parse_args(argv)
+    only = options.only and options.only.split(',')
+
+    results = []
+    for name, scenario, repeat, settings in SCENARIOS:
+        if only and name not in only:
+            continue
+        settings = dict(settings, latency=options.latency / 1000.0)
+        if options.error_rate is not None:
+            settings['error_rate'] = options.error_rate
+        if options.compress:
+            settings['compress'] = True
+        if options.song_kb:
+            settings['song_bytes'] = options.song_kb * 1024
+        result = run(name, max(1, int(repeat * options.scale)), settings)
+        print_result(result)
+        results.append(result)
+
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump({'results': dict((result['name'], result)
+                                       for result in results)},
+                      output, indent=2, sort_keys=True)
+    failed = any('error' in result for result in results)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+Command line interface
+
+    python -m googlemusic export --user email@gmail.com --output library.csv
+"""
+__author__ = "Tirino"
+
+import sys
+
+from googlemusic import export
+
+COMMANDS = {'export': export.main}
+
+def main(argv=None):
+    """Run the command named by the first argument"""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print >> sys.stderr, 'usage: python -m googlemusic COMMAND [options]'
+        print >> sys.stderr, 'commands: %s' % ', '.join(sorted(COMMANDS))
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+if __name__ == '__main__':
+    sys.exit(main())
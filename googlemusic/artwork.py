@@ -0,0 +1,260 @@
+"""
+Album artwork
+
+Fetch album covers concurrently and keep them in a content-addressed disk
+cache, so covers shared by many songs are downloaded and stored once.
+"""
+__author__ = "Tirino"
+
+import hashlib
+import os
+import re
+import threading
+import urllib2
+from collections import OrderedDict
+
+from googlemusic.concurrency import Task, WorkerPool
+from googlemusic.utils import TEMP_SUFFIX, write_file
+
+SIZE_RE = re.compile(r'=s\d+$')
+
+def artwork_url(item, size=None):
+    """
+    Return the full artwork URL of a Song, an Album or a URL, asking for
+    images of `size` pixels if given (None if there's no artwork)
+    """
+    url = getattr(item, 'artwork_url', item)
+    if not url:
+        return None
+    if url.startswith('//'):
+        url = 'http:' + url
+    if size:
+        if SIZE_RE.search(url):
+            url = SIZE_RE.sub('=s%d' % size, url)
+        elif '=' not in url.rsplit('/', 1)[-1]:
+            url = '%s=s%d' % (url, size)
+    return url
+
+
+class ArtworkCache(object):
+    """
+    Disk cache of images. Images are stored once, named after the SHA-1 of
+    their content, and every URL points to its image. The least recently
+    used images (and the URLs pointing to them) are removed once they take
+    more than max_bytes.
+    """
+    DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.images = os.path.join(path, 'images')
+        self.urls = os.path.join(path, 'urls')
+        for folder in (self.images, self.urls):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.evictions = 0
+        # digest -> size, least recently used first
+        self.sizes = OrderedDict()
+        files = []
+        for name in self._listdir(self.images):
+            stat = os.stat(os.path.join(self.images, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+        for mtime, digest, size in sorted(files):
+            self.sizes[digest] = size
+        self.total = sum(self.sizes.itervalues())
+        # URL file name -> digest, and digest -> URL file names
+        self.targets = {}
+        self.pointers = {}
+        for name in self._listdir(self.urls):
+            filename = os.path.join(self.urls, name)
+            try:
+                with open(filename, 'rb') as url_file:
+                    digest = url_file.read().strip()
+            except IOError:
+                continue
+            if digest in self.sizes:
+                self._point(name, digest)
+            else:
+                # left behind by an eviction that was interrupted
+                self._remove(filename)
+
+    def _listdir(self, folder):
+        """
+        Return the names of the files in a folder, removing the ones left
+        behind by writes that were interrupted
+        """
+        names = []
+        for name in os.listdir(folder):
+            if name.endswith(TEMP_SUFFIX):
+                self._remove(os.path.join(folder, name))
+            else:
+                names.append(name)
+        return names
+
+    def _url_file(self, url):
+        """Return the file that holds the digest of a URL's image"""
+        return os.path.join(self.urls, self._url_name(url))
+
+    @staticmethod
+    def _url_name(url):
+        """Return the name of a URL's file"""
+        return hashlib.sha1(url).hexdigest()
+
+    @staticmethod
+    def _remove(filename):
+        """Remove a file, if it still exists"""
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def _point(self, name, digest):
+        """Record that a URL file points to an image (with the lock held)"""
+        previous = self.targets.get(name)
+        if previous == digest:
+            return
+        if previous is not None:
+            self.pointers[previous].discard(name)
+        self.targets[name] = digest
+        self.pointers.setdefault(digest, set()).add(name)
+
+    def image_file(self, digest):
+        """Return the file of an image"""
+        return os.path.join(self.images, digest)
+
+    def get(self, url):
+        """Return the file of a URL's image, or None if it's not cached"""
+        try:
+            with open(self._url_file(url), 'rb') as url_file:
+                digest = url_file.read().strip()
+        except IOError:
+            return None
+        with self.lock:
+            if digest not in self.sizes:
+                # the image was evicted
+                return None
+            self.sizes[digest] = self.sizes.pop(digest)
+        filename = self.image_file(digest)
+        try:
+            # the modification time keeps the LRU order across restarts
+            os.utime(filename, None)
+        except OSError:
+            return None
+        return filename
+
+    def set(self, url, data):
+        """Store a URL's image and return its file"""
+        digest = hashlib.sha1(data).hexdigest()
+        filename = self.image_file(digest)
+        with self.lock:
+            if digest not in self.sizes:
+                write_file(filename, data)
+                self.sizes[digest] = len(data)
+                self.total += len(data)
+            else:
+                self.sizes[digest] = self.sizes.pop(digest)
+            write_file(self._url_file(url), digest)
+            self._point(self._url_name(url), digest)
+            while self.total > self.max_bytes and len(self.sizes) > 1:
+                self._evict(next(iter(self.sizes)))
+        return filename
+
+    def _evict(self, digest):
+        """Remove an image and its URL files (with the lock held)"""
+        self.total -= self.sizes.pop(digest)
+        self.evictions += 1
+        self._remove(self.image_file(digest))
+        for name in self.pointers.pop(digest, ()):
+            del self.targets[name]
+            self._remove(os.path.join(self.urls, name))
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+class ArtworkFetcher(object):
+    """
+    Fetches artwork through a WebRequest (so it uses the client's
+    keep-alive connections) into an ArtworkCache, up to `workers` images at
+    a time. Each URL is fetched once, even if asked for by several items or
+    several callers at the same time.
+    """
+    DEFAULT_WORKERS = 8
+
+    def __init__(self, web, cache, workers=DEFAULT_WORKERS):
+        self.web = web
+        self.cache = cache
+        self.pool = WorkerPool(workers)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.hits = 0
+        self.fetched = 0
+
+    def submit(self, url):
+        """Return a Task whose result is the file of the URL's image"""
+        filename = self.cache.get(url)
+        with self.lock:
+            if filename:
+                self.hits += 1
+                return Task.from_value(filename)
+            task = self.pending.get(url)
+            if task is None:
+                task = self.pool.submit(self._fetch, url)
+                self.pending[url] = task
+        return task
+
+    def _fetch(self, url):
+        """Download an image into the cache"""
+        try:
+            try:
+                response = self.web.open(url, headers={
+                  'Referer': self.web.DEFAULT_REFERER})
+            except urllib2.HTTPError, error:
+                # release its connection
+                error.close()
+                raise
+            try:
+                data = response.read()
+            finally:
+                response.close()
+            filename = self.cache.set(url, data)
+            with self.lock:
+                self.fetched += 1
+            return filename
+        finally:
+            with self.lock:
+                del self.pending[url]
+
+    def fetch(self, items, size=None):
+        """
+        Return the image files of the given Songs, Albums or URLs, in the
+        same order (None for items without artwork or whose image couldn't
+        be fetched)
+        """
+        urls = [artwork_url(item, size) for item in items]
+        tasks = dict((url, self.submit(url)) for url in set(urls) if url)
+        files = []
+        for url in urls:
+            task = tasks.get(url)
+            files.append(task and not task.exception() and task.result()
+                         or None)
+        return files
+
+    def prefetch(self, items, size=None):
+        """Start fetching the artwork of the given items in the background"""
+        urls = set(artwork_url(item, size) for item in items)
+        return [self.submit(url) for url in urls if url]
+
+    def stats(self):
+        """Return the fetcher counters, for monitoring"""
+        return {
+          'hits': self.hits, 'fetched': self.fetched,
+          'pending': len(self.pending), 'images': len(self.cache),
+          'bytes': self.cache.total, 'evictions': self.cache.evictions
+        }
+
+    def close(self):
+        """Wait for the pending fetches and stop the workers"""
+        self.pool.shutdown()
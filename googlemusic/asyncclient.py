@@ -0,0 +1,480 @@
+"""
+Google Music asynchronous client
+
+A non-blocking counterpart of Client. Python 2 has no asyncio, so requests
+are sent by a single event loop thread multiplexing non-blocking sockets
+(see googlemusic.eventloop and googlemusic.asynchttp): thousands of
+operations can be in flight without a thread each. Every call returns a
+Task right away.
+"""
+__author__ = "Tirino"
+
+import httplib
+import socket
+import sys
+import threading
+import urllib
+import urllib2
+
+from googlemusic.asynchttp import AsyncHTTPClient
+from googlemusic.client import Client
+from googlemusic.concurrency import Task, WorkerPool, as_completed
+from googlemusic.download import PartialDownload, song_filename
+from googlemusic.eventloop import EventLoop, Return
+from googlemusic.model import Playlist
+from googlemusic.protocol import AuthenticationException, MusicManagerClient
+from googlemusic.protocol import RequestException
+from googlemusic.request import FORM_CONTENT_TYPE
+from googlemusic.request import IncompleteDownloadException, get_total_size
+
+class AsyncClient(object):
+    """
+    Asynchronous Client API class.
+    Methods mirror the ones of Client but return a Task: use
+    task.result(), task.add_done_callback(callback) or as_completed(tasks)
+    to get the results. Up to max_connections requests per host are sent at
+    the same time, the rest wait for a free connection; requests that make
+    no progress for timeout seconds fail.
+    The wrapped Client's cookies, session, stream URL cache and Song
+    registry are shared, so both can be used together. Its response cache,
+    request policy and metrics only apply to its own (blocking) calls.
+    Task callbacks may run on the event loop thread: they must not block,
+    and must not wait for other Tasks. Downloaded files are written by a
+    separate disk thread.
+    """
+    DEFAULT_MAX_CONNECTIONS = 16
+    STREAM_CHUNK = 64 * 1024
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, client=None,
+                 timeout=AsyncHTTPClient.DEFAULT_TIMEOUT):
+        self.client = client or Client()
+        self.protocol = self.client.protocol
+        self.web = self.client.web
+        self.loop = EventLoop().start()
+        self.http = AsyncHTTPClient(self.loop, self.client.cookies,
+                                    self.web.compression, max_connections,
+                                    timeout)
+        # one thread, so the writes of each file are done in order
+        self.disk = WorkerPool(1)
+        self.lock = threading.Lock()
+        self.pending = set()
+        # song id -> Task, so concurrent lookups share a request
+        self.stream_url_tasks = {}
+        self.renewal = None
+
+    def set_debug(self, debug):
+        """Enable debug mode"""
+        self.client.set_debug(debug)
+
+    def _spawn(self, generator):
+        """Run a coroutine on the loop and keep track of its Task"""
+        task = self.loop.spawn(generator)
+        with self.lock:
+            self.pending.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task):
+        """Forget a finished Task"""
+        with self.lock:
+            self.pending.discard(task)
+
+    # Authentication #
+    def login(self, username, password, session_file=None):
+        """
+        Log the user in.
+        If session_file is given, the session saved there (if any, and for
+        the same user) is reused without contacting the server, and new
+        sessions are saved to it. Sessions the server rejects are renewed
+        automatically on the next request.
+        """
+        if session_file and \
+                self.protocol.load_session(session_file, username):
+            self.protocol.credentials = (username, password)
+            return Task.from_value(True)
+        self.protocol.session_file = session_file
+        return self._spawn(self._login(username, password))
+
+    def _login(self, username, password):
+        """Coroutine getting the auth tokens and session cookies"""
+        self.protocol.credentials = (username, password)
+        yield self.loop.spawn(self._client_login(username, password))
+        yield self.loop.spawn(self._authenticate_session())
+        self.protocol.auth_generation += 1
+        self.protocol.save_session()
+        raise Return(True)
+
+    def _client_login(self, username, password):
+        """Coroutine getting the account's auth tokens"""
+        url, body, headers = self.protocol._client_login_call(username,
+                                                              password)
+        response = yield self.http.fetch(self.web.prepare(url, body,
+                                                          headers))
+        self.protocol._set_auth_data(username,
+                                     unicode(response.read(), 'utf8'))
+
+    def _authenticate_session(self):
+        """Coroutine turning the auth tokens into session cookies"""
+        mm_client = MusicManagerClient(self.protocol.cookies,
+                                       self.client.pool)
+        headers = {'Content-Type': FORM_CONTENT_TYPE}
+        body = urllib.urlencode(
+            mm_client.issue_auth_body(self.protocol.auth_data))
+        response = yield self.http.fetch(mm_client.base_request.prepare(
+            mm_client.ISSUE_AUTH_URL, body, dict(headers)))
+        issue_auth = unicode(response.read(), 'utf8').rstrip()
+        url = mm_client.token_auth_url(issue_auth,
+                                       self.protocol.SERVICE_NAME,
+                                       self.protocol.GOOGLE_PLAY_URL,
+                                       'jumper')
+        yield self.http.fetch(mm_client.base_request.prepare(
+            url, None, dict(headers)))
+
+    def _reauthenticate(self, generation):
+        """
+        Return a Task renewing a session the server rejected (see
+        Protocol.reauthenticate), shared by every request that saw it
+        """
+        if generation != self.protocol.auth_generation:
+            return Task.from_value(None)
+        if self.renewal is None or self.renewal.done():
+            self.renewal = self.loop.spawn(self._renew())
+        return self.renewal
+
+    def _renew(self):
+        """Coroutine renewing the session"""
+        try:
+            yield self.loop.spawn(self._authenticate_session())
+        except urllib2.HTTPError, error:
+            if not self.protocol.credentials:
+                raise AuthenticationException('Session expired: %s' % error)
+            yield self.loop.spawn(self._client_login(
+                *self.protocol.credentials))
+            yield self.loop.spawn(self._authenticate_session())
+        self.protocol.auth_generation += 1
+        self.protocol.save_session()
+
+    def _xhr_json(self, build):
+        """
+        Coroutine making the XHR request returned by build() (a (url, body,
+        headers) tuple, built again after renewing a rejected session) and
+        returning its result as JSON
+        """
+        for attempt in (0, 1):
+            generation = self.protocol.auth_generation
+            if self.protocol.auth_data and \
+                    not self.protocol.has_session_cookie():
+                # the xt cookie of a restored session expired
+                yield self._reauthenticate(generation)
+                generation = self.protocol.auth_generation
+            url, body, headers = build()
+            request = self.web.prepare(url, body, dict(headers or {}),
+                                       xhr=True)
+            try:
+                response = yield self.http.fetch(request)
+            except urllib2.HTTPError, error:
+                if attempt or not self.protocol.auth_data or \
+                        error.code not in self.protocol.AUTH_ERROR_CODES:
+                    raise
+                yield self._reauthenticate(generation)
+                continue
+            raise Return(self.web.codec.loads(response.read()))
+
+    def _api(self, method, payload=None):
+        """Coroutine making an API call (see Protocol.api_request)"""
+        return self._xhr_json(
+            lambda: self.protocol._api_call(method, payload))
+
+    # Playlists #
+    def get_all_playlists(self, lazy=False):
+        """Get a list of Playlist objects with embedded Song objects"""
+        return self._spawn(self._get_all_playlists(lazy))
+
+    def _get_all_playlists(self, lazy):
+        """Coroutine loading every playlist"""
+        result = yield self.loop.spawn(self._api('loadplaylist', {}))
+        if 'playlists' not in result:
+            raise RequestException("Couldn't get playlists: %s" % result)
+        playlists = [Playlist(playlist_data, lazy, self.client.songs)
+                     for playlist_data in result['playlists']]
+        self.client._index_playlists(playlists)
+        raise Return(playlists)
+
+    def load_playlist(self, playlist):
+        """Populate a Playlist object with its Song objects"""
+        return self._spawn(self._load_playlist(playlist))
+
+    def _load_playlist(self, playlist):
+        """Coroutine loading the songs of a playlist"""
+        body = {'id': playlist.id, 'requestCause': 3, 'requestType': 1}
+        result = yield self.loop.spawn(self._api('loadplaylist', body))
+        if 'playlistId' not in result:
+            raise RequestException("Couldn't load playlist: %s" % result)
+        for song_data in result['playlist']:
+            playlist.songs.append(self.client.songs.song(song_data))
+        self.client._index_playlists([playlist])
+        raise Return(playlist)
+
+    # General #
+    def search(self, query):
+        """Get a dict with the Albums and Songs that match the given query"""
+        return self._spawn(self._search(query))
+
+    def _search(self, query):
+        """Coroutine searching the user's library"""
+        result = yield self.loop.spawn(self._api('search', {'q': query}))
+        if 'results' not in result:
+            raise RequestException('Could not perform search!')
+        raise Return(self.client._search_result(result['results']))
+
+    def get_stream_url(self, song):
+        """Get the stream/download URL for a specific song"""
+        return self._spawn(self._get_stream_url(song))
+
+    def _get_stream_url(self, song):
+        """Coroutine returning a song's stream URL"""
+        result = yield self._stream_url(song.id)
+        raise Return(result['url'])
+
+    def _stream_url(self, song_id, refresh=False):
+        """
+        Return a Task with the stream URL data of a song, from the client's
+        cache of stream URLs if it's there (call it from the loop thread)
+        """
+        if refresh:
+            self.protocol.stream_urls.invalidate(song_id)
+        cached = self.protocol.stream_urls.peek(song_id)
+        if cached is not None:
+            return Task.from_value(cached)
+        task = self.stream_url_tasks.get(song_id)
+        if task is None:
+            task = self.loop.spawn(self._fetch_stream_url(song_id))
+            self.stream_url_tasks[song_id] = task
+            task.add_done_callback(
+                lambda task: self.stream_url_tasks.pop(song_id, None))
+        return task
+
+    def _fetch_stream_url(self, song_id):
+        """Coroutine requesting the URL to stream or download a song"""
+        result = yield self.loop.spawn(self._xhr_json(
+            lambda: (self.protocol._stream_url_call(song_id), None, None)))
+        if 'url' not in result:
+            raise RequestException('Could not get the URL: %s' % result)
+        self.protocol.stream_urls.put(song_id, result)
+        raise Return(result)
+
+    # Transfers #
+    def download_song(self, song, to_folder='.'):
+        """
+        Download the mp3 file of the given Song object, like
+        Client.download_song (interrupted downloads are resumed)
+        """
+        return self._spawn(self._download_song(song, to_folder))
+
+    def _download_song(self, song, to_folder):
+        """Coroutine downloading a song, retrying like WebRequest does"""
+        url = (yield self._stream_url(song.id))['url']
+        partial = yield self.disk.submit(PartialDownload,
+                                         song_filename(song, to_folder))
+        attempt = 0
+        while not (yield self.disk.submit(partial.complete)):
+            try:
+                yield self.loop.spawn(self._download_part(url, partial))
+            except urllib2.HTTPError, error:
+                if error.code == 416:
+                    # the range we asked for doesn't exist anymore
+                    yield self.disk.submit(partial.reset)
+                elif attempt >= self.web.DOWNLOAD_RETRIES:
+                    raise
+                elif error.code in self.web.EXPIRED_URL_CODES:
+                    url = (yield self._stream_url(song.id, True))['url']
+                elif error.code >= 500:
+                    yield self.loop.sleep(
+                        self.web.DOWNLOAD_RETRY_DELAY * (attempt + 1))
+                else:
+                    raise
+            except (socket.error, httplib.HTTPException,
+                    IncompleteDownloadException):
+                if attempt >= self.web.DOWNLOAD_RETRIES:
+                    raise
+                yield self.loop.sleep(
+                    self.web.DOWNLOAD_RETRY_DELAY * (attempt + 1))
+            attempt += 1
+        yield self.disk.submit(partial.commit)
+        raise Return(True)
+
+    def _download_part(self, url, partial):
+        """Coroutine downloading what's missing from a partial download"""
+        offset = yield self.disk.submit(lambda: partial.offset)
+        headers = {
+          'Referer': self.web.DEFAULT_REFERER,
+          'User-Agent': self.web.USER_AGENT,
+          # sizes and offsets must refer to the file itself
+          'Accept-Encoding': 'identity'
+        }
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        sink = DownloadSink(partial, offset, self.web.DOWNLOAD_CHUNK,
+                            self.disk)
+        try:
+            yield self.http.fetch(urllib2.Request(url, None, headers),
+                                  sink.write, sink.start)
+        except Exception:
+            error = sys.exc_info()
+            try:
+                yield sink.close()
+            except Exception:
+                pass
+            raise error[0], error[1], error[2]
+        yield sink.close()
+        if sink.total_size is None:
+            # no Content-Length, trust the server closed the stream at the end
+            partial.size = sink.downloaded
+            yield self.disk.submit(partial.save)
+        elif sink.downloaded != sink.total_size:
+            raise IncompleteDownloadException(
+                'Got %d of %d bytes' % (sink.downloaded, sink.total_size))
+
+    def stream_song(self, song, callback, chunk_size=STREAM_CHUNK):
+        """
+        Download a song calling callback(data) (from the event loop thread,
+        so it must not block) with every chunk, as it's received. The Task's
+        result is the number of bytes received
+        """
+        return self._spawn(self._stream_song(song, callback, chunk_size))
+
+    def _stream_song(self, song, callback, chunk_size):
+        """Coroutine reading a song's stream, passing its chunks on"""
+        url = (yield self._stream_url(song.id))['url']
+        headers = {
+          'Referer': self.web.DEFAULT_REFERER,
+          'User-Agent': self.web.USER_AGENT
+        }
+        received = [0]
+        def on_chunk(data):
+            received[0] += len(data)
+            callback(data)
+        yield self.http.fetch(urllib2.Request(url, None, headers), on_chunk,
+                              chunk_size=chunk_size)
+        raise Return(received[0])
+
+    def map(self, method, items, *args):
+        """Call one of the async methods for every item and return the Tasks"""
+        return [method(item, *args) for item in items]
+
+    def as_completed(self, tasks):
+        """Yield the given tasks as they finish"""
+        return as_completed(tasks)
+
+    def close(self):
+        """Wait for the pending operations and stop the event loop"""
+        with self.lock:
+            pending = list(self.pending)
+        for task in pending:
+            task.wait()
+        closed = Task(self.http.close, (), {})
+        self.loop.call_soon(closed.run)
+        closed.wait()
+        self.loop.close()
+        self.disk.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DownloadSink(object):
+    """
+    Writes the body of a (possibly partial) download response into a
+    PartialDownload, journaling it every chunk_size bytes.
+    The file and journal are written by the disk pool (which must have a
+    single thread), not by the loop thread; once a chunk is journaled, the
+    response isn't read on until the chunk before it is on disk.
+    """
+    def __init__(self, partial, offset, chunk_size, disk):
+        self.partial = partial
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.disk = disk
+        self.dest = None
+        self.error = None
+        self.marking = None
+        self.total_size = None
+        self.downloaded = self.marked = 0
+
+    def start(self, response):
+        """Open the .part file once the response headers arrive"""
+        offset = self.offset
+        if offset and response.code != 206:
+            # the server ignored the Range header, start over
+            offset = 0
+        self.total_size = get_total_size(response.info(), offset)
+        reset = not offset or self.total_size != self.partial.size
+        if reset:
+            offset = 0
+        self.downloaded = self.marked = offset
+        self._submit(self._open, offset, reset)
+
+    def write(self, data):
+        """Write a piece of the body. Returns a Task to wait for, if any"""
+        self._submit(self._write, data)
+        self.downloaded += len(data)
+        if self.downloaded - self.marked >= self.chunk_size:
+            return self.mark()
+        return None
+
+    def mark(self):
+        """
+        Journal what was written since the last mark. Returns the Task of
+        the previous mark
+        """
+        previous = self.marking
+        self.marking = self._submit(self._mark, self.marked, self.downloaded)
+        self.marked = self.downloaded
+        return previous
+
+    def close(self):
+        """
+        Journal and close the .part file. Returns a Task that fails with the
+        first error writing it, if there was one
+        """
+        if self.downloaded > self.marked:
+            self.mark()
+        return self.disk.submit(self._close)
+
+    def _submit(self, func, *args):
+        """Run func on the disk thread, unless writing already failed"""
+        return self.disk.submit(self._guarded, func, args)
+
+    def _guarded(self, func, args):
+        """Call func, keeping its error"""
+        if self.error is None:
+            try:
+                func(*args)
+            except Exception:
+                self.error = sys.exc_info()
+
+    # Disk thread #
+    def _open(self, offset, reset):
+        """Open the .part file at offset, forgetting the journal if reset"""
+        if reset:
+            self.partial.reset(self.total_size)
+        self.dest = self.partial.open(offset)
+
+    def _write(self, data):
+        """Write data to the .part file"""
+        self.dest.write(data)
+
+    def _mark(self, start, end):
+        """Flush the .part file and journal [start, end)"""
+        self.dest.flush()
+        self.partial.mark(start, end)
+
+    def _close(self):
+        """Close the .part file and raise the error writing it, if any"""
+        if self.dest is not None:
+            self.dest.close()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
@@ -0,0 +1,757 @@
+"""
+Non-blocking HTTP client
+
+HTTP/1.1 over non-blocking sockets driven by an EventLoop: a single thread
+keeps any number of requests in flight. Requests are urllib2 Requests, so
+cookies, compression and redirects work like they do for WebRequest.
+"""
+__author__ = "Tirino"
+
+import base64
+import errno
+import httplib
+import os
+import socket
+import ssl
+import sys
+import time
+import urllib
+import urllib2
+import urlparse
+from collections import deque
+from StringIO import StringIO
+
+from googlemusic.compression import DECODED_ENCODINGS, StreamDecoder
+from googlemusic.concurrency import Task, WorkerPool
+from googlemusic.eventloop import Return
+
+# errors of non-blocking calls that would have had to wait
+WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINPROGRESS,
+               getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+class StreamClosedError(socket.error):
+    """The connection was closed before an operation finished"""
+    pass
+
+def failed(error):
+    """Return a Task that finished with the given exception"""
+    task = Task(None, (), {})
+    task.set_error((type(error), error, None))
+    return task
+
+
+class SocketStream(object):
+    """
+    Buffered non-blocking socket driven by an EventLoop.
+    Reads and writes return Tasks, and one of each can be pending at a time.
+    They fail with socket.timeout if the connection makes no progress for
+    timeout seconds. Use it from the loop thread only.
+    """
+    READ_SIZE = 64 * 1024
+    SEND_SIZE = 256 * 1024
+    # stop reading from the socket while this much data is unread
+    MAX_BUFFER = 1024 * 1024
+
+    def __init__(self, loop, sock, timeout=None):
+        self.loop = loop
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.fd = sock.fileno()
+        self.timeout = timeout
+        self.timer = None
+        self.buffer = ''
+        self.received = 0
+        self.eof = False
+        self.reading = False
+        self.read_task = None
+        self.read_op = None
+        self.write_data = ''
+        self.write_task = None
+        self.closed = False
+        # called with the stream when it's closed
+        self.on_close = None
+        self.idle_since = None
+
+    # Connection #
+    def connect(self, address):
+        """Connect the socket to address"""
+        task = Task(None, (), {})
+        code = self.sock.connect_ex(address)
+        if code and code not in WOULD_BLOCK + (errno.EALREADY,):
+            self.close(socket.error(code, os.strerror(code)))
+            return failed(socket.error(code, os.strerror(code)))
+        self.write_task = task
+        self.loop.add_writer(self.fd, self._connected)
+        self._arm()
+        return task
+
+    def _connected(self):
+        """Finish connecting once the socket is writable"""
+        self.loop.remove_writer(self.fd)
+        code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            self.close(socket.error(code, os.strerror(code)))
+            return
+        self._start_reading()
+        self._finish_write(None)
+
+    def start_tls(self, hostname):
+        """Do a TLS handshake, checking the certificate of hostname"""
+        self._stop_reading()
+        context = ssl.create_default_context()
+        self.sock = context.wrap_socket(self.sock, server_hostname=hostname,
+                                        do_handshake_on_connect=False)
+        self.write_task = Task(None, (), {})
+        task = self.write_task
+        self._arm()
+        self._handshake()
+        return task
+
+    def _handshake(self):
+        """Advance the TLS handshake"""
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, error:
+            if error.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.loop.add_reader(self.fd, self._handshake)
+            elif error.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.loop.add_writer(self.fd, self._handshake)
+            else:
+                self.close(error)
+            return
+        except socket.error, error:
+            self.close(error)
+            return
+        self._start_reading()
+        self._finish_write(None)
+
+    # Reads #
+    def read_until(self, delimiter, max_bytes):
+        """Read up to and including delimiter, at most max_bytes away"""
+        return self._read(('until', delimiter, max_bytes))
+
+    def read_bytes(self, size):
+        """Read exactly size bytes"""
+        return self._read(('bytes', size))
+
+    def read_some(self, size):
+        """Read up to size bytes, as soon as any arrive ('' at the end)"""
+        return self._read(('some', size))
+
+    def _read(self, op):
+        """Start a read operation"""
+        if self.read_task:
+            raise RuntimeError('Already reading')
+        task = Task(None, (), {})
+        self.read_task, self.read_op = task, op
+        if not self._satisfy():
+            if self.closed:
+                self._fail_read(StreamClosedError('Connection closed'))
+            else:
+                self._arm()
+                # TLS may hold decrypted data that poll() doesn't report
+                self._handle_read()
+        return task
+
+    def _satisfy(self):
+        """Finish the pending read if it can be. Return True if it did"""
+        op = self.read_op
+        data = None
+        if op[0] == 'until':
+            index = self.buffer.find(op[1])
+            if index >= 0:
+                data = self.buffer[:index + len(op[1])]
+            elif len(self.buffer) > op[2]:
+                self._fail_read(IOError('No %r in %d bytes' % (op[1], op[2])))
+                return True
+        elif op[0] == 'bytes':
+            if len(self.buffer) >= op[1]:
+                data = self.buffer[:op[1]]
+        elif self.buffer or self.eof:
+            data = self.buffer[:op[1]]
+        if data is None:
+            if self.eof:
+                self._fail_read(StreamClosedError('Connection closed'))
+                return True
+            return False
+        self.buffer = self.buffer[len(data):]
+        task = self.read_task
+        self.read_task = self.read_op = None
+        self._arm()
+        if not self.reading and not self.eof and not self.closed:
+            self._start_reading()
+        task.set_result(data)
+        return True
+
+    def _fail_read(self, error):
+        """Fail the pending read"""
+        task = self.read_task
+        self.read_task = self.read_op = None
+        if task:
+            task.set_error((type(error), error, None))
+
+    def _start_reading(self):
+        """Watch the socket for data"""
+        if not self.reading:
+            self.reading = True
+            self.loop.add_reader(self.fd, self._handle_read)
+
+    def _stop_reading(self):
+        """Stop watching the socket for data"""
+        if self.reading:
+            self.reading = False
+            self.loop.remove_reader(self.fd)
+
+    def _handle_read(self):
+        """Read what the socket has, and finish the pending read if it can"""
+        while len(self.buffer) < self.MAX_BUFFER and not self.eof:
+            try:
+                data = self.sock.recv(self.READ_SIZE)
+            except ssl.SSLError, error:
+                if error.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                     ssl.SSL_ERROR_WANT_WRITE):
+                    break
+                self.close(error)
+                return
+            except socket.error, error:
+                if error.args[0] in WOULD_BLOCK:
+                    break
+                if error.args[0] == errno.EINTR:
+                    continue
+                self.close(error)
+                return
+            if not data:
+                self.eof = True
+                break
+            self.buffer += data
+            self.received += len(data)
+            if self.read_task and self._satisfy():
+                break
+        if self.read_task:
+            self._satisfy()
+        if self.eof or len(self.buffer) >= self.MAX_BUFFER:
+            self._stop_reading()
+        if self.eof and not self.read_task and not self.buffer:
+            # e.g. the server closed an idle keep-alive connection
+            self.close()
+
+    # Writes #
+    def write(self, data):
+        """Send data"""
+        if self.write_task:
+            raise RuntimeError('Already writing')
+        if self.closed:
+            return failed(StreamClosedError('Connection closed'))
+        task = Task(None, (), {})
+        self.write_task = task
+        self.write_data = data
+        self._handle_write()
+        if self.write_task:
+            self.loop.add_writer(self.fd, self._handle_write)
+            self._arm()
+        return task
+
+    def _handle_write(self):
+        """Send what the socket takes"""
+        while self.write_data:
+            try:
+                sent = self.sock.send(self.write_data[:self.SEND_SIZE])
+            except ssl.SSLError, error:
+                if error.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                     ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                self.close(error)
+                return
+            except socket.error, error:
+                if error.args[0] in WOULD_BLOCK:
+                    return
+                if error.args[0] == errno.EINTR:
+                    continue
+                self.close(error)
+                return
+            self.write_data = self.write_data[sent:]
+            if self.timer:
+                self._arm()
+        self.loop.remove_writer(self.fd)
+        self._finish_write(None)
+
+    def _finish_write(self, error):
+        """Finish the pending write (or connect/handshake)"""
+        task = self.write_task
+        self.write_task = None
+        self._arm()
+        if task is None:
+            return
+        if error:
+            task.set_error((type(error), error, None))
+        else:
+            task.set_result(None)
+
+    # Timeouts #
+    def _arm(self):
+        """Restart the inactivity timer, if an operation is pending"""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.timeout and (self.read_task or self.write_task) and \
+                not self.closed:
+            self.timer = self.loop.call_later(self.timeout, self._timed_out)
+
+    def _timed_out(self):
+        """Fail the pending operations"""
+        self.timer = None
+        self.close(socket.timeout('timed out'))
+
+    def close(self, error=None):
+        """Close the socket, failing the pending operations with error"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.reading = False
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        error = error or StreamClosedError('Connection closed')
+        self._fail_read(error)
+        self._finish_write(error)
+        if self.on_close:
+            self.on_close(self)
+
+
+class AsyncResponse(object):
+    """A response of AsyncHTTPClient, with the interface of urllib2's"""
+    def __init__(self, url, code, msg, headers, body=''):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        """Return the body (empty if it was passed to on_chunk)"""
+        return self.body
+
+    def info(self):
+        """Return the headers"""
+        return self.headers
+
+    def geturl(self):
+        """Return the URL"""
+        return self.url
+
+    def getcode(self):
+        """Return the HTTP status code"""
+        return self.code
+
+
+class AsyncHTTPClient(object):
+    """
+    HTTP client keeping up to max_per_host keep-alive connections to each
+    host; requests beyond that wait for a free connection.
+    Like the blocking one (see googlemusic.connection), a request that fails
+    on a reused connection is sent again on a new one only if it didn't
+    reach the server or its method is idempotent. Proxies are taken from
+    the environment. Host names are resolved (and cached) by worker threads,
+    so lookups don't block the loop.
+    """
+    DEFAULT_MAX_PER_HOST = 16
+    DEFAULT_TIMEOUT = 60
+    IDLE_TIMEOUT = 60
+    DNS_TTL = 300
+    RESOLVER_THREADS = 4
+    READ_SIZE = 64 * 1024
+    MAX_HEADER_SIZE = 64 * 1024
+    MAX_REDIRECTS = 10
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, loop, cookies=None, compression=None,
+                 max_per_host=DEFAULT_MAX_PER_HOST, timeout=DEFAULT_TIMEOUT):
+        self.loop = loop
+        self.cookies = cookies
+        self.compression = compression
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.redirects = urllib2.HTTPRedirectHandler()
+        self.proxies = urllib.getproxies()
+        self.addresses = {}
+        # address -> Task, so concurrent connections share a lookup
+        self.resolving = {}
+        self.resolver = WorkerPool(self.RESOLVER_THREADS)
+        self.idle = {}
+        self.active = {}
+        self.waiting = {}
+        self.created = 0
+        self.reused = 0
+
+    def fetch(self, request, on_chunk=None, on_headers=None,
+              chunk_size=READ_SIZE):
+        """
+        Send a urllib2 Request and return a Task with its AsyncResponse,
+        following redirects. Error statuses fail the Task with a
+        urllib2.HTTPError. If given, on_headers(response) is called once
+        the headers of a successful response arrive, and on_chunk(data) with
+        each (decoded) piece of its body, which isn't kept then. Both are
+        called on the loop thread and must not block; if on_chunk returns a
+        Task, the rest of the body is only read once it finishes.
+        """
+        return self.loop.spawn(self._fetch(request, on_chunk, on_headers,
+                                           chunk_size))
+
+    def _fetch(self, request, on_chunk, on_headers, chunk_size):
+        """Coroutine sending a request and following its redirects"""
+        for _ in xrange(self.MAX_REDIRECTS + 1):
+            if self.cookies is not None:
+                self.cookies.add_cookie_header(request)
+            if self.compression is not None:
+                self.compression.http_request(request)
+            response = yield self.loop.spawn(self._send(
+                request, on_chunk, on_headers, chunk_size))
+            if self.cookies is not None:
+                self.cookies.extract_cookies(response, request)
+            location = response.headers.getheader('Location') or \
+                response.headers.getheader('URI')
+            if response.code in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(request.get_full_url(), location)
+                request = self.redirects.redirect_request(
+                    request, None, response.code, response.msg,
+                    response.headers, url)
+                continue
+            if not 200 <= response.code < 300:
+                raise urllib2.HTTPError(response.url, response.code,
+                                        response.msg, response.headers,
+                                        StringIO(response.body))
+            raise Return(response)
+        raise urllib2.HTTPError(request.get_full_url(), response.code,
+                                'Too many redirects', response.headers,
+                                StringIO(response.body))
+
+    def _send(self, request, on_chunk, on_headers, chunk_size):
+        """Coroutine sending a request and reading its response"""
+        key = self._key(request)
+        method = request.get_method()
+        data = self._head(request, key) + (request.get_data() or '')
+        fresh = False
+        while True:
+            stream, reused = yield self._acquire(key, fresh)
+            received = stream.received
+            sent = False
+            try:
+                yield stream.write(data)
+                sent = True
+                response, keep_alive = yield self.loop.spawn(
+                    self._read_response(stream, request, on_chunk,
+                                        on_headers, chunk_size))
+            except Exception:
+                error = sys.exc_info()
+                self._release(key, stream, False)
+                # a kept-alive connection the server had already closed
+                if reused and stream.received == received and \
+                        isinstance(error[1], (IOError,
+                                              httplib.HTTPException)) and \
+                        (not sent or method in self.IDEMPOTENT_METHODS):
+                    fresh = True
+                    continue
+                raise error[0], error[1], error[2]
+            self._release(key, stream, keep_alive)
+            raise Return(response)
+
+    def _key(self, request):
+        """Return the (scheme, host, port, proxy) a request is sent to"""
+        scheme = request.get_type()
+        host, port = urllib.splitport(request.get_host())
+        port = int(port) if port else DEFAULT_PORTS[scheme]
+        proxy = self.proxies.get(scheme)
+        if proxy and urllib.proxy_bypass(host):
+            proxy = None
+        return scheme, host, port, proxy
+
+    def _head(self, request, key):
+        """Return the request line and headers of a request"""
+        scheme, _, _, proxy = key
+        if proxy and scheme == 'http':
+            target = request.get_full_url()
+        else:
+            target = request.get_selector() or '/'
+        headers = dict((name.capitalize(), value)
+                       for name, value in request.header_items())
+        headers.setdefault('Host', request.get_host())
+        data = request.get_data()
+        if data is not None:
+            headers.setdefault('Content-type',
+                               'application/x-www-form-urlencoded')
+            headers['Content-length'] = str(len(data))
+        if proxy and scheme == 'http':
+            authorization = self._proxy_authorization(proxy)
+            if authorization:
+                headers['Proxy-authorization'] = authorization
+        lines = ['%s %s HTTP/1.1' % (request.get_method(), target)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    @staticmethod
+    def _proxy_authorization(proxy):
+        """Return the Proxy-Authorization header of a proxy URL, if any"""
+        user_pass = urllib.splituser(urlparse.urlparse(proxy).netloc)[0]
+        if not user_pass:
+            return None
+        return 'Basic ' + base64.b64encode(urllib.unquote(user_pass))
+
+    def _read_response(self, stream, request, on_chunk, on_headers,
+                       chunk_size):
+        """Coroutine reading a response. Returns (response, keep_alive)"""
+        while True:
+            head = yield stream.read_until('\r\n\r\n', self.MAX_HEADER_SIZE)
+            status, _, header_text = head.partition('\r\n')
+            parts = status.split(None, 2)
+            try:
+                code = int(parts[1])
+            except (IndexError, ValueError):
+                raise httplib.BadStatusLine(status)
+            if not parts[0].startswith('HTTP/'):
+                raise httplib.BadStatusLine(status)
+            # skip 100 Continue
+            if code >= 200 or code == 101:
+                break
+        headers = httplib.HTTPMessage(StringIO(header_text))
+        response = AsyncResponse(request.get_full_url(), code,
+                                 parts[2].strip() if len(parts) > 2 else '',
+                                 headers)
+        connection = (headers.getheader('Connection') or '').lower()
+        if parts[0] == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        length = headers.getheader('Content-Length')
+        chunked = (headers.getheader('Transfer-Encoding') or '').lower() == \
+            'chunked'
+        decoder = None
+        encoding = (headers.getheader('Content-Encoding') or '').lower()
+        if encoding in DECODED_ENCODINGS:
+            decoder = StreamDecoder(encoding)
+            # the lengths and encoding no longer apply to the decoded body
+            for name in ('content-encoding', 'content-length'):
+                if name in headers:
+                    del headers[name]
+
+        streamed = on_chunk is not None and 200 <= code < 300
+        if streamed and on_headers:
+            on_headers(response)
+        body = []
+        def deliver(data):
+            """Pass data on, returning the Task to wait for, if any"""
+            if decoder:
+                data = decoder.decode(data)
+            if not data:
+                return None
+            if streamed:
+                return on_chunk(data)
+            body.append(data)
+
+        if request.get_method() == 'HEAD' or code in (204, 304):
+            pass
+        elif chunked:
+            while True:
+                line = yield stream.read_until('\r\n', self.MAX_HEADER_SIZE)
+                try:
+                    size = int(line.split(';')[0].strip(), 16)
+                except ValueError:
+                    raise httplib.IncompleteRead(''.join(body))
+                if not size:
+                    break
+                while size:
+                    data = yield stream.read_some(min(size, chunk_size))
+                    if not data:
+                        raise httplib.IncompleteRead(''.join(body), size)
+                    size -= len(data)
+                    paused = deliver(data)
+                    if paused:
+                        yield paused
+                yield stream.read_bytes(2)
+            # trailers
+            while (yield stream.read_until('\r\n', self.MAX_HEADER_SIZE)) \
+                    != '\r\n':
+                pass
+        elif length is not None:
+            try:
+                left = int(length.strip())
+            except ValueError:
+                raise httplib.BadStatusLine(status)
+            while left > 0:
+                data = yield stream.read_some(min(left, chunk_size))
+                if not data:
+                    raise httplib.IncompleteRead(''.join(body), left)
+                left -= len(data)
+                paused = deliver(data)
+                if paused:
+                    yield paused
+        else:
+            # the body ends when the server closes the connection
+            keep_alive = False
+            while True:
+                data = yield stream.read_some(chunk_size)
+                if not data:
+                    break
+                paused = deliver(data)
+                if paused:
+                    yield paused
+        if decoder:
+            data = decoder.flush()
+            decoder = None
+            paused = deliver(data)
+            if paused:
+                yield paused
+        response.body = ''.join(body)
+        raise Return((response, keep_alive))
+
+    # Connections #
+    def _acquire(self, key, fresh=False):
+        """
+        Return a Task with a (stream, reused) tuple for key: an idle
+        connection (unless fresh is True) or a new one, as soon as the
+        host has a free slot
+        """
+        idle = self.idle.get(key)
+        now = time.time()
+        while idle and not fresh:
+            stream = idle.pop()
+            if stream.closed or stream.buffer or \
+                    now - stream.idle_since > self.IDLE_TIMEOUT:
+                stream.on_close = None
+                stream.close()
+                continue
+            stream.on_close = None
+            self.active[key] = self.active.get(key, 0) + 1
+            self.reused += 1
+            return Task.from_value((stream, True))
+        if self.active.get(key, 0) < self.max_per_host:
+            return self._open(key)
+        task = Task(None, (), {})
+        self.waiting.setdefault(key, deque()).append(task)
+        return task
+
+    def _open(self, key):
+        """Take a slot of key's host and open a connection"""
+        self.active[key] = self.active.get(key, 0) + 1
+        self.created += 1
+        task = self.loop.spawn(self._connect(key))
+        def opened(task):
+            if task.error:
+                self._free(key)
+        task.add_done_callback(opened)
+        return task
+
+    def _connect(self, key):
+        """Coroutine connecting to key's host. Returns (stream, False)"""
+        scheme, host, port, proxy = key
+        address = (host, port)
+        if proxy:
+            proxy_host, proxy_port = urllib.splitport(urllib.splituser(
+                urlparse.urlparse(proxy).netloc)[1])
+            address = (proxy_host, int(proxy_port or 80))
+        family, kind, protocol, _, sockaddr = yield self._resolve(address)
+        stream = SocketStream(self.loop, socket.socket(family, kind, protocol),
+                              self.timeout)
+        try:
+            yield stream.connect(sockaddr)
+            stream.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if proxy and scheme == 'https':
+                yield self.loop.spawn(self._tunnel(stream, key))
+            if scheme == 'https':
+                yield stream.start_tls(host)
+        except Exception:
+            error = sys.exc_info()
+            stream.close()
+            raise error[0], error[1], error[2]
+        raise Return((stream, False))
+
+    def _tunnel(self, stream, key):
+        """Coroutine asking a proxy to CONNECT to key's host"""
+        _, host, port, proxy = key
+        lines = ['CONNECT %s:%d HTTP/1.1' % (host, port),
+                 'Host: %s:%d' % (host, port)]
+        authorization = self._proxy_authorization(proxy)
+        if authorization:
+            lines.append('Proxy-Authorization: %s' % authorization)
+        yield stream.write('\r\n'.join(lines) + '\r\n\r\n')
+        head = yield stream.read_until('\r\n\r\n', self.MAX_HEADER_SIZE)
+        status = head.split('\r\n', 1)[0]
+        parts = status.split(None, 2)
+        if len(parts) < 2 or parts[1] != '200':
+            raise socket.error('Tunnel connection failed: %s' % status)
+
+    def _resolve(self, address):
+        """
+        Return a Task with the first getaddrinfo() entry of address, from
+        the cache if it's there (call it from the loop thread)
+        """
+        cached = self.addresses.get(address)
+        if cached and cached[0] > time.time():
+            return Task.from_value(cached[1])
+        task = self.resolving.get(address)
+        if task is None:
+            task = self.loop.spawn(self._lookup(address))
+            self.resolving[address] = task
+            task.add_done_callback(
+                lambda task: self.resolving.pop(address, None))
+        return task
+
+    def _lookup(self, address):
+        """Coroutine resolving address on a worker thread"""
+        infos = yield self.resolver.submit(socket.getaddrinfo, address[0],
+                                           address[1], 0, socket.SOCK_STREAM)
+        self.addresses[address] = (time.time() + self.DNS_TTL, infos[0])
+        raise Return(infos[0])
+
+    def _release(self, key, stream, keep_alive):
+        """Give back a connection, handing it to a waiting request if any"""
+        if not keep_alive or stream.closed or stream.buffer:
+            stream.close()
+            self._free(key)
+            return
+        waiting = self.waiting.get(key)
+        if waiting:
+            self.reused += 1
+            waiting.popleft().set_result((stream, True))
+            return
+        self.active[key] -= 1
+        stream.idle_since = time.time()
+        stream.on_close = lambda stream: self._discard(key, stream)
+        self.idle.setdefault(key, []).append(stream)
+
+    def _free(self, key):
+        """Give back the slot of a closed connection"""
+        self.active[key] -= 1
+        waiting = self.waiting.get(key)
+        if waiting:
+            waiter = waiting.popleft()
+            self._open(key).add_done_callback(
+                lambda task: waiter.set_error(task.error) if task.error
+                else waiter.set_result(task.value))
+
+    def _discard(self, key, stream):
+        """Forget an idle connection the server closed"""
+        idle = self.idle.get(key)
+        if idle and stream in idle:
+            idle.remove(stream)
+
+    def close(self):
+        """
+        Close the idle connections and stop the resolver threads (call it
+        from the loop thread)
+        """
+        for streams in self.idle.values():
+            for stream in streams:
+                stream.on_close = None
+                stream.close()
+        self.idle = {}
+        self.resolver.shutdown(wait=False)
@@ -0,0 +1,227 @@
+"""
+Batched playlist changes
+
+Queue playlist creations, renames and deletions, drop the redundant ones and
+send the rest in parallel.
+"""
+__author__ = "Tirino"
+
+from googlemusic.concurrency import WorkerPool
+from googlemusic.protocol import RequestException
+
+class BatchOperation(object):
+    """A queued playlist change and its outcome"""
+    CREATE = 'create'
+    RENAME = 'rename'
+    DELETE = 'delete'
+
+    # statuses
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    MERGED = 'merged'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, action, target=None, title=None, songs=None):
+        self.action = action
+        # a Playlist, or the BatchOperation that creates it
+        self.target = target
+        self.title = title
+        self.songs = songs
+        self.status = self.PENDING
+        self.result = None
+        self.error = None
+        self.merged_into = None
+
+    @property
+    def success(self):
+        """True if the operation (or the one it was merged into) worked"""
+        return self.status in (self.DONE, self.MERGED, self.CANCELLED) and \
+            self.error is None
+
+    def __str__(self):
+        if self.action == self.CREATE:
+            name = self.title
+        else:
+            name = getattr(self.target, 'id', None) or self.target.title
+        return '%s %s: %s' % (self.action, name, self.error or self.status)
+
+
+class PlaylistBatch(object):
+    """
+    Queue of playlist changes, sent when the batch is committed (or when the
+    with block ends without an exception):
+
+        with client.batch() as batch:
+            new = batch.add_playlist('New')
+            batch.modify_playlist(new, 'Renamed')
+            batch.delete_playlist(old_playlist)
+
+    Redundant operations are dropped before anything is sent: repeated
+    renames only send the last one, renames followed by a delete only send
+    the delete, a created playlist is created with its final title and one
+    that is created and deleted is never sent (later changes to it fail).
+    The remaining operations are sent by up to `workers` threads and every
+    operation gets its outcome.
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, client, workers=DEFAULT_WORKERS):
+        self.client = client
+        self.workers = workers
+        self.operations = []
+
+    def add_playlist(self, title, songs=None):
+        """Queue the creation of a playlist. The result is the Playlist"""
+        return self._queue(BatchOperation(BatchOperation.CREATE, None, title,
+                                          songs))
+
+    def modify_playlist(self, playlist, title):
+        """
+        Queue the renaming of a Playlist (or of the playlist created by an
+        add_playlist operation of this batch)
+        """
+        return self._queue(BatchOperation(BatchOperation.RENAME, playlist,
+                                          title))
+
+    def delete_playlist(self, playlist):
+        """
+        Queue the deletion of a Playlist (or of the playlist created by an
+        add_playlist operation of this batch)
+        """
+        return self._queue(BatchOperation(BatchOperation.DELETE, playlist))
+
+    def _queue(self, operation):
+        """Add an operation to the queue"""
+        self.operations.append(operation)
+        return operation
+
+    def coalesce(self):
+        """Resolve redundant operations and return the ones to send"""
+        by_target = {}
+        order = []
+        for operation in self.operations:
+            if operation.status != BatchOperation.PENDING:
+                continue
+            if operation.action == BatchOperation.CREATE:
+                key = id(operation)
+            elif isinstance(operation.target, BatchOperation):
+                key = id(operation.target)
+            else:
+                key = operation.target.id
+            if key not in by_target:
+                by_target[key] = []
+                order.append(key)
+            by_target[key].append(operation)
+
+        pending = []
+        for key in order:
+            operation = self._coalesce_target(by_target[key])
+            if operation:
+                pending.append(operation)
+        return pending
+
+    def _coalesce_target(self, operations):
+        """Reduce the operations on a single playlist to at most one"""
+        effective = None
+        # set once a playlist created in the batch was deleted in it too
+        deleted = False
+        for operation in operations:
+            if deleted or \
+                    effective and effective.action == BatchOperation.DELETE:
+                operation.status = BatchOperation.FAILED
+                operation.error = RequestException(
+                    'Playlist deleted earlier in the batch')
+            elif effective is None:
+                effective = operation
+            elif operation.action == BatchOperation.RENAME:
+                if effective.action == BatchOperation.CREATE:
+                    effective.title = operation.title
+                    self._merge(operation, effective)
+                else:
+                    self._merge(effective, operation)
+                    effective = operation
+            elif effective.action == BatchOperation.CREATE:
+                # created and deleted: nothing to send
+                effective.status = BatchOperation.CANCELLED
+                operation.status = BatchOperation.CANCELLED
+                effective = None
+                deleted = True
+            else:
+                self._merge(effective, operation)
+                effective = operation
+        return effective
+
+    @staticmethod
+    def _merge(operation, into):
+        """Mark operation as superseded by another one"""
+        operation.status = BatchOperation.MERGED
+        operation.merged_into = into
+
+    def commit(self):
+        """Send the queued operations and return them, with their outcome"""
+        pending = self.coalesce()
+        creates = [operation for operation in pending
+                   if operation.action == BatchOperation.CREATE]
+        others = [operation for operation in pending
+                  if operation.action != BatchOperation.CREATE]
+        with WorkerPool(self.workers) as pool:
+            for operation in creates:
+                pool.submit(self._send, operation)
+        # renames and deletes may refer to playlists created above
+        with WorkerPool(self.workers) as pool:
+            for operation in others:
+                pool.submit(self._send, operation)
+
+        for operation in self.operations:
+            if operation.status == BatchOperation.MERGED:
+                final = operation.merged_into
+                while final.merged_into:
+                    final = final.merged_into
+                operation.result = final.result
+                operation.error = final.error
+        return self.operations
+
+    def _send(self, operation):
+        """Send a single operation"""
+        try:
+            target = operation.target
+            if isinstance(target, BatchOperation):
+                if target.error or target.result is None:
+                    raise RequestException('Playlist could not be created')
+                target = target.result
+            if operation.action == BatchOperation.CREATE:
+                if operation.songs:
+                    operation.result = self.client.add_playlist_with_songs(
+                        operation.title, operation.songs)
+                else:
+                    operation.result = self.client.add_playlist(
+                        operation.title)
+            elif operation.action == BatchOperation.RENAME:
+                operation.result = self.client.modify_playlist(
+                    target, operation.title)
+            else:
+                operation.result = self.client.delete_playlist(target)
+            operation.status = BatchOperation.DONE
+        except Exception, error:
+            operation.status = BatchOperation.FAILED
+            operation.error = error
+
+    @property
+    def succeeded(self):
+        """The operations that worked"""
+        return [operation for operation in self.operations
+                if operation.success]
+
+    @property
+    def failed(self):
+        """The operations that failed"""
+        return [operation for operation in self.operations
+                if not operation.success]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
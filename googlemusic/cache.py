@@ -0,0 +1,387 @@
+"""
+Caches
+
+Caches used to avoid repeating requests whose answer we already know.
+"""
+__author__ = "Tirino"
+
+import hashlib
+import os
+import threading
+import time
+import urllib2
+import urlparse
+from collections import OrderedDict
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.concurrency import Task
+from googlemusic.utils import write_file
+
+class LRUCache(object):
+    """Bounded, thread-safe mapping that evicts the least recently used keys"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the value of key, marking it as recently used"""
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the oldest entries if the cache is full"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove key and return its value"""
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def clear(self):
+        """Remove every entry"""
+        with self.lock:
+            self.entries.clear()
+
+    def keys(self):
+        """Return the keys, least recently used first"""
+        with self.lock:
+            return self.entries.keys()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_url_expiry(url):
+    """Return the expiry timestamp embedded in a signed URL, or None"""
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    try:
+        return float(query['expire'][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+class StreamUrlCache(object):
+    """
+    LRU cache of stream URLs, keyed by song id.
+    Entries live until the expiry signed in the URL, minus refresh_margin
+    seconds so callers never get a URL that's about to expire. Concurrent
+    lookups of the same missing song share a single request.
+    """
+    DEFAULT_MAX_SIZE = 1000
+    DEFAULT_REFRESH_MARGIN = 60
+    # used when the URL doesn't say when it expires
+    DEFAULT_TTL = 60
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 default_ttl=DEFAULT_TTL):
+        self.entries = LRUCache(max_size)
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def get(self, song_id, fetch):
+        """
+        Return the cached result for song_id, calling fetch(song_id) to get
+        it (once, no matter how many threads ask for it) when it's missing or
+        about to expire
+        """
+        now = time.time()
+        entry = self.entries.get(song_id)
+        with self.lock:
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            task = self.pending.get(song_id)
+            if task:
+                self.shared += 1
+                owner = False
+            else:
+                self.misses += 1
+                task = Task(fetch, (song_id,), {})
+                self.pending[song_id] = task
+                owner = True
+
+        if owner:
+            try:
+                task.run()
+                if not task.error:
+                    self.put(song_id, task.value)
+            finally:
+                with self.lock:
+                    del self.pending[song_id]
+        return task.result()
+
+    def peek(self, song_id):
+        """
+        Return the cached result for song_id, or None if it's missing or about
+        to expire (for callers that fetch it themselves, see put)
+        """
+        entry = self.entries.get(song_id)
+        with self.lock:
+            if entry and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, song_id, result):
+        """Cache the result fetched for song_id"""
+        self.entries.set(song_id, (self._refresh_at(result), result))
+
+    def invalidate(self, song_id):
+        """Forget the URL of a song (e.g. because the server rejected it)"""
+        self.entries.pop(song_id)
+
+    def clear(self):
+        """Forget every URL"""
+        self.entries.clear()
+
+    def stats(self):
+        """Return the cache counters, for monitoring"""
+        return {
+          'hits': self.hits, 'misses': self.misses, 'shared': self.shared,
+          'evictions': self.entries.evictions, 'size': len(self.entries)
+        }
+
+    def _refresh_at(self, result):
+        """Return the timestamp at which a result must be fetched again"""
+        expiry = get_url_expiry(result['url'])
+        if expiry is None:
+            return time.time() + self.default_ttl
+        return expiry - self.refresh_margin
+
+
+class MemoryBackend(object):
+    """Response cache storage that keeps up to max_size entries in memory"""
+    DEFAULT_MAX_SIZE = 200
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.entries = LRUCache(max_size)
+
+    def get(self, key):
+        """Return the entry stored under key, or None"""
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        """Store an entry"""
+        self.entries.set(key, entry)
+
+    def delete(self, key):
+        """Remove an entry"""
+        self.entries.pop(key)
+
+    def keys(self):
+        """Return the stored keys"""
+        return self.entries.keys()
+
+    @property
+    def evictions(self):
+        return self.entries.evictions
+
+
+class DiskBackend(object):
+    """
+    Response cache storage that keeps one file per entry in a folder, so
+    responses survive restarts. The least recently used files are removed
+    once they take more than max_bytes.
+    """
+    DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+    EXTENSION = '.json'
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.evictions = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # key -> size, least recently used first
+        self.sizes = OrderedDict()
+        files = []
+        for name in os.listdir(path):
+            if name.endswith(self.EXTENSION):
+                stat = os.stat(os.path.join(path, name))
+                files.append((stat.st_mtime, name[:-len(self.EXTENSION)],
+                              stat.st_size))
+        for mtime, key, size in sorted(files):
+            self.sizes[key] = size
+        self.total = sum(self.sizes.itervalues())
+
+    def _filename(self, key):
+        """Return the file of an entry"""
+        return os.path.join(self.path, key + self.EXTENSION)
+
+    def get(self, key):
+        """Return the entry stored under key, or None"""
+        with self.lock:
+            if key not in self.sizes:
+                return None
+            self.sizes[key] = self.sizes.pop(key)
+            filename = self._filename(key)
+            try:
+                with open(filename, 'rb') as entry_file:
+                    entry = json.loads(entry_file.read())
+                # the modification time keeps the LRU order across restarts
+                os.utime(filename, None)
+                return entry
+            except (IOError, OSError, ValueError):
+                self._delete(key)
+                return None
+
+    def set(self, key, entry):
+        """Store an entry, removing the oldest ones if over max_bytes"""
+        data = json.dumps(entry)
+        with self.lock:
+            filename = self._filename(key)
+            write_file(filename, data)
+            self.total -= self.sizes.pop(key, 0)
+            self.sizes[key] = len(data)
+            self.total += len(data)
+            while self.total > self.max_bytes and len(self.sizes) > 1:
+                self._delete(next(iter(self.sizes)))
+                self.evictions += 1
+
+    def delete(self, key):
+        """Remove an entry"""
+        with self.lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        """Remove an entry (with the lock held)"""
+        self.total -= self.sizes.pop(key, 0)
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def keys(self):
+        """Return the stored keys"""
+        with self.lock:
+            return self.sizes.keys()
+
+
+class ResponseCache(object):
+    """
+    Cache of read-only API responses, stored in a MemoryBackend or a
+    DiskBackend.
+    Each cacheable method has its own time to live. Expired responses that
+    came with an ETag or a Last-Modified header are revalidated with a
+    conditional request and reused if the server answers 304. Mutations
+    invalidate the responses they affect.
+    """
+    # seconds a response of each (read-only) method is fresh
+    DEFAULT_TTLS = {
+      'loadsettings': 300,
+      'loadplaylist': 60,
+      'search': 60,
+    }
+    # methods whose responses each mutation makes stale
+    INVALIDATES = {
+      'addplaylist': ('loadplaylist',),
+      'modifyplaylist': ('loadplaylist',),
+      'deleteplaylist': ('loadplaylist',),
+      'modifylabs': ('loadsettings',),
+    }
+
+    def __init__(self, backend=None, ttls=None):
+        self.backend = backend or MemoryBackend()
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def make_key(method, payload, namespace=None):
+        """
+        Return the key of a call. It starts with the method so its entries
+        can be found without reading them
+        """
+        data = json.dumps([namespace, payload], sort_keys=True)
+        return '%s-%s' % (method, hashlib.sha1(data).hexdigest())
+
+    def call(self, method, payload, send, namespace=None):
+        """
+        Return the result of an API call, from the cache if possible.
+        send(headers) makes the actual request with the given extra headers
+        and returns its result and the response headers.
+        """
+        ttl = self.ttls.get(method)
+        if not ttl:
+            try:
+                return send({})[0]
+            finally:
+                # even failed mutations may have changed something (other
+                # uncached methods must not reach invalidate(), which would
+                # forget everything)
+                if method in self.INVALIDATES:
+                    self.invalidate(*self.INVALIDATES[method])
+
+        key = self.make_key(method, payload, namespace)
+        entry = self.backend.get(key)
+        now = time.time()
+        if entry and entry['expires'] > now:
+            self.hits += 1
+            return json.loads(entry['value'])
+
+        conditional = {}
+        if entry and entry.get('etag'):
+            conditional['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            conditional['If-Modified-Since'] = entry['last_modified']
+        try:
+            result, headers = send(conditional)
+        except urllib2.HTTPError, error:
+            if error.code != 304 or not conditional:
+                raise
+            error.close()
+            self.revalidated += 1
+            entry['expires'] = now + ttl
+            self.backend.set(key, entry)
+            return json.loads(entry['value'])
+
+        self.misses += 1
+        self.backend.set(key, {
+          'expires': now + ttl,
+          'etag': headers.getheader('ETag'),
+          'last_modified': headers.getheader('Last-Modified'),
+          'value': json.dumps(result)
+        })
+        return result
+
+    def invalidate(self, *methods):
+        """Forget the responses of the given methods (all if none given)"""
+        prefixes = tuple('%s-' % method for method in methods)
+        for key in self.backend.keys():
+            if not methods or key.startswith(prefixes):
+                self.backend.delete(key)
+                self.invalidated += 1
+
+    def stats(self):
+        """Return the cache counters, for monitoring"""
+        return {
+          'hits': self.hits, 'misses': self.misses,
+          'revalidated': self.revalidated, 'invalidated': self.invalidated,
+          'evictions': self.backend.evictions,
+          'size': len(self.backend.keys())
+        }
@@ -5,18 +5,42 @@ A simple Client to interact with Google Music
 """
 __author__ = "Tirino"
 
-from googlemusic.model import Album, Song, Playlist
+import os
+import tempfile
+
+from googlemusic.artwork import ArtworkCache, ArtworkFetcher
+from googlemusic.batch import PlaylistBatch
+from googlemusic.cache import DiskBackend, MemoryBackend, ResponseCache
+from googlemusic.concurrency import WorkerPool, as_completed
+from googlemusic.connection import ConnectionPool
+from googlemusic.download import BulkDownloader, song_filename
+from googlemusic.metrics import Metrics
+from googlemusic.model import Album, Playlist, SongRegistry
 from googlemusic.protocol import Protocol
 from googlemusic.request import CookieManager, WebRequest
+from googlemusic.search import SearchIndex
+from googlemusic.store import LibraryStore
+from googlemusic.stream import SongQueue, SongStreamer
 
 class Client(object):
-    """Client API class"""
-    def __init__(self):
+    """
+    Client API class.
+    Clients can share a ConnectionPool (keep-alive connections carry no
+    session state), e.g. when many accounts are used at once.
+    """
+    def __init__(self, pool=None):
         self.debug = False
         self.cookies =  CookieManager()
-        self.web = WebRequest(self.cookies)
+        self.pool = pool or ConnectionPool()
+        self.web = WebRequest(self.cookies, self.pool)
         self.protocol = Protocol(self.web)
         self.playlists = []
+        self.store = None
+        self.index = None
+        # every Song object the client hands out, by id
+        self.songs = SongRegistry()
+        self.artwork = None
+        self.streamer = None
     
     def set_debug(self, debug):
         """Enable debug mode"""
@@ -24,29 +48,211 @@ class Client(object):
         self.web.debug = self.debug
         self.protocol.debug = self.debug
     
-    def login(self, username, password):
-        """Log the user in"""
+    def login(self, username, password, session_file=None):
+        """
+        Log the user in.
+        If session_file is given, the session saved there (if any, and for
+        the same user) is reused without contacting the server, and new
+        sessions are saved to it. Sessions the server rejects are renewed
+        automatically on the next request.
+        """
+        if session_file and \
+                self.protocol.load_session(session_file, username):
+            self.protocol.credentials = (username, password)
+            return True
+        self.protocol.session_file = session_file
         return self.protocol.login(username, password)
+
+    def resume_session(self, session_file):
+        """
+        Reuse a session saved by login() without knowing the password.
+        Return False if there's no saved session
+        """
+        return self.protocol.load_session(session_file)
     
+    # Local store #
+    def open_store(self, path=':memory:'):
+        """
+        Keep a local snapshot of the library in the given SQLite file.
+        Once synced, playlists are read from it instead of the server.
+        """
+        self.store = LibraryStore(path)
+        return self.store
+
+    def sync(self):
+        """
+        Update the local snapshot with the server's playlists and return a
+        SyncResult with what changed (an in-memory store is used if none was
+        opened)
+        """
+        if self.store is None:
+            self.open_store()
+        result = self.store.apply(self.protocol.get_all_playlists())
+        if self.index:
+            self.index.remove_songs(result.removed_songs)
+            self.index.add_songs(
+                self.songs.song(self.store.get_song(song_id))
+                for song_id in result.added_songs + result.changed_songs)
+        return result
+
+    # Metrics #
+    def enable_metrics(self, hooks=None):
+        """
+        Start measuring requests and return the Metrics object: see its
+        snapshot() method for per-request counters, latency percentiles,
+        bytes, retries and errors. hooks are called with every finished
+        request
+        """
+        if self.web.metrics is None:
+            metrics = Metrics()
+            self.web.metrics = metrics
+            self.protocol.metrics = metrics
+        for hook in hooks or []:
+            self.web.metrics.add_hook(hook)
+        return self.web.metrics
+
+    def disable_metrics(self):
+        """Stop measuring requests"""
+        self.web.metrics = None
+        self.protocol.metrics = None
+
+    # Request policy #
+    def set_policy(self, policy):
+        """
+        Rate limit, retry and/or break the circuit of API and stream URL
+        requests following a googlemusic.policy.RequestPolicy (None to make
+        requests as they come, raising every error)
+        """
+        self.protocol.policy = policy
+
+    # Transfers #
+    def set_compression(self, responses=True, request_min_size=None):
+        """
+        Choose whether to ask for gzip/deflate compressed responses (the
+        default) and, if request_min_size is given, gzip the request bodies
+        of at least that many bytes
+        """
+        self.web.compression.accept = responses
+        self.web.compression.min_request_size = request_min_size
+
+    def set_json_codec(self, codec):
+        """
+        Decode responses with the given codec (see googlemusic.codec), e.g.
+        get_codec('ujson')
+        """
+        self.web.codec = codec
+
+    # Response cache #
+    def enable_response_cache(self, path=None, max_size=None, ttls=None):
+        """
+        Cache the responses of read-only API calls (settings, playlists and
+        searches) until their TTL (see ResponseCache.DEFAULT_TTLS, or pass
+        ttls={method: seconds}) expires. Responses are kept in memory (up to
+        max_size entries) or, if a path is given, in files in that folder (up
+        to max_size bytes). Playlist changes made through the client
+        invalidate the cached playlists.
+        """
+        if path:
+            backend = DiskBackend(path,
+                                  max_size or DiskBackend.DEFAULT_MAX_BYTES)
+        else:
+            backend = MemoryBackend(max_size or MemoryBackend.DEFAULT_MAX_SIZE)
+        self.protocol.response_cache = ResponseCache(backend, ttls)
+        return self.protocol.response_cache
+
+    # Local search #
+    def enable_local_search(self):
+        """
+        Start indexing the songs the client loads, so search(local=True) can
+        answer without going to the server. Songs already in a synced local
+        store are indexed right away.
+        """
+        if self.index is None:
+            self.index = SearchIndex()
+            if self.store and self.store.last_sync():
+                self.index.add_songs(self.songs.song(song_data)
+                                     for song_data in self.store.get_songs())
+        return self.index
+
+    def _index_playlists(self, playlists):
+        """Add the songs of the given playlists to the local index"""
+        if self.index:
+            for playlist in playlists:
+                self.index.add_songs(playlist.songs)
+
     # Playlists #
-    def get_all_playlists(self):
-        """Return a list of Playlist objects with embedded Song objects"""
+    def get_all_playlists(self, refresh=False, lazy=False):
+        """
+        Return a list of Playlist objects with embedded Song objects.
+        If the local store was synced they are read from it; use refresh=True
+        to sync it first.
+        With lazy=True the Song objects of each playlist are only built when
+        its songs are accessed.
+        """
+        if self.store and self.store.last_sync():
+            if refresh:
+                self.sync()
+            return [Playlist(playlist_data, lazy, self.songs)
+                    for playlist_data in self.store.get_playlists()]
         result = []
         playlists_data = self.protocol.get_all_playlists()
         for playlist_data in playlists_data:
-            result.append(Playlist(playlist_data))
+            result.append(Playlist(playlist_data, lazy, self.songs))
+        self._index_playlists(result)
         return result
     
+    def iter_all_playlists(self, lazy=False):
+        """
+        Yield the Playlist objects, with their Song objects, as they're
+        received and parsed, so memory use doesn't grow with the size of the
+        library
+        """
+        for playlist_data in self.protocol.iter_all_playlists():
+            playlist = Playlist(playlist_data, lazy, self.songs)
+            self._index_playlists([playlist])
+            yield playlist
+    
     def load_playlist(self, playlist):
         """Given a Playlist object populate it with its Song objects"""
         songs_data = self.protocol.load_playlist(playlist.id)
         for song_data in songs_data:
-            playlist.songs.append(Song(song_data))
+            playlist.songs.append(self.songs.song(song_data))
+        self._index_playlists([playlist])
+        return playlist
+
+    def load_playlists(self, playlists, workers=4, ordered=True):
+        """
+        Load (or reload) the songs of many Playlist objects, up to workers
+        at a time. Return them in the same order or, with ordered=False,
+        return an iterator that yields them as they're loaded.
+        """
+        playlists = list(playlists)
+        if not playlists:
+            return [] if ordered else iter([])
+        workers = max(1, min(workers, len(playlists)))
+        self.pool.max_size = max(self.pool.max_size, workers)
+        pool = WorkerPool(workers)
+        tasks = [pool.submit(self._load_playlist_songs, playlist)
+                 for playlist in playlists]
+        # the workers stop once they're done
+        pool.shutdown(wait=False)
+        if ordered:
+            return [task.result() for task in tasks]
+        return (task.result() for task in as_completed(tasks))
+
+    def _load_playlist_songs(self, playlist):
+        """Replace the songs of a playlist with the server's"""
+        playlist.songs = [self.songs.song(song_data) for song_data in
+                          self.protocol.load_playlist(playlist.id)]
+        self._index_playlists([playlist])
         return playlist
     
     def add_playlist(self, title):
         """Create a playlist"""
-        return Playlist(self.protocol.add_playlist(title))
+        playlist = Playlist(self.protocol.add_playlist(title))
+        if self.store:
+            self.store.add_playlist(playlist.id, playlist.title)
+        return playlist
 
     def add_playlist_with_songs(self, title, songs=None):
         """Create a Playlist and add the given songs to it"""
@@ -54,15 +260,71 @@ class Client(object):
             song_ids = [song.id for song in songs]
         else:
             song_ids = []
-        return Playlist(self.protocol.add_playlist_with_songs(title, song_ids))
+        playlist = Playlist(self.protocol.add_playlist_with_songs(title,
+                                                                  song_ids))
+        if self.store:
+            self.store.add_playlist(playlist.id, playlist.title,
+                                    [song.data() for song in songs or []])
+        return playlist
 
     def modify_playlist(self, playlist, title):
         """Rename a Playlist"""
-        return self.protocol.modify_playlist(playlist.id, title)
+        result = self.protocol.modify_playlist(playlist.id, title)
+        if self.store:
+            self.store.rename_playlist(playlist.id, title)
+        return result
 
     def delete_playlist(self, playlist):
         """Delete a Playlist object from the user's library"""
-        return self.protocol.delete_playlist(playlist.id)
+        result = self.protocol.delete_playlist(playlist.id)
+        if self.store:
+            self.store.delete_playlist(playlist.id)
+        return result
+
+    def batch(self, workers=4):
+        """
+        Return a PlaylistBatch to queue playlist creations, renames and
+        deletions and send them together, in parallel:
+
+            with client.batch() as batch:
+                batch.add_playlist('New playlist')
+                batch.delete_playlist(playlist)
+        """
+        return PlaylistBatch(self, workers)
+
+    # Artwork #
+    def open_artwork_cache(self, path, max_bytes=None, workers=8):
+        """
+        Keep the artwork fetched by fetch_artwork in the given folder, up to
+        max_bytes (the least recently used images are removed first)
+        """
+        if self.artwork:
+            self.artwork.close()
+        cache = ArtworkCache(path, max_bytes or ArtworkCache.DEFAULT_MAX_BYTES)
+        self.artwork = ArtworkFetcher(self.web, cache, workers)
+        return self.artwork
+
+    def fetch_artwork(self, items, size=None):
+        """
+        Return the local image files of the artwork of the given Songs or
+        Albums, in the same order (None where there's no artwork), fetching
+        the missing ones in parallel. Images are `size` pixels if given.
+        Without open_artwork_cache, they're cached in the temporary folder.
+        """
+        if self.artwork is None:
+            self.open_artwork_cache(os.path.join(tempfile.gettempdir(),
+                                                 'googlemusic-artwork'))
+        return self.artwork.fetch(items, size)
+
+    def prefetch_artwork(self, playlist, position=0, count=20, size=None):
+        """
+        Start fetching, in the background, the artwork of the count songs of
+        a playlist that come after position (e.g. the song being played)
+        """
+        if self.artwork is None:
+            self.fetch_artwork([])
+        songs = playlist.songs[position + 1:position + 1 + count]
+        return self.artwork.prefetch(songs, size)
 
     def get_stream_url(self, song):
         """Obtain the stream/download URL for a specific song"""
@@ -73,24 +335,82 @@ class Client(object):
         """Return a dict with the user Google Music's Settings"""
         return self.protocol.get_settings()
 
-    def search(self, query):
-        """Return a dict with Albums and Songs that match the given query"""
+    def get_song(self, song_id):
+        """
+        Return the Song object with the given id if the client has it (e.g.
+        in a loaded playlist or search result), or None
+        """
+        return self.songs.get(song_id)
+
+    def search(self, query, local=False, limit=50):
+        """
+        Return a dict with Albums and Songs that match the given query.
+        With local=True the search is answered by the local index (see
+        enable_local_search), matching word prefixes and typos, and ranked.
+        """
         # TODO: add Artists as well
+        if local:
+            return self.enable_local_search().search(query, limit)
+        return self._search_result(self.protocol.search(query))
+
+    def _search_result(self, result_data):
+        """Turn the results of a search into Albums and Songs"""
         result = {'Albums': [], 'Songs': []}
-        result_data = self.protocol.search(query)
         for album_data in result_data['albums']:
             result['Albums'].append(Album(album_data))
         for song_data in result_data['songs']:
-            result['Songs'].append(Song(song_data))
+            result['Songs'].append(self.songs.song(song_data))
+        if self.index:
+            self.index.add_songs(result['Songs'])
         return result
 
+    # Streaming #
+    def open_song(self, song, buffer_size=None):
+        """
+        Return a seekable, file-like SongStream of the mp3 file of the given
+        Song, which reads ahead in the background (keeping up to buffer_size
+        bytes), so it can be played before it's fully downloaded
+        """
+        return self._get_streamer().open(song, buffer_size)
+
+    def queue_songs(self, songs, ahead=2):
+        """
+        Return a SongQueue of the given Songs: each call to its next() opens
+        the next song, while the stream URLs and first bytes of the `ahead`
+        songs after it are prefetched
+        """
+        return SongQueue(self._get_streamer(), songs, ahead)
+
+    def _get_streamer(self):
+        """Return the SongStreamer, creating it on first use"""
+        if self.streamer is None:
+            self.streamer = SongStreamer(self.protocol, self.web)
+        return self.streamer
+
     def download_song(self, song, to_folder='.'):
         """
         Download the mp3 file of the given Song object
         If you don't provide a to_folder argument, the file will be downloaded
         to the current folder.
+        An interrupted download is resumed next time the song is downloaded.
         """
         url_data = self.protocol.get_stream_url(song.id)
-        filename = '%s/%s - %s.mp3' % (to_folder, song.artist, song.title)
-        return self.web.download_file(url_data['url'], filename)
+        filename = song_filename(song, to_folder)
+        resolve_url = lambda: self.protocol.get_stream_url(
+            song.id, refresh=True)['url']
+        return self.web.download_file(url_data['url'], filename,
+                                      resolve_url=resolve_url)
+
+    def download_songs(self, songs, to_folder='.', workers=4, per_host=4,
+                       progress=None):
+        """
+        Download the mp3 files of the given Song objects in parallel.
+        Return a DownloadReport with a DownloadResult for every song; a song
+        that fails doesn't abort the others.
+        If given, progress(report) is called (from the worker threads) as the
+        downloads advance.
+        """
+        downloader = BulkDownloader(self.protocol, self.web, workers,
+                                    per_host, progress)
+        return downloader.download(songs, to_folder)
 
@@ -0,0 +1,254 @@
+"""
+Google Music client pool
+
+Run operations for many accounts at once, on shared keep-alive connections
+and worker threads, logging accounts in only when they're used.
+"""
+__author__ = "Tirino"
+
+import os
+import re
+import threading
+import time
+from collections import deque, OrderedDict
+
+from googlemusic.client import Client
+from googlemusic.concurrency import Task, WorkerPool
+from googlemusic.connection import ConnectionPool
+from googlemusic.policy import TokenBucket
+
+def session_filename(username):
+    """Return a file name, safe on any platform, for an account's session"""
+    return re.sub(r'[^\w.@-]', '_', username) + '.session'
+
+
+class PooledAccount(object):
+    """An account of a ClientPool and its Client, when logged in"""
+    def __init__(self, username, password, session_file=None, rate=None,
+                 burst=None):
+        self.username = username
+        self.password = password
+        self.session_file = session_file
+        self.limiter = rate and TokenBucket(rate, burst)
+        self.client = None
+        # session of the last evicted Client, to restore it without logging in
+        self.session = None
+        self.login_lock = threading.Lock()
+        # tasks waiting for a worker
+        self.pending = deque()
+        # tasks running right now
+        self.active = 0
+        self.last_used = time.time()
+
+
+class ClientPool(object):
+    """
+    Many authenticated accounts sharing one ConnectionPool and one
+    WorkerPool:
+
+        with ClientPool(workers=32, max_clients=100) as pool:
+            pool.add_account('a@gmail.com', 'p4ssw0rd', rate=5)
+            task = pool.submit('a@gmail.com', Client.get_all_playlists)
+
+    Submitted functions are called with the account's Client as their first
+    argument. Workers take tasks from the accounts in turns, so an account
+    with a long queue doesn't delay the others, and an account with a rate
+    (tasks per second) never goes over it.
+    Accounts log in on their first task (reusing the session saved in
+    session_dir, if given). Clients unused for idle_timeout seconds, or the
+    least recently used ones when there are more than max_clients, are
+    dropped, keeping only their session to restore them without logging in
+    when needed again. Sockets depend on the workers, and memory on the
+    clients in use, not on the accounts added.
+    """
+    DEFAULT_WORKERS = 16
+    DEFAULT_IDLE_TIMEOUT = 300
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_clients=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, session_dir=None,
+                 connections=None):
+        self.connections = connections or ConnectionPool(
+            max(workers, ConnectionPool.DEFAULT_MAX_SIZE))
+        self.workers = WorkerPool(workers)
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.session_dir = session_dir
+        if session_dir and not os.path.isdir(session_dir):
+            os.makedirs(session_dir)
+        self.lock = threading.Lock()
+        self.accounts = {}
+        # accounts with a Client, least recently used first
+        self.live = OrderedDict()
+        # accounts with pending tasks, in turn order
+        self.ready = deque()
+        self.logins = 0
+        self.restores = 0
+        self.evictions = 0
+        self.last_eviction = time.time()
+
+    # Accounts #
+    def add_account(self, username, password, rate=None, burst=None):
+        """Add an account (it won't log in until it's used)"""
+        session_file = None
+        if self.session_dir:
+            session_file = os.path.join(self.session_dir,
+                                        session_filename(username))
+        account = PooledAccount(username, password, session_file, rate, burst)
+        with self.lock:
+            self.accounts[username] = account
+        return account
+
+    def remove_account(self, username):
+        """Remove an account. Its pending tasks are cancelled"""
+        with self.lock:
+            account = self.accounts.pop(username)
+            if account in self.ready:
+                self.ready.remove(account)
+            pending, account.pending = list(account.pending), deque()
+            account.client = None
+            self.live.pop(username, None)
+        for task in pending:
+            task.func = self._cancelled
+            task.run()
+
+    @staticmethod
+    def _cancelled(*args):
+        """Stand-in for the tasks of removed accounts"""
+        raise KeyError('Account removed from the pool')
+
+    def client(self, username):
+        """Return the logged in Client of an account, logging it in if needed"""
+        account = self.accounts[username]
+        with account.login_lock:
+            client = account.client
+            if client is None:
+                self._make_room()
+                client = Client(self.connections)
+                if client.protocol.restore_session(account.session):
+                    client.protocol.credentials = (account.username,
+                                                   account.password)
+                    client.protocol.session_file = account.session_file
+                    with self.lock:
+                        self.restores += 1
+                else:
+                    client.login(account.username, account.password,
+                                 account.session_file)
+                    with self.lock:
+                        self.logins += 1
+                account.client = client
+        with self.lock:
+            if username in self.accounts:
+                self.live.pop(username, None)
+                self.live[username] = account
+        account.last_used = time.time()
+        return client
+
+    # Tasks #
+    def submit(self, username, func, *args, **kwargs):
+        """
+        Schedule func(client, *args, **kwargs) with the account's Client and
+        return its Task
+        """
+        account = self.accounts[username]
+        task = Task(self._execute, (account, func, args, kwargs), {})
+        with self.lock:
+            if not account.pending:
+                self.ready.append(account)
+            account.pending.append(task)
+        # every worker run takes the next task in turn, not necessarily this
+        self.workers.submit(self._run_next)
+        if time.time() - self.last_eviction > min(self.idle_timeout, 30):
+            self.evict_idle()
+        return task
+
+    def _run_next(self):
+        """Run the next task of the first account whose rate allows it"""
+        while True:
+            wait = None
+            with self.lock:
+                for _ in xrange(len(self.ready)):
+                    account = self.ready.popleft()
+                    delay = account.limiter and account.limiter.try_acquire()
+                    if not delay:
+                        task = account.pending.popleft()
+                        if account.pending:
+                            self.ready.append(account)
+                        account.active += 1
+                        break
+                    self.ready.append(account)
+                    wait = delay if wait is None else min(wait, delay)
+                else:
+                    task = None
+            if task:
+                task.run()
+                return
+            if wait is None:
+                # the tasks were cancelled
+                return
+            time.sleep(wait)
+
+    def _execute(self, account, func, args, kwargs):
+        """Run a task with the account's Client"""
+        try:
+            return func(self.client(account.username), *args, **kwargs)
+        finally:
+            with self.lock:
+                account.active -= 1
+            account.last_used = time.time()
+
+    # Eviction #
+    def _make_room(self):
+        """Drop the least recently used idle Client if there are too many"""
+        if not self.max_clients:
+            return
+        with self.lock:
+            if len(self.live) < self.max_clients:
+                return
+            for account in self.live.itervalues():
+                if not account.active:
+                    self._evict(account)
+                    return
+
+    def evict_idle(self):
+        """Drop the Clients that weren't used for idle_timeout seconds"""
+        now = time.time()
+        with self.lock:
+            self.last_eviction = now
+            for account in self.live.values():
+                if now - account.last_used <= self.idle_timeout:
+                    break
+                if not account.active:
+                    self._evict(account)
+
+    def _evict(self, account):
+        """Drop an account's Client (with the lock held)"""
+        account.session = account.client.protocol.session_data()
+        account.client = None
+        del self.live[account.username]
+        self.evictions += 1
+
+    # General #
+    def stats(self):
+        """Return the pool counters, for monitoring"""
+        with self.lock:
+            return {
+              'accounts': len(self.accounts),
+              'clients': len(self.live),
+              'pending': sum(len(account.pending)
+                             for account in self.accounts.itervalues()),
+              'logins': self.logins, 'restores': self.restores,
+              'evictions': self.evictions,
+              'connections_created': self.connections.created,
+              'connections_reused': self.connections.reused
+            }
+
+    def close(self):
+        """Wait for the pending tasks, stop the workers and close connections"""
+        self.workers.shutdown()
+        self.connections.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,63 @@
+"""
+JSON codecs
+
+WebRequest decodes responses through a codec, so a faster JSON library can
+be plugged in. Codecs decode straight from the (utf-8) bytes of the body,
+without decoding it to a unicode string first.
+"""
+__author__ = "Tirino"
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+class JSONCodec(object):
+    """
+    Codec using simplejson if it's installed, or the standard json module.
+    Subclass it and override loads/dumps to plug in another library.
+    """
+    name = json.__name__
+
+    def loads(self, data):
+        """Decode a JSON document from utf-8 bytes (or a unicode string)"""
+        return json.loads(data)
+
+    def dumps(self, value):
+        """Encode a value as a JSON string"""
+        return json.dumps(value)
+
+
+class UltraJSONCodec(JSONCodec):
+    """Codec using ujson (https://pypi.python.org/pypi/ujson), if installed"""
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError('ujson is not installed')
+
+    def loads(self, data):
+        """Decode a JSON document from utf-8 bytes (or a unicode string)"""
+        return ujson.loads(data)
+
+    def dumps(self, value):
+        """Encode a value as a JSON string"""
+        return ujson.dumps(value)
+
+
+CODECS = {'json': JSONCodec, 'ujson': UltraJSONCodec}
+
+def get_codec(name=None):
+    """
+    Return an instance of the codec with the given name, or of the fastest
+    one installed if no name is given
+    """
+    if name:
+        return CODECS[name]()
+    if ujson is not None:
+        return UltraJSONCodec()
+    return JSONCodec()
@@ -0,0 +1,156 @@
+"""
+Compressed transfers
+
+A urllib2 handler that asks for gzip/deflate responses and decodes them
+while they're read, and can gzip big request bodies.
+"""
+__author__ = "Tirino"
+
+import urllib
+import urllib2
+import zlib
+
+# zlib window bits for gzip and for raw deflate streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+RAW_DEFLATE_WBITS = -zlib.MAX_WBITS
+# Content-Encodings that are decoded
+DECODED_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+def gzip_data(data, level=6):
+    """Return data compressed in the gzip format"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class StreamDecoder(object):
+    """Incremental decoder of a gzip or deflate body"""
+    def __init__(self, encoding):
+        self.deflate = encoding == 'deflate'
+        self.decompressor = zlib.decompressobj(
+            zlib.MAX_WBITS if self.deflate else GZIP_WBITS)
+        self.started = False
+
+    def decode(self, data):
+        """Return the decoded bytes of the next piece of the body"""
+        try:
+            decoded = self.decompressor.decompress(data)
+        except zlib.error:
+            if not self.deflate or self.started:
+                raise
+            # some servers send deflate streams without the zlib header
+            self.decompressor = zlib.decompressobj(RAW_DEFLATE_WBITS)
+            decoded = self.decompressor.decompress(data)
+        self.started = True
+        return decoded
+
+    def flush(self):
+        """Return what's left once the whole body was decoded"""
+        return self.decompressor.flush()
+
+
+class DecodedResponseFile(object):
+    """
+    File-like wrapper that decompresses a gzip or deflate response body as
+    it's read. wire_bytes counts the compressed bytes received.
+    """
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self.decoder = StreamDecoder(encoding)
+        self.eof = False
+        self.buffer = ''
+        self.wire_bytes = 0
+
+    def _next(self):
+        """Read and decompress the next chunk of the body"""
+        data = self.fp.read(self.READ_SIZE)
+        if not data:
+            self.eof = True
+            return self.decoder.flush()
+        self.wire_bytes += len(data)
+        return self.decoder.decode(data)
+
+    def read(self, amt=None):
+        """Read up to amt decoded bytes (or everything, if amt is None)"""
+        if amt is None:
+            parts = [self.buffer]
+            while not self.eof:
+                parts.append(self._next())
+            self.buffer = ''
+            return ''.join(parts)
+        while len(self.buffer) < amt and not self.eof:
+            self.buffer += self._next()
+        data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def readline(self, limit=-1):
+        """Read a single line"""
+        while '\n' not in self.buffer and not self.eof:
+            if limit >= 0 and len(self.buffer) >= limit:
+                break
+            self.buffer += self._next()
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        """Read all the remaining lines"""
+        return self.read().splitlines(True)
+
+    def close(self):
+        """Close the underlying response"""
+        self.fp.close()
+
+
+class CompressionHandler(urllib2.BaseHandler):
+    """
+    urllib2 handler for compressed transfers:
+    - if accept is True, asks for gzip or deflate responses (except for
+      range requests) and decodes them transparently
+    - if min_request_size is set, request bodies of at least that many
+      bytes are sent gzipped (not every server accepts them)
+    """
+    ACCEPT_ENCODING = 'gzip, deflate'
+    DEFAULT_MIN_REQUEST_SIZE = 1024
+    # before AbstractHTTPHandler sets the Content-Length
+    handler_order = 490
+
+    def __init__(self, accept=True, min_request_size=None):
+        self.accept = accept
+        self.min_request_size = min_request_size
+
+    def http_request(self, request):
+        """Add the Accept-Encoding header and compress the body if needed"""
+        if self.accept and not request.has_header('Accept-encoding') and \
+                not request.has_header('Range'):
+            request.add_unredirected_header('Accept-encoding',
+                                            self.ACCEPT_ENCODING)
+        data = request.get_data()
+        if self.min_request_size is not None and data and \
+                len(data) >= self.min_request_size and \
+                not request.has_header('Content-encoding'):
+            request.add_data(gzip_data(data))
+            request.add_unredirected_header('Content-encoding', 'gzip')
+        return request
+
+    def http_response(self, request, response):
+        """Decode gzip and deflate responses"""
+        headers = response.info()
+        encoding = (headers.getheader('Content-Encoding') or '').lower()
+        if encoding not in DECODED_ENCODINGS:
+            return response
+        # the lengths and encoding no longer apply to the decoded body
+        for name in ('content-encoding', 'content-length'):
+            if name in headers:
+                del headers[name]
+        decoded = urllib.addinfourl(DecodedResponseFile(response.fp, encoding),
+                                    headers, response.geturl())
+        decoded.code = response.code
+        decoded.msg = response.msg
+        return decoded
+
+    https_request = http_request
+    https_response = http_response
@@ -0,0 +1,207 @@
+"""
+Concurrency helpers
+
+A small thread based worker pool (Python 2 has no concurrent.futures) and a
+per-host concurrency limiter.
+"""
+__author__ = "Tirino"
+
+import Queue
+import sys
+import threading
+import urlparse
+from collections import deque
+from contextlib import contextmanager
+
+class Task(object):
+    """
+    A function call submitted to a WorkerPool, or an operation finished with
+    set_result/set_error (e.g. by googlemusic.eventloop), and its eventual
+    result
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.callbacks = []
+
+    @classmethod
+    def from_value(cls, value):
+        """Return an already finished Task with the given result"""
+        task = cls(None, (), {})
+        task.value = value
+        task.finished.set()
+        return task
+
+    def run(self):
+        """Run the function and store its result or error"""
+        try:
+            value = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.set_error(sys.exc_info())
+        else:
+            self.set_result(value)
+
+    def set_result(self, value):
+        """Finish the task with the given result"""
+        self.value = value
+        self._finish()
+
+    def set_error(self, exc_info):
+        """Finish the task with the given error (a sys.exc_info() tuple)"""
+        self.error = exc_info
+        self._finish()
+
+    def _finish(self):
+        """Mark the task as finished and call the done callbacks"""
+        with self.lock:
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        """Return True if the task already finished"""
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the task finishes. Return False on timeout"""
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """Return the task's result, raising its exception if it failed"""
+        if not self.wait(timeout):
+            raise RuntimeError('Task did not finish in %s seconds' % timeout)
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    def exception(self, timeout=None):
+        """Return the exception raised by the task, if any"""
+        if not self.wait(timeout):
+            raise RuntimeError('Task did not finish in %s seconds' % timeout)
+        if self.error:
+            return self.error[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Call callback(task) once the task finishes"""
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+
+class WorkerPool(object):
+    """
+    Fixed-size pool of daemon threads running submitted tasks.
+    Threads are started lazily, on the first submit().
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = max(1, workers)
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs) and return its Task"""
+        task = Task(func, args, kwargs)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('The worker pool was shut down')
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(task)
+        return task
+
+    def map(self, func, items):
+        """Run func over every item and return the list of results, in order"""
+        tasks = [self.submit(func, item) for item in items]
+        return [task.result() for task in tasks]
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the pending tasks are done"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            threads = list(self.threads)
+        for _ in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        """Worker thread loop"""
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            task.run()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def as_completed(tasks):
+    """Yield the given tasks as they finish"""
+    finished = Queue.Queue()
+    tasks = list(tasks)
+    for task in tasks:
+        task.add_done_callback(finished.put)
+    for _ in tasks:
+        yield finished.get()
+
+
+def bounded_map(pool, func, items, window):
+    """
+    Yield func(item) for every item, in order, running the calls on a
+    WorkerPool but submitting at most window of them ahead, so results don't
+    pile up in memory when they're consumed slower than they're produced
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class HostLimiter(object):
+    """Limit how many operations run at the same time against each host"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    @contextmanager
+    def hold(self, url):
+        """Context manager that holds one of the URL's host slots"""
+        if not self.limit:
+            yield
+            return
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.Semaphore(self.limit)
+                self.semaphores[host] = semaphore
+        with semaphore:
+            yield
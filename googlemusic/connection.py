@@ -0,0 +1,300 @@
+"""
+Persistent HTTP connections
+
+urllib2 handlers that keep connections alive and reuse them between requests,
+so talking to the same host repeatedly doesn't pay a new TCP/TLS handshake
+every time.
+"""
+__author__ = "Tirino"
+
+import httplib
+import select
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+from googlemusic.compression import CompressionHandler
+
+def is_alive(connection):
+    """
+    Return False if the server closed an idle connection (its socket is
+    readable while no response is expected)
+    """
+    if connection.sock is None:
+        return True
+    try:
+        return not select.select([connection.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return False
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of idle keep-alive connections, grouped by host.
+    At most max_size idle connections are kept for each host, and connections
+    that stayed idle longer than idle_timeout seconds are discarded.
+    """
+    DEFAULT_MAX_SIZE = 10
+    DEFAULT_IDLE_TIMEOUT = 60
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, connection_class, host, timeout, tunnel=None,
+                **kwargs):
+        """
+        Return a (connection, reused) tuple for the given host (through the
+        proxy tunnel to tunnel, a (host, headers) tuple, if given), reusing
+        an idle connection if there's one available
+        """
+        key = (connection_class, host, tunnel and tunnel[0])
+        now = time.time()
+        with self.lock:
+            connections = self.idle.get(key)
+            while connections:
+                connection, last_used = connections.pop()
+                if now - last_used < self.idle_timeout and \
+                        is_alive(connection):
+                    self.reused += 1
+                    if connection.sock and \
+                            timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+                connection.close()
+        return self.connect(connection_class, host, timeout, tunnel,
+                            **kwargs), False
+
+    def connect(self, connection_class, host, timeout, tunnel=None,
+                **kwargs):
+        """Create a brand new connection (not yet opened) to the given host"""
+        with self.lock:
+            self.created += 1
+        connection = connection_class(host, timeout=timeout, **kwargs)
+        if tunnel:
+            connection.set_tunnel(tunnel[0], headers=tunnel[1])
+        connection.pool_key = (connection_class, host, tunnel and tunnel[0])
+        return connection
+
+    def release(self, connection):
+        """Give a connection back to the pool once its response was read"""
+        with self.lock:
+            self._prune()
+            connections = self.idle.setdefault(connection.pool_key, [])
+            if len(connections) < self.max_size:
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def prune(self):
+        """Close the connections that stayed idle for too long"""
+        with self.lock:
+            self._prune()
+
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            for connections in self.idle.values():
+                for connection, _ in connections:
+                    connection.close()
+            self.idle = {}
+
+    def _prune(self):
+        """Drop expired connections. The lock must be held"""
+        deadline = time.time() - self.idle_timeout
+        for key, connections in self.idle.items():
+            alive = []
+            for connection, last_used in connections:
+                if last_used > deadline:
+                    alive.append((connection, last_used))
+                else:
+                    connection.close()
+            if alive:
+                self.idle[key] = alive
+            else:
+                del self.idle[key]
+
+
+class PooledResponseFile(object):
+    """
+    File-like wrapper around an httplib.HTTPResponse that gives the connection
+    back to the pool as soon as the whole body was read
+    """
+    def __init__(self, response, connection, pool):
+        self.response = response
+        self.connection = connection
+        self.pool = pool
+        self.buffer = ''
+
+    def read(self, amt=None):
+        """Read up to amt bytes (or everything, if amt is None)"""
+        if amt is None:
+            data = self.buffer + self._read()
+            self.buffer = ''
+        elif len(self.buffer) >= amt:
+            data = self.buffer[:amt]
+            self.buffer = self.buffer[amt:]
+        else:
+            data = self.buffer + self._read(amt - len(self.buffer))
+            self.buffer = ''
+        return data
+
+    def readline(self, limit=-1):
+        """Read a single line"""
+        while '\n' not in self.buffer and self.response is not None:
+            if limit >= 0 and len(self.buffer) >= limit:
+                break
+            chunk = self._read(8192)
+            if not chunk:
+                break
+            self.buffer += chunk
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        """Read all the remaining lines"""
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def close(self):
+        """
+        Close the response. The connection is only reused if the body was
+        fully consumed, otherwise it's closed as well
+        """
+        if self.response is None:
+            return
+        if self.response.isclosed():
+            self._release()
+        else:
+            self.response.close()
+            self.connection.close()
+            self.response = None
+
+    def _read(self, amt=None):
+        """Read from the underlying response"""
+        if self.response is None:
+            return ''
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if self.response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        """Return the connection to the pool"""
+        self.response = None
+        self.pool.release(self.connection)
+
+
+class KeepAliveHandlerMixin(object):
+    """Common do_open() for the keep-alive HTTP and HTTPS handlers"""
+    # requests that can be sent again if a reused connection fails before
+    # their response arrives (the server may have processed them already)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def do_open(self, http_class, req, **kwargs):
+        """Send the request through a pooled connection"""
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((name, value) for name, value in
+                            req.headers.items() if name not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), value) for name, value in
+                       headers.items())
+
+        tunnel = None
+        if req._tunnel_host:
+            # HTTPS through a proxy: CONNECT to the real host first, with
+            # the proxy credentials
+            tunnel_headers = {}
+            if 'Proxy-Authorization' in headers:
+                tunnel_headers['Proxy-Authorization'] = \
+                    headers.pop('Proxy-Authorization')
+            tunnel = (req._tunnel_host, tunnel_headers)
+
+        connection, reused = self.pool.acquire(http_class, host, req.timeout,
+                                               tunnel, **kwargs)
+        try:
+            response = self._send(connection, req, headers)
+        except (socket.error, httplib.HTTPException), err:
+            connection.close()
+            # the server may have dropped an idle connection: send again on
+            # a fresh one if the request didn't go through, or if sending it
+            # twice is harmless
+            if not reused or (getattr(err, 'sent', False) and
+                              req.get_method() not in
+                              self.IDEMPOTENT_METHODS):
+                raise urllib2.URLError(err)
+            connection = self.pool.connect(http_class, host, req.timeout,
+                                           tunnel, **kwargs)
+            try:
+                response = self._send(connection, req, headers)
+            except (socket.error, httplib.HTTPException), err:
+                connection.close()
+                raise urllib2.URLError(err)
+
+        fp = PooledResponseFile(response, connection, self.pool)
+        resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    @staticmethod
+    def _send(connection, req, headers):
+        """
+        Send a request and return its httplib response. Errors raised after
+        the request was sent are marked with sent = True
+        """
+        connection.request(req.get_method(), req.get_selector(), req.data,
+                           headers)
+        try:
+            return connection.getresponse(buffering=True)
+        except (socket.error, httplib.HTTPException), err:
+            err.sent = True
+            raise
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+    """urllib2 HTTP handler that reuses pooled connections"""
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+    """urllib2 HTTPS handler that reuses pooled connections"""
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+
+def build_opener(cookies, pool, compression=None):
+    """
+    Return a urllib2 opener that handles cookies, pooled connections and
+    compressed transfers (see CompressionHandler)
+    """
+    return urllib2.build_opener(
+        urllib2.HTTPCookieProcessor(cookies),
+        compression or CompressionHandler(),
+        KeepAliveHTTPHandler(pool),
+        KeepAliveHTTPSHandler(pool)
+    )
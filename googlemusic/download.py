@@ -0,0 +1,274 @@
+"""
+Google Music downloads
+
+Helpers to resume interrupted downloads and to download many songs at once.
+"""
+__author__ = "Tirino"
+
+import os
+import threading
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.concurrency import HostLimiter, WorkerPool
+from googlemusic.utils import replace_file
+
+def song_filename(song, to_folder='.'):
+    """Return the path a Song is downloaded to"""
+    return '%s/%s - %s.mp3' % (to_folder, song.artist, song.title)
+
+
+class PartialDownload(object):
+    """
+    A download in progress.
+    Data is written to <filename>.part and the byte ranges already on disk are
+    journaled in <filename>.part.journal, so an interrupted download can be
+    resumed instead of restarted. The file only gets its final name once it's
+    complete.
+    """
+    PART_SUFFIX = '.part'
+    JOURNAL_SUFFIX = '.part.journal'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.part = filename + self.PART_SUFFIX
+        self.journal = filename + self.JOURNAL_SUFFIX
+        self.size = None
+        self.done = []
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Load the journal of a previous attempt, if there's any"""
+        if not (os.path.exists(self.journal) and os.path.exists(self.part)):
+            return
+        try:
+            with open(self.journal, 'rb') as journal:
+                data = json.load(journal)
+            self.size = data['size']
+            self.done = [list(done) for done in data['done']]
+        except (IOError, ValueError, KeyError, TypeError):
+            self.size = None
+            self.done = []
+
+    def save(self):
+        """Write the journal to disk"""
+        with open(self.journal, 'wb') as journal:
+            json.dump({'size': self.size, 'done': self.done}, journal)
+
+    def reset(self, size=None):
+        """Forget any previous progress"""
+        self.size = size
+        self.done = []
+        self.save()
+
+    def part_size(self):
+        """Size of the .part file (0 if there's none)"""
+        try:
+            return os.path.getsize(self.part)
+        except OSError:
+            return 0
+
+    def _on_disk(self):
+        """The journaled ranges that really are in the .part file"""
+        size = self.part_size()
+        return [[start, min(end, size)] for start, end in self.done
+                if start < size]
+
+    @property
+    def offset(self):
+        """Number of contiguous bytes already downloaded from the start"""
+        done = self._on_disk()
+        if done and done[0][0] == 0:
+            return done[0][1]
+        return 0
+
+    @property
+    def downloaded(self):
+        """Number of bytes already downloaded"""
+        return sum(end - start for start, end in self.done)
+
+    def mark(self, start, end):
+        """Record that bytes [start, end) were written (and flushed)"""
+        with self.lock:
+            ranges = sorted(self.done + [[start, end]])
+            self.done = [ranges[0]]
+            for range_start, range_end in ranges[1:]:
+                last = self.done[-1]
+                if range_start <= last[1]:
+                    last[1] = max(last[1], range_end)
+                else:
+                    self.done.append([range_start, range_end])
+            self.save()
+
+    def missing(self, segment_size):
+        """
+        Return the [start, end) ranges that still have to be downloaded, split
+        in pieces of at most segment_size bytes
+        """
+        missing = []
+        position = 0
+        for start, end in self._on_disk() + [[self.size, self.size]]:
+            while position < start:
+                missing.append([position, min(start, position + segment_size)])
+                position = missing[-1][1]
+            position = max(position, end)
+        return missing
+
+    def complete(self):
+        """Return True if every byte of the file was downloaded"""
+        return self.size is not None and self.offset == self.size
+
+    def open(self, offset):
+        """
+        Open the .part file for writing at the given offset, truncating it
+        there (and forgetting the ranges journaled past it)
+        """
+        if offset and os.path.exists(self.part):
+            dest = open(self.part, 'r+b')
+            dest.seek(offset)
+            dest.truncate()
+        else:
+            dest = open(self.part, 'wb')
+            offset = 0
+        with self.lock:
+            self.done = [[start, min(end, offset)] for start, end in self.done
+                         if start < offset]
+            self.save()
+        return dest
+
+    def open_at(self, offset):
+        """
+        Open the (preallocated) .part file for writing at the given offset,
+        without truncating it
+        """
+        dest = open(self.part, 'r+b')
+        dest.seek(offset)
+        return dest
+
+    def preallocate(self, size):
+        """Start over with a .part file of the given size"""
+        with open(self.part, 'wb') as dest:
+            dest.truncate(size)
+        self.reset(size)
+
+    def commit(self):
+        """Atomically give the downloaded file its final name"""
+        replace_file(self.part, self.filename)
+        os.remove(self.journal)
+
+
+class DownloadResult(object):
+    """Outcome of downloading a single Song"""
+    def __init__(self, song, filename):
+        self.song = song
+        self.filename = filename
+        self.success = False
+        self.error = None
+        self.downloaded = 0
+        self.size = 0
+
+    def __str__(self):
+        if self.success:
+            return '%s: OK' % self.filename
+        return '%s: FAILED (%s)' % (self.filename, self.error)
+
+
+class DownloadReport(object):
+    """Aggregated progress and results of a bulk download"""
+    def __init__(self, results):
+        self.results = results
+        self.total = len(results)
+        self.completed = 0
+        self.failed = 0
+        self.downloaded = 0
+        self.lock = threading.Lock()
+
+    def add_bytes(self, result, downloaded, size):
+        """Account for the bytes a download just received"""
+        with self.lock:
+            self.downloaded += downloaded - result.downloaded
+            result.downloaded = downloaded
+            result.size = size
+
+    def finish(self, result, error=None):
+        """Mark a download as finished"""
+        with self.lock:
+            self.completed += 1
+            if error is None:
+                result.success = True
+            else:
+                result.error = error
+                self.failed += 1
+
+    @property
+    def succeeded(self):
+        """Return the results of the songs that were downloaded"""
+        return [result for result in self.results if result.success]
+
+    @property
+    def errors(self):
+        """Return the results of the songs that could not be downloaded"""
+        return [result for result in self.results if not result.success]
+
+    def __str__(self):
+        return '%d/%d songs, %d failed, %d bytes' % (
+            self.completed, self.total, self.failed, self.downloaded)
+
+
+class BulkDownloader(object):
+    """
+    Download many songs in parallel.
+    Stream URLs are resolved and files downloaded by a pool of workers, with
+    at most per_host concurrent downloads against the same host. A failed
+    song is recorded in the report and doesn't stop the other downloads.
+    If given, progress(report) is called from the worker threads every time
+    a chunk is received or a song finishes.
+    """
+    DEFAULT_WORKERS = 4
+    DEFAULT_PER_HOST = 4
+
+    def __init__(self, protocol, web, workers=DEFAULT_WORKERS,
+                 per_host=DEFAULT_PER_HOST, progress=None):
+        self.protocol = protocol
+        self.web = web
+        self.workers = workers
+        self.limiter = HostLimiter(per_host)
+        self.progress = progress
+
+    def download(self, songs, to_folder='.'):
+        """Download the given songs and return a DownloadReport"""
+        results = [DownloadResult(song, song_filename(song, to_folder))
+                   for song in songs]
+        report = DownloadReport(results)
+        with WorkerPool(self.workers) as pool:
+            for result in results:
+                pool.submit(self._download, report, result)
+        return report
+
+    def _download(self, report, result):
+        """Resolve the stream URL of a song and download it"""
+        def chunk_received(downloaded, size):
+            report.add_bytes(result, downloaded, size)
+            self._notify(report)
+
+        try:
+            song_id = result.song.id
+            url = self.protocol.get_stream_url(song_id)['url']
+            resolve_url = lambda: self.protocol.get_stream_url(
+                song_id, refresh=True)['url']
+            with self.limiter.hold(url):
+                self.web.download_file(url, result.filename, chunk_received,
+                                       resolve_url)
+        except Exception, error:
+            report.finish(result, error)
+        else:
+            report.finish(result)
+        self._notify(report)
+
+    def _notify(self, report):
+        """Call the progress callback, if any"""
+        if self.progress:
+            self.progress(report)
@@ -0,0 +1,323 @@
+"""
+Event loop
+
+A single-threaded I/O loop multiplexing non-blocking sockets with poll() (or
+select() where there's no poll), plus generator based coroutines: Python 2
+has no asyncio, so a coroutine yields the Tasks it waits for and is resumed
+with their results.
+"""
+__author__ = "Tirino"
+
+import errno
+import heapq
+import itertools
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from googlemusic.concurrency import Task
+
+class Return(Exception):
+    """Raised by a coroutine to finish with a value (see EventLoop.spawn)"""
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+def gather(tasks):
+    """
+    Return a Task finished with the list of results of the given tasks, or
+    with the error of the first one that fails
+    """
+    tasks = list(tasks)
+    gathered = Task(None, (), {})
+    if not tasks:
+        gathered.set_result([])
+        return gathered
+    pending = [len(tasks)]
+    lock = threading.Lock()
+    def done(task):
+        with lock:
+            if gathered.done():
+                return
+            if task.error:
+                gathered.set_error(task.error)
+                return
+            pending[0] -= 1
+            if pending[0]:
+                return
+        gathered.set_result([task.value for task in tasks])
+    for task in tasks:
+        task.add_done_callback(done)
+    return gathered
+
+
+def waker_pair():
+    """Return two connected sockets, to wake up a loop waiting in poll()"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        writer = socket.create_connection(server.getsockname())
+        reader, _ = server.accept()
+    finally:
+        server.close()
+    for sock in (reader, writer):
+        sock.setblocking(0)
+    writer.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return reader, writer
+
+
+class Timer(object):
+    """A callback scheduled by EventLoop.call_later"""
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Don't call the callback"""
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    I/O loop running on its own daemon thread.
+    Reader/writer callbacks and timers run on the loop thread and must not
+    block; other threads schedule work with call_soon or spawn.
+    """
+    READ = 1
+    WRITE = 2
+    # the longest the loop sleeps without checking for stop()
+    MAX_WAIT = 1.0
+
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.ready = deque()
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.thread = None
+        self.running = False
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+        self.waker, self.wake_writer = waker_pair()
+        self.add_reader(self.waker.fileno(), self._drain_waker)
+
+    def start(self):
+        """Start the loop thread"""
+        with self.lock:
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """Stop the loop (callbacks already scheduled aren't run)"""
+        self.running = False
+        self._wake()
+        if wait and self.thread and not self.in_loop():
+            self.thread.join()
+
+    def in_loop(self):
+        """Return True if called from the loop thread"""
+        return threading.current_thread() is self.thread
+
+    # Scheduling #
+    def call_soon(self, callback, *args):
+        """Call callback(*args) on the loop thread, from any thread"""
+        with self.lock:
+            self.ready.append((callback, args))
+        if not self.in_loop():
+            self._wake()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call callback(*args) on the loop thread after delay seconds and return
+        the Timer, to cancel it
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers,
+                           (timer.when, next(self.sequence), timer))
+        if not self.in_loop():
+            self._wake()
+        return timer
+
+    def sleep(self, delay):
+        """Return a Task finished after delay seconds, for coroutines"""
+        task = Task(None, (), {})
+        self.call_later(delay, task.set_result, None)
+        return task
+
+    def spawn(self, generator):
+        """
+        Run a coroutine (a generator yielding Tasks, or lists of Tasks) on the
+        loop and return its Task. The coroutine is resumed with the results
+        of what it yields, or gets their exceptions raised, and finishes by
+        raising Return(value) or returning.
+        """
+        task = Task(None, (), {})
+        self.call_soon(self._step, generator, task, None, None)
+        return task
+
+    def _step(self, generator, task, value, error):
+        """Resume a coroutine until it yields again"""
+        try:
+            if error:
+                waited = generator.throw(*error)
+            else:
+                waited = generator.send(value)
+        except Return, result:
+            task.set_result(result.value)
+            return
+        except StopIteration:
+            task.set_result(None)
+            return
+        except Exception:
+            task.set_error(sys.exc_info())
+            return
+        if isinstance(waited, (list, tuple)):
+            waited = gather(waited)
+        # always resumed from the loop, even if another thread finished it
+        waited.add_done_callback(lambda done: self.call_soon(
+            self._step, generator, task, done.value, done.error))
+
+    # I/O #
+    def add_reader(self, fd, callback):
+        """Call callback() on the loop thread whenever fd is readable"""
+        self.readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        """Stop watching fd for reads"""
+        if self.readers.pop(fd, None):
+            self._update(fd)
+
+    def add_writer(self, fd, callback):
+        """Call callback() on the loop thread whenever fd is writable"""
+        self.writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        """Stop watching fd for writes"""
+        if self.writers.pop(fd, None):
+            self._update(fd)
+
+    def _update(self, fd):
+        """Register the events watched for fd with the poller"""
+        if self.poller is None:
+            return
+        mask = 0
+        if fd in self.readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self.writers:
+            mask |= select.POLLOUT
+        if mask:
+            self.poller.register(fd, mask)
+            return
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def _poll(self, timeout):
+        """Wait for I/O events and return a list of (fd, READ|WRITE)"""
+        if self.poller is not None:
+            events = []
+            for fd, mask in self.poller.poll(timeout * 1000):
+                flags = 0
+                if mask & (select.POLLIN | select.POLLPRI):
+                    flags |= self.READ
+                if mask & select.POLLOUT:
+                    flags |= self.WRITE
+                if mask & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                    # let the callbacks find out what happened
+                    flags |= self.READ | self.WRITE
+                events.append((fd, flags))
+            return events
+        readable, writable, failed = select.select(
+            self.readers.keys(), self.writers.keys(), self.writers.keys(),
+            timeout)
+        events = dict((fd, self.READ) for fd in readable)
+        for fd in writable + failed:
+            events[fd] = events.get(fd, 0) | self.WRITE
+        return events.items()
+
+    # Loop #
+    def run(self):
+        """Run the loop until stop() is called"""
+        while self.running:
+            timeout = self.MAX_WAIT
+            with self.lock:
+                if self.ready:
+                    timeout = 0
+                elif self.timers:
+                    timeout = max(0, min(timeout,
+                                         self.timers[0][0] - time.time()))
+            try:
+                events = self._poll(timeout)
+            except (select.error, IOError), error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, flags in events:
+                if flags & self.READ and fd in self.readers:
+                    self._run_callback(self.readers[fd], ())
+                if flags & self.WRITE and fd in self.writers:
+                    self._run_callback(self.writers[fd], ())
+            self._run_timers()
+            with self.lock:
+                ready, self.ready = self.ready, deque()
+            for callback, args in ready:
+                self._run_callback(callback, args)
+
+    def _run_timers(self):
+        """Call the timers that are due"""
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+        for timer in due:
+            if not timer.cancelled:
+                self._run_callback(timer.callback, timer.args)
+
+    def _run_callback(self, callback, args):
+        """Call a callback, without letting its errors stop the loop"""
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _wake(self):
+        """Make the loop return from poll()"""
+        try:
+            self.wake_writer.send('x')
+        except socket.error:
+            # the buffer is full, so the loop is about to wake anyway
+            pass
+
+    def _drain_waker(self):
+        """Discard the bytes sent by _wake"""
+        try:
+            while self.waker.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        """Stop the loop and close its sockets"""
+        self.stop()
+        self.waker.close()
+        self.wake_writer.close()
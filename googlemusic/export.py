@@ -0,0 +1,371 @@
+"""
+Library export
+
+Write a whole library (playlists, their songs and, optionally, the songs'
+stream URLs) to JSON lines or CSV, streaming rows out as they're fetched so
+memory use doesn't grow with the size of the library:
+
+    python -m googlemusic export --user email@gmail.com --output library.csv
+
+Run `python -m googlemusic export --help` for the options.
+"""
+__author__ = "Tirino"
+
+import csv
+import getpass
+import optparse
+import os
+import sys
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.concurrency import WorkerPool, bounded_map
+from googlemusic.utils import write_file
+
+# output column -> key in the server's song data
+SONG_FIELDS = [
+  ('id', 'id'), ('title', 'title'), ('artist', 'artist'), ('album', 'album'),
+  ('album_artist', 'albumArtist'), ('track', 'track'), ('disc', 'disc'),
+  ('year', 'year'), ('genre', 'genre'), ('duration_ms', 'durationMillis'),
+  ('play_count', 'playCount'), ('rating', 'rating')
+]
+PLAYLIST_COLUMNS = ['playlist_id', 'playlist_title', 'position']
+PASSWORD_VARIABLE = 'GOOGLEMUSIC_PASSWORD'
+
+def song_columns(stream_urls=False):
+    """Return the columns of the song rows"""
+    columns = PLAYLIST_COLUMNS + [column for column, key in SONG_FIELDS]
+    if stream_urls:
+        columns.append('stream_url')
+    return columns
+
+
+class JSONLinesWriter(object):
+    """
+    Writes a JSON object per line: a "playlist" record for every playlist,
+    followed by a "song" record for each of its songs
+    """
+    def __init__(self, output, columns):
+        self.output = output
+        self.columns = columns
+
+    def write_playlist(self, playlist):
+        """Write a playlist record"""
+        self._write(dict(playlist, type='playlist'))
+
+    def write_song(self, row):
+        """Write a song record"""
+        record = dict((column, row.get(column)) for column in self.columns)
+        record['type'] = 'song'
+        self._write(record)
+
+    def _write(self, record):
+        """Write a record as a line"""
+        # without sort_keys, so the C encoder can be used
+        self.output.write(json.dumps(record, separators=(',', ':')))
+        self.output.write('\n')
+
+
+class CSVWriter(object):
+    """Writes a CSV row per song, with its playlist in the first columns"""
+    def __init__(self, output, columns, header=True):
+        self.writer = csv.writer(output)
+        self.columns = columns
+        if header:
+            self.writer.writerow(columns)
+
+    def write_playlist(self, playlist):
+        """Playlists are only written as the columns of their songs"""
+        pass
+
+    def write_song(self, row):
+        """Write a song row"""
+        values = []
+        for column in self.columns:
+            value = row.get(column)
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('utf8')
+            values.append(value)
+        self.writer.writerow(values)
+
+WRITERS = {'jsonl': JSONLinesWriter, 'csv': CSVWriter}
+
+
+class Checkpoint(object):
+    """
+    Progress of an export to a file: the playlists already written, and the
+    size of the file after the last one (whatever was written after it
+    belongs to an unfinished playlist, and is dropped when resuming)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.size = 0
+        self.songs = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as checkpoint:
+                data = json.load(checkpoint)
+            self.done = set(data['done'])
+            self.size = data['size']
+            self.songs = data['songs']
+
+    def reset(self):
+        """Start over"""
+        self.done = set()
+        self.size = 0
+        self.songs = 0
+
+    def mark(self, playlist_id, size, songs):
+        """Record that a playlist was written, the file being size bytes"""
+        self.done.add(playlist_id)
+        self.size = size
+        self.songs = songs
+        write_file(self.path, json.dumps({
+          'done': sorted(self.done), 'size': size, 'songs': songs}))
+
+    def remove(self):
+        """Forget the progress, once the export finished"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ExportStats(object):
+    """Counters of an export"""
+    def __init__(self):
+        self.started = time.time()
+        self.playlists = 0
+        self.songs = 0
+        self.urls = 0
+        self.url_errors = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @property
+    def elapsed(self):
+        """Seconds since the export started"""
+        return time.time() - self.started
+
+    def __str__(self):
+        elapsed = self.elapsed
+        return '%d playlists, %d songs (%.0f songs/s), %d stream URLs ' \
+            '(%d failed), %d playlists skipped, %d failed, in %.1fs' % (
+                self.playlists, self.songs, self.songs / max(elapsed, 1e-6),
+                self.urls, self.url_errors, self.skipped, self.failed,
+                elapsed)
+
+
+class Exporter(object):
+    """
+    Streams playlists and songs from a Protocol to a writer.
+    Without playlist ids the whole library is parsed from the server's
+    response one playlist at a time: the service only lists playlists
+    together with all their songs, so there's nothing left to load in
+    parallel. Given ids, playlists are loaded by up to `workers` threads, a
+    few ahead of the one being written. Stream URLs are resolved by the same
+    workers. Either way only a few playlists are in memory at once.
+    With a Checkpoint, the playlists it lists are skipped and every playlist
+    written is recorded in it. If given, progress(stats) is called after
+    every playlist.
+    """
+    DEFAULT_WORKERS = 4
+    # stream URLs resolved ahead of the song being written
+    URL_WINDOW = 64
+
+    def __init__(self, protocol, writer, workers=DEFAULT_WORKERS,
+                 stream_urls=False, checkpoint=None, progress=None):
+        self.protocol = protocol
+        self.writer = writer
+        self.workers = workers
+        self.stream_urls = stream_urls
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.stats = ExportStats()
+        # songs written by the exports this one resumes
+        self.previous_songs = checkpoint and checkpoint.songs or 0
+
+    def export(self, output, playlist_ids=None):
+        """Export the playlists to output (a file) and return the stats"""
+        with WorkerPool(self.workers) as pool:
+            for playlist in self._playlists(pool, playlist_ids):
+                if playlist is None:
+                    self.stats.failed += 1
+                elif self.checkpoint and \
+                        playlist['playlistId'] in self.checkpoint.done:
+                    self.stats.skipped += 1
+                else:
+                    self._write_playlist(pool, playlist)
+                    output.flush()
+                    if self.checkpoint:
+                        self.checkpoint.mark(
+                            playlist['playlistId'], output.tell(),
+                            self.previous_songs + self.stats.songs)
+                if self.progress:
+                    self.progress(self.stats)
+        return self.stats
+
+    def _playlists(self, pool, playlist_ids):
+        """Yield the data of the playlists to export (None if one failed)"""
+        if playlist_ids is None:
+            return self.protocol.iter_all_playlists()
+        if self.checkpoint:
+            self.stats.skipped += len([playlist_id for playlist_id in
+                                       playlist_ids if playlist_id in
+                                       self.checkpoint.done])
+            playlist_ids = [playlist_id for playlist_id in playlist_ids
+                            if playlist_id not in self.checkpoint.done]
+        return bounded_map(pool, self._load_playlist, playlist_ids,
+                           self.workers * 2)
+
+    def _load_playlist(self, playlist_id):
+        """Load a playlist, or return None if it fails"""
+        try:
+            return self.protocol.load_playlist_data(playlist_id)
+        except Exception:
+            return None
+
+    def _write_playlist(self, pool, playlist):
+        """Write a playlist and its songs"""
+        songs = playlist.get('playlist') or []
+        self.writer.write_playlist({
+          'id': playlist['playlistId'], 'title': playlist.get('title'),
+          'songs': len(songs)
+        })
+        rows = (self._song_row(playlist, position, song)
+                for position, song in enumerate(songs))
+        if self.stream_urls:
+            rows = bounded_map(pool, self._resolve_url, rows, self.URL_WINDOW)
+        for row in rows:
+            self.writer.write_song(row)
+            self.stats.songs += 1
+            if self.stream_urls:
+                if row['stream_url']:
+                    self.stats.urls += 1
+                else:
+                    self.stats.url_errors += 1
+        self.stats.playlists += 1
+
+    @staticmethod
+    def _song_row(playlist, position, song):
+        """Return the row of a song of a playlist"""
+        row = dict((column, song.get(key)) for column, key in SONG_FIELDS)
+        row['playlist_id'] = playlist['playlistId']
+        row['playlist_title'] = playlist.get('title')
+        row['position'] = position
+        return row
+
+    def _resolve_url(self, row):
+        """Add the stream URL to a song row (None if it fails)"""
+        try:
+            row['stream_url'] = self.protocol.get_stream_url(row['id'])['url']
+        except Exception:
+            row['stream_url'] = None
+        return row
+
+
+# Command line #
+def parse_args(argv):
+    """Parse the export command line"""
+    parser = optparse.OptionParser(
+        usage='python -m googlemusic export --user EMAIL [options]')
+    parser.add_option('-u', '--user', help='account e-mail')
+    parser.add_option('--session-file',
+                      help='reuse (and save) the session in this file')
+    parser.add_option('-o', '--output', default='-',
+                      help='output file (default: standard output)')
+    parser.add_option('-f', '--format', choices=sorted(WRITERS),
+                      help='jsonl or csv (default: from the output name, '
+                      'or jsonl)')
+    parser.add_option('-p', '--playlist', action='append', dest='playlists',
+                      help='export only this playlist id (can be repeated)')
+    parser.add_option('--stream-urls', action='store_true', default=False,
+                      help='resolve the stream URL of every song')
+    parser.add_option('-w', '--workers', type='int',
+                      default=Exporter.DEFAULT_WORKERS,
+                      help='parallel requests')
+    parser.add_option('--checkpoint', action='store_true', default=False,
+                      help='record the progress in OUTPUT.checkpoint and '
+                      'resume from it')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help="don't print progress")
+    options, args = parser.parse_args(argv)
+    if not options.user and not options.session_file:
+        parser.error('--user or --session-file is required')
+    if options.checkpoint and options.output == '-':
+        parser.error('--checkpoint needs an --output file')
+    if not options.format:
+        extension = os.path.splitext(options.output)[1].lstrip('.')
+        options.format = extension if extension in WRITERS else 'jsonl'
+    return options
+
+def login(client, options):
+    """
+    Log in with the saved session, or with the password. Return False if
+    the session can't be resumed and there's no --user to log in as
+    """
+    if options.session_file and \
+            client.resume_session(options.session_file) and \
+            (not options.user or client.protocol.account == options.user):
+        return True
+    if not options.user:
+        print >> sys.stderr, 'No usable session in %s: --user is required ' \
+            'to log in again' % options.session_file
+        return False
+    password = os.environ.get(PASSWORD_VARIABLE) or \
+        getpass.getpass('Password for %s: ' % options.user)
+    client.login(options.user, password, options.session_file)
+    return True
+
+def main(argv=None):
+    """Run the export command"""
+    from googlemusic.client import Client
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    client = Client()
+    client.pool.max_size = max(client.pool.max_size, options.workers)
+    if not login(client, options):
+        client.pool.close()
+        return 2
+
+    checkpoint = None
+    if options.checkpoint:
+        checkpoint = Checkpoint(options.output + '.checkpoint')
+    resuming = bool(checkpoint and checkpoint.done and
+                    os.path.exists(options.output))
+    if options.output == '-':
+        output = sys.stdout
+    elif resuming:
+        # drop the rows of the playlist that was being written
+        output = open(options.output, 'r+b')
+        output.truncate(checkpoint.size)
+        output.seek(checkpoint.size)
+    else:
+        output = open(options.output, 'wb')
+        if checkpoint:
+            checkpoint.reset()
+
+    columns = song_columns(options.stream_urls)
+    if options.format == 'csv':
+        writer = CSVWriter(output, columns, header=not resuming)
+    else:
+        writer = JSONLinesWriter(output, columns)
+    last_report = [time.time()]
+    def progress(stats):
+        if not options.quiet and time.time() - last_report[0] >= 2:
+            last_report[0] = time.time()
+            print >> sys.stderr, stats
+    exporter = Exporter(client.protocol, writer, options.workers,
+                        options.stream_urls, checkpoint, progress)
+    try:
+        stats = exporter.export(output, options.playlists)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        client.pool.close()
+    if checkpoint and not stats.failed:
+        checkpoint.remove()
+    print >> sys.stderr, stats
+    return 1 if stats.failed else 0
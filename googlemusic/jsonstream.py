@@ -0,0 +1,118 @@
+"""
+Streaming JSON parsing
+
+Parse the items of a big JSON array while it's being read from the network,
+one item at a time, instead of loading the whole document in memory.
+"""
+__author__ = "Tirino"
+
+import re
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+WHITESPACE = ' \t\n\r'
+NUMBER_START = '-0123456789'
+# what's left of the buffer after a number that could still be part of it
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+class JSONStreamReader(object):
+    """
+    Incremental reader of a JSON document coming from a file-like object.
+    Values are decoded straight from the (utf-8) bytes with raw_decode, and
+    only the part of the document that's being decoded is kept in memory.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, size=None):
+        """Read more data into the buffer. Return False at end of stream"""
+        if self.eof:
+            return False
+        if self.pos:
+            # drop what was already consumed
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.stream.read(max(size or 0, self.chunk_size))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character ('' at end of stream)"""
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ''
+
+    def expect(self, characters):
+        """Consume the next character, which must be one of characters"""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('Expected %r at offset %d, found %r' % (
+                characters, self.pos, character))
+        self.pos += 1
+        return character
+
+    def decode(self):
+        """Decode the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # incomplete value: read at least as much as we have buffered
+                # so big values are re-scanned a logarithmic number of times
+                if not self.read_more(len(self.buffer) - self.pos):
+                    raise
+                continue
+            if not self.eof and self.buffer[self.pos] in NUMBER_START and \
+                    NUMBER_TAIL.match(self.buffer, end):
+                # a number could continue in the next chunk (e.g. '1.' or
+                # '1e' were decoded as 1)
+                if self.read_more():
+                    continue
+            self.pos = end
+            return value
+
+
+def iter_array(stream, key, chunk_size=JSONStreamReader.CHUNK_SIZE):
+    """
+    Yield, one by one, the items of the array stored under key in the
+    top-level JSON object read from stream.
+    Raise KeyError if the object has no such key.
+    """
+    reader = JSONStreamReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        raise KeyError(key)
+    while True:
+        name = reader.decode()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            break
+        reader.decode()
+        if reader.expect(',}') == '}':
+            raise KeyError(key)
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.decode()
+        if reader.expect(',]') == ']':
+            return
@@ -0,0 +1,259 @@
+"""
+Request instrumentation
+
+Counters, latency histograms, bytes transferred, retries and errors of the
+requests made by WebRequest and Protocol, with hooks to export them.
+Nothing is measured unless a Metrics object is installed (see
+Client.enable_metrics).
+"""
+__author__ = "Tirino"
+
+import math
+import threading
+import time
+import urllib2
+import urlparse
+
+def error_class(error):
+    """Return a short name for the class of an error"""
+    if isinstance(error, urllib2.HTTPError):
+        return 'HTTP %d' % error.code
+    return error.__class__.__name__
+
+def request_name(url):
+    """Name a request after the last part of its URL's path"""
+    path = urlparse.urlparse(url).path.rstrip('/')
+    return path.rsplit('/', 1)[-1] or 'root'
+
+
+class Histogram(object):
+    """
+    Histogram with logarithmic buckets, each one `growth` times wider than
+    the previous one, so percentiles are within that ratio of the real value
+    """
+    MINIMUM = 1e-5
+    GROWTH = 1.05
+
+    def __init__(self, minimum=MINIMUM, growth=GROWTH):
+        self.minimum = minimum
+        self.log_growth = math.log(growth)
+        self.growth = growth
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Add a value"""
+        if value > self.minimum:
+            bucket = int(math.log(value / self.minimum) / self.log_growth) + 1
+        else:
+            bucket = 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return (an upper bound of) the given percentile, or None"""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        return min(self.minimum * self.growth ** bucket, self.max)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+class RequestStats(object):
+    """What happened to the requests with a given name"""
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self.count = 0
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = {}
+        self.latency = Histogram()
+
+    def as_dict(self):
+        """Return the stats as a dict (latencies in seconds)"""
+        result = {
+          'count': self.count, 'retries': self.retries,
+          'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+          'errors': dict(self.errors), 'latency_mean': self.latency.mean,
+          'latency_max': self.latency.max
+        }
+        for percent in self.PERCENTILES:
+            result['latency_p%d' % percent] = \
+                self.latency.percentile(percent)
+        return result
+
+
+class RequestEvent(object):
+    """A finished request, as passed to the hooks"""
+    def __init__(self, name, latency, bytes_in=0, bytes_out=0, status=None,
+                 error=None):
+        self.name = name
+        # seconds until the response headers (or the error)
+        self.latency = latency
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.status = status
+        self.error = error
+
+    def __str__(self):
+        return '%s %s %.1fms in=%d out=%d' % (
+            self.name, self.error or self.status, self.latency * 1000,
+            self.bytes_in, self.bytes_out)
+
+
+class Metrics(object):
+    """
+    Collects RequestStats by request name. HTTP requests are named
+    'http.<last part of the path>' (e.g. http.loadplaylist) and API calls
+    'api.<method>' (they include cache hits and session renewals).
+    Every hook is called with a RequestEvent when a request ends; hooks run
+    in the thread that made the request and must be quick.
+    """
+    def __init__(self, hooks=None):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.hooks = list(hooks or [])
+
+    def add_hook(self, hook):
+        """Call hook(event) for every finished request"""
+        self.hooks.append(hook)
+
+    def _stats(self, name):
+        """Return the stats of a name (with the lock held)"""
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RequestStats()
+        return stats
+
+    def record(self, event):
+        """Account for a finished request"""
+        with self.lock:
+            stats = self._stats(event.name)
+            stats.count += 1
+            stats.bytes_in += event.bytes_in
+            stats.bytes_out += event.bytes_out
+            stats.latency.record(event.latency)
+            if event.error:
+                stats.errors[event.error] = \
+                    stats.errors.get(event.error, 0) + 1
+        for hook in self.hooks:
+            hook(event)
+
+    def retry(self, name):
+        """Count a retry of a request"""
+        with self.lock:
+            self._stats(name).retries += 1
+
+    def open(self, opener, request):
+        """
+        Open a urllib2 request with opener and return a response that
+        records the request when it's closed. Bytes are counted as sent and
+        received, i.e. compressed if the transfer was.
+        """
+        name = 'http.' + request_name(request.get_full_url())
+        started = time.time()
+        try:
+            response = opener.open(request)
+        except Exception, error:
+            # the handlers may have compressed the body in place
+            self.record(RequestEvent(name, time.time() - started, 0,
+                                     len(request.get_data() or ''),
+                                     getattr(error, 'code', None),
+                                     error_class(error)))
+            raise
+        return MeteredResponse(self, response, RequestEvent(
+            name, time.time() - started, 0, len(request.get_data() or ''),
+            response.code))
+
+    def timer(self, name):
+        """Return a context manager that records the time its block takes"""
+        return Timer(self, name)
+
+    def snapshot(self):
+        """Return a dict with the stats of every request name"""
+        with self.lock:
+            return dict((name, stats.as_dict())
+                        for name, stats in self.stats.iteritems())
+
+    def reset(self):
+        """Forget the collected stats"""
+        with self.lock:
+            self.stats.clear()
+
+
+class Timer(object):
+    """Context manager that records a request, and its error if any"""
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        error = exc_value and error_class(exc_value)
+        self.metrics.record(RequestEvent(self.name,
+                                         time.time() - self.started,
+                                         error=error))
+
+
+class MeteredResponse(object):
+    """
+    Response wrapper counting the bytes read until it's closed (for a
+    compressed response, the compressed bytes read from the wire)
+    """
+    def __init__(self, metrics, response, event):
+        self.metrics = metrics
+        self.response = response
+        self.event = event
+        # a DecodedResponseFile (see googlemusic.compression) counts them
+        self.wire = getattr(response, 'fp', None)
+        if not hasattr(self.wire, 'wire_bytes'):
+            self.wire = None
+
+    def _count(self, data):
+        """Account for data read from the response"""
+        if not self.event:
+            return
+        if self.wire:
+            self.event.bytes_in = self.wire.wire_bytes
+        else:
+            self.event.bytes_in += len(data)
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self._count(data)
+        return data
+
+    def readline(self, *args):
+        data = self.response.readline(*args)
+        self._count(data)
+        return data
+
+    def close(self):
+        self.response.close()
+        if self.event:
+            event, self.event = self.event, None
+            self.metrics.record(event)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
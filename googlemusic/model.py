@@ -1,38 +1,143 @@
 """
 Google Music models
+
+Models use __slots__ and share repeated strings (artist and album names,
+artwork URLs) to keep big libraries small in memory.
 """
 __author__ = "Tirino"
 
+import threading
+import weakref
+
+class StringPool(object):
+    """
+    Shares strings that repeat a lot (artist and album names, artwork URLs)
+    so equal values are stored once. At most max_size strings are kept:
+    when it's full the pool starts over (the objects built so far keep
+    sharing the strings they got), so it doesn't grow with every string
+    ever seen.
+    """
+    DEFAULT_MAX_SIZE = 100000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.strings = {}
+
+    def intern(self, value):
+        """Return the shared copy of a string"""
+        if value is None:
+            return None
+        shared = self.strings.get(value)
+        if shared is None:
+            if len(self.strings) >= self.max_size:
+                self.strings.clear()
+            shared = self.strings[value] = value
+        return shared
+
+    def __len__(self):
+        return len(self.strings)
+
+# used by the models built without a SongRegistry
+_default_strings = StringPool()
+
+def intern_string(value, strings=None):
+    """Return a shared copy of a string that repeats a lot"""
+    if strings is None:
+        strings = _default_strings
+    return strings.intern(value)
+
+# fields of the song data the models use
+SONG_KEYS = ('id', 'name', 'title', 'artist', 'album', 'albumArtist',
+             'track', 'albumArtUrl')
+SHARED_SONG_KEYS = frozenset(['artist', 'album', 'albumArtist',
+                              'albumArtUrl'])
+
+def compact_song(data, strings=None):
+    """
+    Return the fields of a song's data (see SONG_KEYS) as a tuple, with its
+    repeated strings shared: much smaller than the decoded dict
+    """
+    if strings is None:
+        strings = _default_strings
+    values = [strings.intern(data.get(key)) if key in SHARED_SONG_KEYS
+              else data.get(key) for key in SONG_KEYS]
+    # like Song.id, a str is a fraction of the size of a unicode string
+    values[0] = str(values[0])
+    return tuple(values)
+
+
 class Playlist(object):
-    """A Google Music Playlist"""
-    def __init__(self, data=None):
+    """
+    A Google Music Playlist
+    With lazy=True, the Song objects are only built when songs is accessed;
+    until then only the fields they need are kept, as tuples (see
+    compact_song). Songs are built by the given SongRegistry, if any.
+    """
+    __slots__ = ('id', 'title', '_songs', '_songs_data', '_registry')
+
+    def __init__(self, data=None, lazy=False, registry=None):
+        self._songs = []
+        self._songs_data = None
+        self._registry = registry
         if data:
             if 'playlistId' in data:
                 self.id = str(data['playlistId'])
             else:
                 self.id = str(data['id'])
             self.title = data['title']
-            self.songs = []
             if 'playlist' in data:
-                for song in data['playlist']:
-                    self.songs.append(Song(song))
+                if lazy:
+                    strings = getattr(registry, 'strings', None)
+                    self._songs = None
+                    self._songs_data = [compact_song(song, strings)
+                                        for song in data['playlist']]
+                else:
+                    self._songs = self._build_songs(data['playlist'])
         else:
             self.id = None
             self.title = None
-            self.songs = []
+
+    @property
+    def songs(self):
+        """The playlist's Song objects"""
+        if self._songs is None:
+            self._songs = self._build_songs(
+                dict(zip(SONG_KEYS, values)) for values in self._songs_data)
+            self._songs_data = None
+        return self._songs
+
+    def _build_songs(self, songs_data):
+        """Return the Song objects of the given songs' data"""
+        if self._registry is None:
+            return [Song(song) for song in songs_data]
+        return [self._registry.song(song) for song in songs_data]
+
+    @songs.setter
+    def songs(self, songs):
+        self._songs = songs
+        self._songs_data = None
+
+    @property
+    def song_count(self):
+        """Number of songs, without building them"""
+        if self._songs is None:
+            return len(self._songs_data)
+        return len(self._songs)
     
     def __str__(self):
         return ' - '.join([self.id, self.title])
 
 class Album(object):
     """A Google Music Album"""
+    __slots__ = ('name', 'artist', 'album_artist', 'artwork_url')
+
     def __init__(self, data=None):
         if data:
-            self.name = data['albumName']
-            self.artist = data['artistName']
-            self.album_artist = data['albumArtist']
+            self.name = intern_string(data['albumName'])
+            self.artist = intern_string(data['artistName'])
+            self.album_artist = intern_string(data['albumArtist'])
             if 'imageUrl' in data:
-                self.artwork_url = data['imageUrl']
+                self.artwork_url = intern_string(data['imageUrl'])
             else:
                 self.artwork_url = None
         else:
@@ -54,24 +159,19 @@ class Album(object):
 
 class Song(object):
     """A Google Music Song"""
-    def __init__(self, data=None):
+    __slots__ = ('id', 'name', 'title', 'artist', 'album', 'album_artist',
+                 'track', 'artwork_url', '__weakref__')
+
+    def __init__(self, data=None, strings=None):
         if data:
-            self.id = str(data['id'])
-            self.name = data['name']
-            self.title = data['title']
-            self.artist = data['artist']
-            self.album = data['album']
-            self.track = data['track']
-            if 'albumArtUrl' in data:
-                self.artwork_url = data['albumArtUrl']
-            else:
-                self.artwork_url = None
+            self.update(data, strings)
         else:
             self.id = None
             self.name = None
             self.title = None
             self.artist = None
             self.album = None
+            self.album_artist = None
             self.track = None
             self.artwork_url = None
     
@@ -82,5 +182,61 @@ class Song(object):
         else:
             return None
     
+    def update(self, data, strings=None):
+        """
+        Set the song's fields from its data, as returned by the server,
+        sharing repeated strings through the given StringPool
+        """
+        self.id = str(data['id'])
+        self.name = data['name']
+        self.title = data['title']
+        self.artist = intern_string(data['artist'], strings)
+        self.album = intern_string(data['album'], strings)
+        self.album_artist = intern_string(data.get('albumArtist'), strings)
+        self.track = data['track']
+        self.artwork_url = intern_string(data.get('albumArtUrl'), strings)
+
+    def data(self):
+        """Return the song's fields as song data, in the server's format"""
+        return {
+          'id': self.id, 'name': self.name, 'title': self.title,
+          'artist': self.artist, 'album': self.album,
+          'albumArtist': self.album_artist, 'track': self.track,
+          'albumArtUrl': self.artwork_url
+        }
+    
     def __str__(self):
         return ' - '.join([self.id, self.artist, self.title])
+
+
+class SongRegistry(object):
+    """
+    Identity map of Song objects by id: building a song that's already known
+    updates the known Song in place and returns it, so every playlist and
+    search result shares one object per song. Songs are held by weak
+    references, and forgotten once nothing else uses them. Their repeated
+    strings are shared through the registry's own StringPool, so they go
+    away with it.
+    """
+    def __init__(self):
+        self.songs = weakref.WeakValueDictionary()
+        self.strings = StringPool()
+        self.lock = threading.Lock()
+
+    def song(self, data):
+        """Return the Song for the given data, updated with it"""
+        song_id = str(data['id'])
+        with self.lock:
+            song = self.songs.get(song_id)
+            if song is None:
+                song = self.songs[song_id] = Song(data, self.strings)
+            else:
+                song.update(data, self.strings)
+        return song
+
+    def get(self, song_id):
+        """Return the Song with the given id, or None if there's none"""
+        return self.songs.get(str(song_id))
+
+    def __len__(self):
+        return len(self.songs)
@@ -0,0 +1,218 @@
+"""
+Request policies
+
+Client-side rate limiting, retries with exponential backoff and a circuit
+breaker for the calls Protocol makes to Google Music.
+"""
+__author__ = "Tirino"
+
+import errno
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+
+class CircuitOpenException(Exception):
+    """Exception for calls refused because the service keeps failing"""
+    pass
+
+
+def retry_after(error):
+    """Return the seconds a Retry-After header asks to wait, or None"""
+    headers = getattr(error, 'hdrs', None)
+    # an empty header Message is false, compare with None
+    value = headers.getheader('Retry-After') if headers is not None else None
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """
+    Rate limiter allowing `rate` calls per second on average, and bursts of
+    up to `burst` calls
+    """
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Wait until the given number of tokens is available and take it"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            self.sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """
+        Take the given number of tokens if they're available and return 0,
+        or return the seconds until they will be
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time
+    between 0 and min(maximum, base * factor ** n) seconds
+    """
+    def __init__(self, base=0.5, factor=2, maximum=30, rand=None):
+        self.base = base
+        self.factor = factor
+        self.maximum = maximum
+        self.rand = rand or random.Random()
+
+    def delay(self, attempt):
+        """Return the seconds to wait before the given retry (from 0)"""
+        ceiling = min(self.maximum, self.base * self.factor ** attempt)
+        return self.rand.uniform(0, ceiling)
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a service after `threshold` consecutive failures. Calls are
+    refused for reset_timeout seconds, then a single trial call decides
+    whether the circuit closes again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before(self):
+        """Raise CircuitOpenException if a call can't be made now"""
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenException(
+                        'Too many failures, not calling the service')
+                self.state = self.HALF_OPEN
+                self.trial = False
+            if self.state == self.HALF_OPEN:
+                if self.trial:
+                    raise CircuitOpenException(
+                        'Waiting for a trial call to the service')
+                self.trial = True
+
+    def success(self):
+        """Record a call that reached the service"""
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def failure(self):
+        """Record a call that failed because of the service"""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+            self.trial = False
+
+
+class RequestPolicy(object):
+    """
+    Rate limit, retry and circuit breaker settings for Protocol calls (see
+    Client.set_policy). Every part is optional:
+    - rate/burst: at most `rate` calls per second (token bucket)
+    - retries: transient errors (429, 5xx, connection errors) are retried
+      this many times, waiting Backoff delays (or what Retry-After asks)
+    - breaker: a CircuitBreaker shared by every call
+    Calls that aren't idempotent (UNSAFE_METHODS) are only retried when the
+    server surely didn't process them: 429 responses and refused
+    connections.
+    """
+    RETRY_CODES = (429, 500, 502, 503, 504)
+    UNSAFE_METHODS = ('addplaylist', 'deleteplaylist')
+    DEFAULT_RETRIES = 3
+
+    def __init__(self, rate=None, burst=None, retries=DEFAULT_RETRIES,
+                 backoff=None, breaker=None, sleep=time.sleep):
+        self.limiter = rate and TokenBucket(rate, burst, sleep=sleep)
+        self.retries = retries
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker
+        self.sleep = sleep
+
+    def is_transient(self, error):
+        """True if the error may go away by calling again"""
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in self.RETRY_CODES
+        return isinstance(error, (urllib2.URLError, socket.error,
+                                  httplib.HTTPException))
+
+    def can_retry(self, name, error):
+        """True if a call that failed with a transient error can be retried"""
+        if name not in self.UNSAFE_METHODS:
+            return True
+        if isinstance(error, urllib2.HTTPError):
+            return error.code == 429
+        reason = getattr(error, 'reason', error)
+        return getattr(reason, 'errno', None) == errno.ECONNREFUSED
+
+    def call(self, name, func, args=(), on_retry=None):
+        """
+        Call func(*args) following the policy. on_retry(name, error) is
+        called before every retry
+        """
+        attempt = 0
+        while True:
+            if self.breaker:
+                self.breaker.before()
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                result = func(*args)
+            except Exception, error:
+                transient = self.is_transient(error)
+                if self.breaker:
+                    if transient:
+                        self.breaker.failure()
+                    else:
+                        # the service answered
+                        self.breaker.success()
+                if not transient or attempt >= self.retries or \
+                        not self.can_retry(name, error):
+                    raise
+                delay = self.backoff.delay(attempt)
+                wait = retry_after(error)
+                if wait is not None:
+                    delay = max(delay, min(wait, self.backoff.maximum))
+                if hasattr(error, 'close'):
+                    error.close()
+                if on_retry:
+                    on_retry(name, error)
+                self.sleep(delay)
+                attempt += 1
+            else:
+                if self.breaker:
+                    self.breaker.success()
+                return result
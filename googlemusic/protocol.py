@@ -10,10 +10,15 @@ information.
 __author__ = "Tirino"
 
 import urllib
+import urllib2
 import random
+import threading
 
+from googlemusic.cache import StreamUrlCache
 from googlemusic.request import MusicManagerRequest
 from googlemusic.request import FORM_CONTENT_TYPE
+from googlemusic.session import dump_cookies, load_cookies
+from googlemusic.session import load_session, save_session
 from googlemusic.utils import get_from_text
 
 class AuthenticationException(Exception):
@@ -30,24 +35,33 @@ class MusicManagerClient(object):
     ISSUE_AUTH_SERVICE_NAME = 'gaia'
     TOKEN_AUTH_URL = 'https://www.google.com/accounts/TokenAuth'
 
-    def __init__(self, cookies):
+    def __init__(self, cookies, pool=None):
         self.cookies = cookies
-        self.base_request = MusicManagerRequest(self.cookies)
+        self.base_request = MusicManagerRequest(self.cookies, pool)
 
     def get_issue_auth(self, auth_data, headers):
         """Return an issue auth token"""
-        body = {
+        issue_response = self.base_request.request(self.ISSUE_AUTH_URL, 
+                                self.issue_auth_body(auth_data), headers)
+        return issue_response.rstrip()
+
+    def issue_auth_body(self, auth_data):
+        """Return the form asking for an issue auth token"""
+        return {
           'SID': auth_data['SID'], 'LSID': auth_data['LSID'],
           'service': self.ISSUE_AUTH_SERVICE_NAME
         }
-        issue_response = self.base_request.request(self.ISSUE_AUTH_URL, 
-                                                            body, headers)
-        return issue_response.rstrip()
 
     def authenticate(self, auth_data, service, redirect, source=None):
         """Authenticate against the provided service"""
         headers = {'Content-Type': FORM_CONTENT_TYPE}
         issue_auth = self.get_issue_auth(auth_data, headers)
+        url = self.token_auth_url(issue_auth, service, redirect, source)
+        # Get session cookies
+        return self.base_request.request(url, None, headers)
+
+    def token_auth_url(self, issue_auth, service, redirect, source=None):
+        """Return the URL that turns an issue auth token into cookies"""
         params_data = {
           'auth': issue_auth, 'service': service, 'continue': redirect
         }
@@ -55,9 +69,7 @@ class MusicManagerClient(object):
             params_data['source'] = source
 
         params = urllib.urlencode(params_data)
-        url = '%s?%s' % (self.TOKEN_AUTH_URL, params)
-        # Get session cookies
-        return self.base_request.request(url, None, headers)
+        return '%s?%s' % (self.TOKEN_AUTH_URL, params)
 
 
 class Protocol(object):
@@ -69,6 +81,9 @@ class Protocol(object):
     PLAY_ENDPOINT = 'https://play.google.com/music/play'
     
     GOOGLE_PLAY_URL = 'https://play.google.com/music/listen?u=0&hl=en'
+
+    # the server rejects requests of expired sessions with these
+    AUTH_ERROR_CODES = (401, 403)
     
     def __init__(self, web_request):
         self.debug = False
@@ -77,9 +92,38 @@ class Protocol(object):
         self.cookies = self.web.get_cookies()
         self.auth_data = {}
         self.playlists = []
+        self.stream_urls = StreamUrlCache()
+        # see Client.enable_response_cache
+        self.response_cache = None
+        self.account = None
+        # kept in memory only, to log in again if the session is rejected
+        self.credentials = None
+        self.session_file = None
+        self.auth_lock = threading.Lock()
+        # incremented every time the session is renewed
+        self.auth_generation = 0
+        # see Client.enable_metrics
+        self.metrics = None
+        # see Client.set_policy
+        self.policy = None
     
     def login(self, username, password):
         """Authenticate against Google Music servers"""
+        self.credentials = (username, password)
+        with self.auth_lock:
+            self._client_login(username, password)
+            self._authenticate_session()
+            self.auth_generation += 1
+        self.save_session()
+        return True
+
+    def _client_login(self, username, password):
+        """Get the account's auth tokens"""
+        url, body, headers = self._client_login_call(username, password)
+        self._set_auth_data(username, self.web.request(url, body, headers))
+
+    def _client_login_call(self, username, password):
+        """Return the URL, body and headers of a ClientLogin request"""
         body = {
           'Email': username, 'Passwd': password,
           'service': self.SERVICE_NAME, 'accountType': 'GOOGLE'
@@ -87,7 +131,10 @@ class Protocol(object):
         headers = {
           'Accept': '*/*', 'Content-Type': 'application/x-www-form-urlencoded'
         }
-        auth_data = self.web.request(self.LOGIN_ENDPOINT, body, headers)
+        return self.LOGIN_ENDPOINT, body, headers
+
+    def _set_auth_data(self, username, auth_data):
+        """Keep the auth tokens of a ClientLogin response"""
         if 'Auth=' in auth_data:
             self.auth_data['SID'] = get_from_text(r'^SID=(.*)', auth_data)
             self.auth_data['LSID'] = get_from_text(r'LSID=(.*)', auth_data)
@@ -95,27 +142,178 @@ class Protocol(object):
         else:
             raise AuthenticationException(
                                     'Unable to authenticate: %s' % auth_data)
-        
+        self.account = username
+
+    def _authenticate_session(self):
+        """Turn the auth tokens into session cookies"""
         # now get a XT cookie
-        mm_client = MusicManagerClient(self.cookies)
+        mm_client = MusicManagerClient(self.cookies, self.web.get_pool())
+        mm_client.base_request.metrics = self.metrics
         mm_client.authenticate(self.auth_data, self.SERVICE_NAME, 
                                             self.GOOGLE_PLAY_URL, 'jumper')
         self.cookies = mm_client.cookies
+
+    # Session #
+    def session_data(self):
+        """
+        Return the session (auth tokens, cookies and session id) as a dict,
+        or None if not logged in. The password is never included.
+        """
+        if not self.auth_data:
+            return None
+        return {
+          'account': self.account, 'session_id': self.session_id,
+          'auth_data': self.auth_data,
+          'cookies': dump_cookies(self.cookies)
+        }
+
+    def restore_session(self, data, username=None):
+        """
+        Restore a session returned by session_data, without contacting the
+        server. Return False if it's not a session (for username, if given)
+        """
+        if not data or not data.get('auth_data') or \
+                (username and data.get('account') != username):
+            return False
+        self.account = data['account']
+        self.session_id = data['session_id']
+        self.auth_data = data['auth_data']
+        load_cookies(self.cookies, data['cookies'])
+        self.auth_generation += 1
+        return True
+
+    def save_session(self, path=None):
+        """Save the session to path, or to the session file in use"""
+        path = path or self.session_file
+        data = self.session_data()
+        if not path or not data:
+            return False
+        self.session_file = path
+        save_session(path, data)
         return True
+
+    def load_session(self, path, username=None):
+        """
+        Restore a session saved with save_session (see restore_session) and
+        keep saving it there
+        """
+        self.session_file = path
+        return self.restore_session(load_session(path), username)
+
+    def reauthenticate(self, generation=None):
+        """
+        Renew a session the server rejected: ask for new session cookies with
+        the auth tokens and, if they were rejected too, log in again with the
+        credentials given to login(). Nothing is done if the session was
+        renewed since generation.
+        """
+        with self.auth_lock:
+            if generation is not None and generation != self.auth_generation:
+                return
+            try:
+                self._authenticate_session()
+            except urllib2.HTTPError, error:
+                if not self.credentials:
+                    raise AuthenticationException(
+                        'Session expired: %s' % error)
+                self._client_login(*self.credentials)
+                self._authenticate_session()
+            self.auth_generation += 1
+        self.save_session()
+
+    def _authorized(self, func, *args):
+        """
+        Call func(*args), renewing the session and calling it again if the
+        server rejected the session
+        """
+        generation = self.auth_generation
+        if self.auth_data and not self.has_session_cookie():
+            # the xt cookie of a restored session expired: renew it first
+            self.reauthenticate(generation)
+            generation = self.auth_generation
+        try:
+            return func(*args)
+        except urllib2.HTTPError, error:
+            if error.code not in self.AUTH_ERROR_CODES or not self.auth_data:
+                raise
+            error.close()
+        if self.metrics:
+            self.metrics.retry('api.session')
+        self.reauthenticate(generation)
+        return func(*args)
     
+    def has_session_cookie(self):
+        """Return True if there's an XT cookie to make API calls with"""
+        return self.cookies.get_cookie('xt') is not None
+
     def get_xt_for_url(self):
         """Return the XT code, url encoded"""
-        return urllib.quote(self.cookies.get_cookie('xt'))
+        xt = self.cookies.get_cookie('xt')
+        if xt is None:
+            raise AuthenticationException('Not logged in (no session cookie)')
+        return urllib.quote(xt)
     
     def api_request(self, method, payload=None):
-        """Make XHR requests and parse the result as JSON"""
-        payload = payload or {}
+        """
+        Make XHR requests and parse the result as JSON.
+        Read-only methods are answered by the response cache, if any.
+        """
+        if not self.metrics:
+            return self._authorized(self._api_request, method, payload)
+        with self.metrics.timer('api.' + method):
+            return self._authorized(self._api_request, method, payload)
+
+    def _api_request(self, method, payload=None):
+        """Make an XHR request (see api_request)"""
+        if self.response_cache is None:
+            url, body, headers = self._api_call(method, payload)
+            return self._call(method, self.web.xhr_json, url, body, headers)
+
+        key_payload = payload or {}
+        url, body, headers = self._api_call(method, payload)
+        def send(extra_headers):
+            headers.update(extra_headers)
+            return self._call(method, self.web.xhr_json_response, url, body,
+                              headers)
+        return self.response_cache.call(method, key_payload, send,
+                                        self.account)
+
+    def api_stream(self, method, key, payload=None):
+        """
+        Make XHR requests and yield the items of the array found under key in
+        the result, parsing them while they're received
+        """
+        return self._authorized(self._api_stream, method, key, payload)
+
+    def _api_stream(self, method, key, payload=None):
+        """Make a streamed XHR request (see api_stream)"""
+        url, body, headers = self._api_call(method, payload)
+        return self._call(method, self.web.xhr_json_items, url, key, body,
+                          headers)
+
+    def _call(self, name, func, *args):
+        """Make a request following the request policy, if any"""
+        if self.policy is None:
+            return func(*args)
+        return self.policy.call(name, func, args, self._retrying)
+
+    def _retrying(self, name, error):
+        """Called by the request policy before retrying a request"""
+        if self.metrics:
+            self.metrics.retry('api.' + name)
+        if self.debug:
+            print 'Retrying %s after %s' % (name, error)
+
+    def _api_call(self, method, payload=None):
+        """Return the URL, body and headers of an API call"""
+        # a copy, the caller's payload may be used again (e.g. as a key)
+        payload = dict(payload or {})
         payload['sessionId'] = self.session_id
         body = {'json': payload}
         headers = {'Content-Type': FORM_CONTENT_TYPE}
-        url = url = '%s/%s?u=0&xt=%s' % (self.SERVICE_ENDPOINT, method, 
-                                                self.get_xt_for_url())
-        return self.web.xhr_json(url, body, headers)
+        url = '%s/%s?u=0&xt=%s' % (self.SERVICE_ENDPOINT, method,
+                                   self.get_xt_for_url())
+        return url, body, headers
     
     # Playlists #
     def get_all_playlists(self):
@@ -126,12 +324,27 @@ class Protocol(object):
         else:
             raise RequestException("Couldn't get playlists: %s", str(result))
     
+    def iter_all_playlists(self):
+        """
+        Yield all the playlists and their songs, one by one, while the
+        response is being received
+        """
+        try:
+            for playlist in self.api_stream('loadplaylist', 'playlists', {}):
+                yield playlist
+        except KeyError:
+            raise RequestException("Couldn't get playlists")
+    
     def load_playlist(self, playlist_id):
         """Load a specific playlist's songs"""
+        return self.load_playlist_data(playlist_id)['playlist']
+
+    def load_playlist_data(self, playlist_id):
+        """Load a specific playlist, with its title and songs"""
         body = {'id': playlist_id, 'requestCause': 3, 'requestType': 1}
         result = self.api_request('loadplaylist', body)
         if 'playlistId' in result:
-            return result['playlist']
+            return result
         else:
             raise RequestException("Couldn't load playlist: %s", str(result))
     
@@ -188,15 +401,30 @@ class Protocol(object):
         else:
             raise RequestException('Could not perform search!')
     
-    def get_stream_url(self, song_id):
-        """Get the URL to stream or download a song"""
-        url = '%s?u=0&songid=%s&pt=e' % (self.PLAY_ENDPOINT, song_id)
-        result = self.web.xhr_json(url)
+    def get_stream_url(self, song_id, refresh=False):
+        """
+        Get the URL to stream or download a song.
+        URLs are cached until shortly before they expire, unless refresh is
+        True. See stream_urls.stats() for the cache counters.
+        """
+        if refresh:
+            self.stream_urls.invalidate(song_id)
+        return self.stream_urls.get(song_id, self._fetch_stream_url)
+
+    def _fetch_stream_url(self, song_id):
+        """Request the URL to stream or download a song"""
+        url = self._stream_url_call(song_id)
+        result = self._authorized(self._call, 'play', self.web.xhr_json,
+                                  url)
         if 'url' in result:
             return result
         else:
             raise RequestException('Could not get the URL: %s' % str(result))
     
+    def _stream_url_call(self, song_id):
+        """Return the URL that answers with a song's stream URL"""
+        return '%s?u=0&songid=%s&pt=e' % (self.PLAY_ENDPOINT, song_id)
+    
     def get_settings(self):
         """Get the user settings"""
         # URL: /services/loadsettings?u=0&xt=Cj...U==
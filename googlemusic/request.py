@@ -6,15 +6,52 @@ These classes mimic requests made by a Web Browser and Google Music Manager
 __author__ = "Tirino"
 
 import cookielib
+import httplib
+import os
+import socket
+import threading
+import time
 import urllib
 import urllib2
-try:
-    import simplejson as json
-except ImportError:
-    import json
+from googlemusic.codec import JSONCodec
+from googlemusic.compression import CompressionHandler
+from googlemusic.concurrency import WorkerPool
+from googlemusic.connection import ConnectionPool, build_opener
+from googlemusic.download import PartialDownload
+from googlemusic.jsonstream import iter_array
+from googlemusic.metrics import request_name
 
 FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded;charset=UTF-8'
 
+class IncompleteDownloadException(Exception):
+    """Exception for downloads that ended before receiving the whole file"""
+    pass
+
+def parse_content_range(headers):
+    """Return the (start, total) of a Content-Range header, or None"""
+    content_range = headers.getheader('Content-Range')
+    if not content_range or '/' not in content_range:
+        return None
+    byte_range, total = content_range.rsplit('/', 1)
+    try:
+        start = int(byte_range.split()[-1].split('-')[0])
+        return start, int(total)
+    except ValueError:
+        return None
+
+def get_total_size(headers, offset=0):
+    """
+    Return the full size of a (possibly partial) response body, or None if
+    the server didn't tell
+    """
+    content_range = parse_content_range(headers)
+    if content_range:
+        return content_range[1]
+    content_length = headers.getheader('Content-Length')
+    if content_length:
+        return offset + int(content_length.strip())
+    return None
+
 class CookieManager(cookielib.CookieJar):
     """Class to store and retrieve Cookies"""
     def __init__(self):
@@ -32,31 +69,49 @@ class MusicManagerRequest(object):
     """Class to emulate MusicManager requests"""
     USER_AGENT = 'Music Manager (1, 0, 37, 252 - Mac)'
     
-    def __init__(self, cookies):
+    def __init__(self, cookies, pool=None):
         self.cookies = cookies
+        self.pool = pool or ConnectionPool()
+        self.compression = CompressionHandler()
+        self.opener = build_opener(self.cookies, self.pool, self.compression)
+        # see googlemusic.metrics
+        self.metrics = None
 
     def request(self, url, body=None, headers=None):
         """Wrapper to make all requests"""
         headers = headers or {}
         if body:
             body = urllib.urlencode(body).encode('utf8')
-        
-        if 'User-Agent' not in headers:
-            headers['User-Agent'] = self.USER_AGENT
-
-        request = urllib2.Request(url, body, headers)
-        handler = urllib2.build_opener(
-            urllib2.HTTPCookieProcessor(self.cookies)
-        )
-        response = handler.open(request)
+        response = self.open(url, body, headers)
         result = response.read()
         response.close()
         return unicode(result, encoding='utf8')
 
+    def open(self, url, data=None, headers=None):
+        """
+        Send data (a byte string, POSTed if given) and return the response,
+        without reading it
+        """
+        request = self.prepare(url, data, headers)
+        if self.metrics:
+            return self.metrics.open(self.opener, request)
+        return self.opener.open(request)
+
+    def prepare(self, url, data=None, headers=None):
+        """Return the urllib2 Request of open(), without sending it"""
+        headers = headers or {}
+        if 'User-Agent' not in headers:
+            headers['User-Agent'] = self.USER_AGENT
+        return urllib2.Request(url, data, headers)
+
     def get_cookies(self):
         """Return the Cookie Manager object"""
         return self.cookies
-    
+
+    def get_pool(self):
+        """Return the Connection Pool object"""
+        return self.pool
+
 class WebRequest(object):
     """
     Class to mimic Web requests.
@@ -70,13 +125,44 @@ class WebRequest(object):
     DEFAULT_REFERER = 'https://play.google.com/music/listen'
     
     DOWNLOAD_CHUNK = 512 * 1024
+    DOWNLOAD_RETRIES = 5
+    DOWNLOAD_RETRY_DELAY = 1
+    # signed stream URLs that expired are rejected with one of these
+    EXPIRED_URL_CODES = (403, 404, 410)
+    # segmented downloads are disabled unless segments is greater than 1
+    DOWNLOAD_SEGMENTS = 1
+    DOWNLOAD_SEGMENT_SIZE = 4 * 1024 * 1024
     
-    def __init__(self, cookies):
+    def __init__(self, cookies, pool=None):
         self.debug = False
         self.cookies = cookies
+        self.segments = self.DOWNLOAD_SEGMENTS
+        self.segment_size = self.DOWNLOAD_SEGMENT_SIZE
+        self.pool = pool or ConnectionPool()
+        # see Client.set_compression
+        self.compression = CompressionHandler()
+        self.opener = build_opener(self.cookies, self.pool, self.compression)
+        # see Client.set_json_codec
+        self.codec = JSONCodec()
+        # see googlemusic.metrics
+        self.metrics = None
 
     def request(self, url, body=None, headers=None, xhr=False):
         """Wrapper to make all web requests."""
+        response = self.open(url, body, headers, xhr)
+        result = response.read()
+        response.close()
+        return unicode(result, encoding='utf8')
+
+    def open(self, url, body=None, headers=None, xhr=False):
+        """Make a web request and return the response, without reading it"""
+        return self.send(self.prepare(url, body, headers, xhr))
+
+    def prepare(self, url, body=None, headers=None, xhr=False):
+        """
+        Return the urllib2 Request of a web request, with the default headers,
+        without sending it
+        """
         headers = headers or {}
         if body:
             body = urllib.urlencode(body).encode('utf8')
@@ -97,51 +183,232 @@ class WebRequest(object):
             print ">>> Body: %s" % body
             print ">>> Headers: %s" % str(headers) 
         
-        request = urllib2.Request(url, body, headers)
-        handler = urllib2.build_opener(
-            urllib2.HTTPCookieProcessor(self.cookies)
-        )
+        return urllib2.Request(url, body, headers)
 
-        response = handler.open(request)
-        result = response.read()
-        response.close()
-        return unicode(result, encoding='utf8')
+    def send(self, request):
+        """Open a urllib2 Request, measuring it if metrics are enabled"""
+        if self.metrics:
+            return self.metrics.open(self.opener, request)
+        return self.opener.open(request)
 
     def xhr_json(self, url, body=None, headers=None):
         """Make an XHR request and return its result as JSON"""
-        return json.loads(self.request(url, body, headers, xhr=True))
+        return self.xhr_json_response(url, body, headers)[0]
+
+    def xhr_json_response(self, url, body=None, headers=None):
+        """
+        Make an XHR request and return its result as JSON along with the
+        response headers
+        """
+        response = self.open(url, body, headers, xhr=True)
+        try:
+            # decoded straight from the bytes, without a unicode copy
+            result = self.codec.loads(response.read())
+        finally:
+            response.close()
+        return result, response.info()
+
+    def xhr_json_items(self, url, key, body=None, headers=None):
+        """
+        Make an XHR request and return an iterator over the items of the array
+        found under key in the resulting JSON object, parsing them as they're
+        received
+        """
+        response = self.open(url, body, headers, xhr=True)
+        return self._iter_items(response, key)
+
+    @staticmethod
+    def _iter_items(response, key):
+        """Yield the items of an array in a JSON response, then close it"""
+        try:
+            for item in iter_array(response, key):
+                yield item
+        finally:
+            response.close()
     
-    def download_file(self, url, filename):
-        """Download a file to the specified location"""
+    def download_file(self, url, filename, progress=None, resolve_url=None,
+                      segments=None):
+        """
+        Download a file to the specified location.
+        The file is written to a journaled .part file and renamed once its
+        size matches the Content-Length. If the connection drops, the download
+        is resumed with a Range request; if the URL expired, resolve_url() is
+        called (when given) to get a fresh one. Interrupted downloads are also
+        resumed when downloading the same file again.
+        With more than one segment (see self.segments and self.segment_size)
+        the file is fetched as several byte ranges in parallel, as long as the
+        server supports ranges.
+        If given, progress(downloaded, total_size) is called after each chunk
+        """
+        segments = segments or self.segments
+        partial = PartialDownload(filename)
+        attempt = 0
+        while not partial.complete():
+            if attempt and self.metrics:
+                self.metrics.retry('http.' + request_name(url))
+            try:
+                if segments < 2 or not self._download_segments(
+                        url, partial, progress, segments):
+                    self._download_part(url, partial, progress)
+            except urllib2.HTTPError, error:
+                if error.code == 416:
+                    # the range we asked for doesn't exist anymore
+                    partial.reset()
+                elif attempt >= self.DOWNLOAD_RETRIES:
+                    raise
+                elif error.code in self.EXPIRED_URL_CODES and resolve_url:
+                    url = resolve_url()
+                elif error.code >= 500:
+                    time.sleep(self.DOWNLOAD_RETRY_DELAY * (attempt + 1))
+                else:
+                    raise
+            except (urllib2.URLError, socket.error, httplib.HTTPException,
+                    IncompleteDownloadException):
+                if attempt >= self.DOWNLOAD_RETRIES:
+                    raise
+                time.sleep(self.DOWNLOAD_RETRY_DELAY * (attempt + 1))
+            attempt += 1
+        partial.commit()
+        return True
+
+    def _download_part(self, url, partial, progress=None):
+        """Download what's missing from a partial download"""
+        offset = partial.offset
         headers = {
           'Referer': self.DEFAULT_REFERER,
-          'User-Agent': self.USER_AGENT
+          'User-Agent': self.USER_AGENT,
+          # sizes and offsets must refer to the file itself
+          'Accept-Encoding': 'identity'
         }
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
         request = urllib2.Request(url, None, headers)
-        handler = urllib2.build_opener(
-            urllib2.HTTPCookieProcessor(self.cookies)
-        )
-        source = handler.open(request)
-        
-        downloaded = 0
-        total_size = 0
-        content_length = source.info().getheader('Content-Length')
-        if content_length:
-            total_size = int(content_length.strip())
-
-        with open(filename, 'wb') as dest:
-            while True:
-                chunk = source.read(self.DOWNLOAD_CHUNK)
-                if not chunk:
-                    break
-                downloaded += len(chunk)
-                dest.write(chunk)
-                if total_size and self.debug:
-                    progress = int((float(downloaded) / total_size) * 100)
-                    print '%s%%' % progress
+        source = self.send(request)
+        try:
+            if offset and source.code != 206:
+                # the server ignored the Range header, start over
+                offset = 0
+            total_size = get_total_size(source.info(), offset)
+            if not offset or total_size != partial.size:
+                offset = 0
+                partial.reset(total_size)
+
+            downloaded = offset
+            with partial.open(offset) as dest:
+                while True:
+                    chunk = source.read(self.DOWNLOAD_CHUNK)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    dest.flush()
+                    partial.mark(downloaded, downloaded + len(chunk))
+                    downloaded += len(chunk)
+                    if progress:
+                        progress(downloaded, total_size or 0)
+                    if total_size and self.debug:
+                        percent = int((float(downloaded) / total_size) * 100)
+                        print '%s%%' % percent
+        finally:
+            source.close()
+
+        if total_size is None:
+            # no Content-Length, trust the server closed the stream at the end
+            partial.size = downloaded
+            partial.save()
+        elif downloaded != total_size:
+            raise IncompleteDownloadException(
+                'Got %d of %d bytes' % (downloaded, total_size))
+
+    def _download_segments(self, url, partial, progress, segments):
+        """
+        Download what's missing from a partial download as byte ranges
+        fetched in parallel.
+        Return False, without downloading anything, if the server doesn't
+        support ranges or doesn't tell the file size.
+        """
+        try:
+            source = self.open_range(url, 0, 0)
+        except urllib2.HTTPError, error:
+            if error.code == 416:
+                return False
+            raise
+        content_range = parse_content_range(source.info())
+        source.close()
+        if source.code != 206 or not content_range:
+            return False
+
+        total_size = content_range[1]
+        if partial.size != total_size or not os.path.exists(partial.part):
+            partial.preallocate(total_size)
+        segment_size = self.segment_size or \
+            -(-total_size // segments) or 1
+        ranges = partial.missing(segment_size)
+        if not ranges:
+            if partial.complete():
+                return True
+            # the journal doesn't match the file, don't trust either
+            partial.reset()
+            raise IncompleteDownloadException(
+                'Nothing missing from an incomplete download')
+
+        lock = threading.Lock()
+        def segment_done(start, end):
+            partial.mark(start, end)
+            if progress:
+                with lock:
+                    progress(partial.downloaded, total_size)
+
+        with WorkerPool(min(segments, len(ranges))) as pool:
+            tasks = [pool.submit(self._download_segment, url, partial,
+                                 start, end, segment_done)
+                     for start, end in ranges]
+        for task in tasks:
+            task.result()
         return True
-    
+
+    def _download_segment(self, url, partial, start, end, segment_done):
+        """Download the [start, end) byte range into the .part file"""
+        source = self.open_range(url, start, end - 1)
+        try:
+            content_range = parse_content_range(source.info())
+            if source.code != 206 or not content_range or \
+                    content_range[0] != start:
+                raise IncompleteDownloadException(
+                    'Range %d-%d not honored' % (start, end - 1))
+            position = start
+            with partial.open_at(start) as dest:
+                while position < end:
+                    chunk = source.read(min(self.DOWNLOAD_CHUNK,
+                                            end - position))
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    dest.flush()
+                    segment_done(position, position + len(chunk))
+                    position += len(chunk)
+        finally:
+            source.close()
+        if position != end:
+            raise IncompleteDownloadException(
+                'Got %d of %d bytes' % (position - start, end - start))
+
+    def open_range(self, url, first, last=None):
+        """
+        Request the given byte range (both ends included) of a URL, or
+        everything from first if last is None
+        """
+        headers = {
+          'Referer': self.DEFAULT_REFERER,
+          'User-Agent': self.USER_AGENT,
+          'Range': 'bytes=%d-%s' % (first, '' if last is None else last)
+        }
+        return self.send(urllib2.Request(url, None, headers))
+
     def get_cookies(self):
         """Return the Cookie Manager object"""
         return self.cookies
+
+    def get_pool(self):
+        """Return the Connection Pool object"""
+        return self.pool
  
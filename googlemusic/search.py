@@ -0,0 +1,358 @@
+"""
+Local search
+
+An in-memory inverted index over the songs and albums the client has seen,
+with prefix and fuzzy matching, so searches can be answered without going to
+the server.
+"""
+__author__ = "Tirino"
+
+import heapq
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from operator import itemgetter
+
+from googlemusic.cache import LRUCache
+from googlemusic.model import Album
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# match quality multipliers
+EXACT = 1.0
+PREFIX = 0.7
+FUZZY = 0.4
+# tokens shorter than this are never fuzzy matched
+FUZZY_MIN_LENGTH = 4
+# a short prefix matches too many words: only the most common ones are used
+PREFIX_EXPANSIONS = 32
+# the expansions of prefixes up to this long are kept until the index changes
+CACHED_PREFIX_LENGTH = 3
+
+# tokenize() remembers the words of this many (repeated) strings
+TOKEN_CACHE_SIZE = 100000
+_token_cache = {}
+
+def normalize(text):
+    """Lowercase text and strip its accents"""
+    if not text:
+        return u''
+    if not isinstance(text, unicode):
+        text = unicode(text, 'utf8', 'replace')
+    try:
+        text.encode('ascii')
+        return text.lower()
+    except UnicodeError:
+        pass
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text):
+    """Split text in normalized words"""
+    tokens = _token_cache.get(text)
+    if tokens is None:
+        tokens = TOKEN_RE.findall(normalize(text))
+        if len(_token_cache) >= TOKEN_CACHE_SIZE:
+            _token_cache.clear()
+        _token_cache[text] = tokens
+    return tokens
+
+def deletes(token):
+    """Return the variants of token with one character removed"""
+    return set(token[:i] + token[i + 1:] for i in xrange(len(token)))
+
+
+class InvertedIndex(object):
+    """
+    Maps words to the documents (any hashable key) whose fields contain them.
+    Each field has a weight, and a document keeps the best weight of the
+    fields a word appears in. The documents of a word are grouped by weight,
+    so the best matches can be found without scoring every match.
+    """
+    def __init__(self):
+        # word -> {weight: set of documents}
+        self.postings = {}
+        # word -> number of documents
+        self.sizes = {}
+        self.documents = {}
+        # one-deletion variants of every word, for fuzzy matching
+        self.variants = {}
+        self.sorted_tokens = None
+        # short prefix -> its best completions
+        self.completions = {}
+
+    def add(self, key, fields):
+        """Index a document given a list of (text, weight) fields"""
+        if key in self.documents:
+            self.remove(key)
+        self.completions.clear()
+        weights = {}
+        for text, weight in fields:
+            for token in tokenize(text):
+                if weights.get(token, 0) < weight:
+                    weights[token] = weight
+        self.documents[key] = weights.items()
+        for token, weight in weights.iteritems():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                self.sizes[token] = 0
+                self._add_token(token)
+            keys = posting.get(weight)
+            if keys is None:
+                keys = posting[weight] = set()
+            keys.add(key)
+            self.sizes[token] += 1
+
+    def remove(self, key):
+        """Remove a document from the index"""
+        self.completions.clear()
+        for token, weight in self.documents.pop(key, ()):
+            posting = self.postings[token]
+            keys = posting[weight]
+            keys.discard(key)
+            if not keys:
+                del posting[weight]
+            self.sizes[token] -= 1
+            if not posting:
+                del self.postings[token]
+                del self.sizes[token]
+                self._remove_token(token)
+
+    def _add_token(self, token):
+        """Register a new word"""
+        self.sorted_tokens = None
+        if len(token) >= FUZZY_MIN_LENGTH:
+            for variant in deletes(token):
+                self.variants.setdefault(variant, set()).add(token)
+
+    def _remove_token(self, token):
+        """Forget a word that no document contains anymore"""
+        self.sorted_tokens = None
+        if len(token) >= FUZZY_MIN_LENGTH:
+            for variant in deletes(token):
+                tokens = self.variants[variant]
+                tokens.discard(token)
+                if not tokens:
+                    del self.variants[variant]
+
+    def prefixed(self, prefix):
+        """Return the words that start with prefix (excluding prefix)"""
+        if self.sorted_tokens is None:
+            self.sorted_tokens = sorted(self.postings)
+        tokens = self.sorted_tokens
+        result = []
+        position = bisect_left(tokens, prefix)
+        while position < len(tokens) and tokens[position].startswith(prefix):
+            if tokens[position] != prefix:
+                result.append(tokens[position])
+            position += 1
+        return result
+
+    def similar(self, token):
+        """Return the words at one edit (insert, delete, replace) of token"""
+        if len(token) < FUZZY_MIN_LENGTH - 1:
+            return set()
+        candidates = set(self.variants.get(token, ()))
+        for variant in deletes(token):
+            if variant in self.postings:
+                candidates.add(variant)
+            candidates.update(self.variants.get(variant, ()))
+        candidates.discard(token)
+        return candidates
+
+    def expand(self, token, prefix=True, fuzzy=True):
+        """Return the (word, quality) pairs a query word matches"""
+        words = []
+        if token in self.postings:
+            words.append((token, EXACT))
+        if prefix:
+            completions = self.completions.get(token)
+            if completions is None:
+                completions = self.prefixed(token)
+                if len(completions) > PREFIX_EXPANSIONS:
+                    completions = heapq.nlargest(PREFIX_EXPANSIONS,
+                                                 completions,
+                                                 key=self.sizes.get)
+                if len(token) <= CACHED_PREFIX_LENGTH:
+                    self.completions[token] = completions
+            words.extend((word, PREFIX) for word in completions)
+        if fuzzy:
+            words.extend((word, FUZZY) for word in self.similar(token))
+        return words
+
+    def search(self, query, prefix=True, fuzzy=True):
+        """
+        Return a dict of document -> score for the documents matching every
+        word of the query
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return {}
+        expansions = [self.expand(token, prefix, fuzzy) for token in tokens]
+        # start with the most selective words so the candidates shrink fast
+        expansions.sort(key=lambda words: sum(self.sizes[word]
+                                              for word, quality in words))
+        result = None
+        for words in expansions:
+            result = self._score(words, result)
+            if not result:
+                return {}
+        return result
+
+    def top(self, query, limit, prefix=True, fuzzy=True):
+        """
+        Return the (document, score) pairs of the limit best documents
+        matching every word of the query, best first
+        """
+        tokens = tokenize(query)
+        if len(tokens) != 1:
+            return heapq.nlargest(limit, self.search(query, prefix,
+                                                     fuzzy).iteritems(),
+                                  key=itemgetter(1))
+        # a single word (e.g. autocomplete): walk its documents from the
+        # best score down and stop at limit, instead of scoring them all
+        ranked = []
+        seen = set()
+        if limit <= 0:
+            return ranked
+        for score, keys in self._levels(self.expand(tokens[0], prefix,
+                                                    fuzzy)):
+            for key in keys:
+                if key not in seen:
+                    seen.add(key)
+                    ranked.append((key, score))
+                    if len(ranked) == limit:
+                        return ranked
+        return ranked
+
+    def _levels(self, words):
+        """
+        Return the (score, documents) groups of the given (word, quality)
+        pairs, best score first
+        """
+        levels = [(weight * quality, keys) for word, quality in words
+                  for weight, keys in self.postings[word].iteritems()]
+        levels.sort(key=itemgetter(0), reverse=True)
+        return levels
+
+    def _score(self, words, candidates):
+        """
+        Score the documents containing any of the given words, keeping only
+        the candidates (and adding their scores) if there are any
+        """
+        scores = {}
+        # best scores first, so the first score of a document is its best
+        for score, keys in self._levels(words):
+            if candidates is None:
+                matches = keys
+            elif len(keys) <= len(candidates):
+                matches = (key for key in keys if key in candidates)
+            else:
+                matches = (key for key in candidates if key in keys)
+            for key in matches:
+                if key not in scores:
+                    scores[key] = score
+        if candidates is not None:
+            for key in scores:
+                scores[key] += candidates[key]
+        return scores
+
+
+class SearchIndex(object):
+    """
+    Local index of Song and Album objects.
+    Songs are indexed by title, name, artist, album and album artist; albums
+    (built out of the songs) by name, artist and album artist.
+    """
+    SONG_FIELDS = (('title', 3), ('name', 3), ('artist', 2), ('album', 1),
+                   ('album_artist', 1))
+    ALBUM_FIELDS = (('name', 3), ('artist', 2), ('album_artist', 2))
+    # recent results are kept until the index changes (e.g. autocomplete
+    # asking for the same prefixes over and over)
+    RESULTS_CACHE_SIZE = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = LRUCache(self.RESULTS_CACHE_SIZE)
+        self.songs = {}
+        self.albums = {}
+        self.album_songs = {}
+        # song id -> key of the album it was indexed under: shared Songs are
+        # updated in place, so the album can't be read back from them
+        self.song_albums = {}
+        self.song_index = InvertedIndex()
+        self.album_index = InvertedIndex()
+
+    def add_songs(self, songs):
+        """Index (or re-index) the given Song objects"""
+        with self.lock:
+            for song in songs:
+                self._add_song(song)
+            self.results.clear()
+
+    def remove_songs(self, song_ids):
+        """Remove songs from the index"""
+        with self.lock:
+            for song_id in song_ids:
+                self._remove_song(song_id)
+            self.results.clear()
+
+    def _add_song(self, song):
+        """Index a single song and its album"""
+        if song.id in self.songs:
+            self._remove_song(song.id)
+        self.songs[song.id] = song
+        self.song_index.add(song.id, [(getattr(song, field), weight)
+                                      for field, weight in self.SONG_FIELDS])
+        if not song.album:
+            return
+        album_key = (song.album, song.album_artist or song.artist)
+        self.song_albums[song.id] = album_key
+        if album_key not in self.albums:
+            album = Album({'albumName': song.album, 'artistName': song.artist,
+                           'albumArtist': song.album_artist})
+            album.artwork_url = song.artwork_url
+            self.albums[album_key] = album
+            self.album_index.add(album_key, [
+                (getattr(album, field), weight)
+                for field, weight in self.ALBUM_FIELDS])
+        self.album_songs.setdefault(album_key, set()).add(song.id)
+
+    def _remove_song(self, song_id):
+        """Remove a single song, and its album if it has no songs left"""
+        song = self.songs.pop(song_id, None)
+        if song is None:
+            return
+        self.song_index.remove(song_id)
+        album_key = self.song_albums.pop(song_id, None)
+        songs = self.album_songs.get(album_key)
+        if songs is not None:
+            songs.discard(song_id)
+            if not songs:
+                del self.album_songs[album_key]
+                del self.albums[album_key]
+                self.album_index.remove(album_key)
+
+    def search(self, query, limit=50, prefix=True, fuzzy=True):
+        """
+        Return a dict with the best Albums and Songs matching every word of
+        the query, in the same format as Client.search
+        """
+        cache_key = (query, limit, prefix, fuzzy)
+        with self.lock:
+            result = self.results.get(cache_key)
+            if result is None:
+                songs = self.song_index.top(query, limit, prefix, fuzzy)
+                albums = self.album_index.top(query, limit, prefix, fuzzy)
+                result = {
+                  'Albums': [self.albums[key] for key, score in albums],
+                  'Songs': [self.songs[key] for key, score in songs]
+                }
+                self.results.set(cache_key, result)
+        return {'Albums': list(result['Albums']),
+                'Songs': list(result['Songs'])}
+
+    def __len__(self):
+        return len(self.songs)
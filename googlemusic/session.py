@@ -0,0 +1,66 @@
+"""
+Google Music session persistence
+
+Save an authenticated session (auth tokens, cookies and session id) to a
+file, so new processes can reuse it instead of logging in again.
+"""
+__author__ = "Tirino"
+
+import cookielib
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic.utils import write_file
+
+SESSION_VERSION = 1
+
+# cookielib.Cookie constructor arguments, in order
+COOKIE_FIELDS = ('version', 'name', 'value', 'port', 'port_specified',
+                 'domain', 'domain_specified', 'domain_initial_dot', 'path',
+                 'path_specified', 'secure', 'expires', 'discard', 'comment',
+                 'comment_url', 'rfc2109')
+
+def dump_cookies(cookies):
+    """Return the (unexpired) cookies of a cookie jar as a list of dicts"""
+    result = []
+    now = time.time()
+    for cookie in cookies:
+        if cookie.is_expired(now):
+            continue
+        data = dict((field, getattr(cookie, field))
+                    for field in COOKIE_FIELDS)
+        data['rest'] = cookie._rest
+        result.append(data)
+    return result
+
+def load_cookies(cookies, cookies_data):
+    """Add the cookies returned by dump_cookies to a cookie jar"""
+    now = time.time()
+    for data in cookies_data:
+        args = [data.get(field) for field in COOKIE_FIELDS[:-1]]
+        cookie = cookielib.Cookie(rest=data.get('rest') or {},
+                                  rfc2109=data.get('rfc2109', False), *args)
+        if not cookie.is_expired(now):
+            cookies.set_cookie(cookie)
+
+def save_session(path, data):
+    """
+    Write session data to path, readable by its owner only (it contains the
+    authentication tokens)
+    """
+    data = dict(data, version=SESSION_VERSION, saved=time.time())
+    write_file(path, json.dumps(data), 0600)
+
+def load_session(path):
+    """Return the session data saved in path, or None if there's none"""
+    try:
+        with open(path, 'rb') as session_file:
+            data = json.loads(session_file.read())
+    except (IOError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != SESSION_VERSION:
+        return None
+    return data
@@ -0,0 +1,294 @@
+"""
+Google Music local library store
+
+A SQLite snapshot of the user's playlists and songs. Syncing compares the
+server's playlists with the snapshot and only writes what changed, and
+queries are answered locally.
+"""
+__author__ = "Tirino"
+
+import sqlite3
+import threading
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# song fields (as returned by the server) kept in the store
+SONG_FIELDS = ('id', 'name', 'title', 'artist', 'album', 'albumArtist',
+               'track', 'albumArtUrl')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playlists (
+  id TEXT PRIMARY KEY,
+  title TEXT,
+  position INTEGER
+);
+CREATE TABLE IF NOT EXISTS songs (
+  id TEXT PRIMARY KEY,
+  data TEXT
+);
+CREATE TABLE IF NOT EXISTS playlist_songs (
+  playlist_id TEXT,
+  position INTEGER,
+  song_id TEXT,
+  PRIMARY KEY (playlist_id, position)
+);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+'''
+
+def song_record(song_data):
+    """Return the part of a song's data kept in the store"""
+    return dict((field, song_data[field]) for field in SONG_FIELDS
+                if field in song_data)
+
+def playlist_id_of(playlist_data):
+    """Return the id of a playlist's data"""
+    if 'playlistId' in playlist_data:
+        return str(playlist_data['playlistId'])
+    return str(playlist_data['id'])
+
+
+class SyncResult(object):
+    """What changed in the library since the last sync"""
+    def __init__(self):
+        self.added = []
+        self.renamed = []
+        self.deleted = []
+        self.changed = []
+        self.added_songs = []
+        self.changed_songs = []
+        self.removed_songs = []
+
+    def __nonzero__(self):
+        return any([self.added, self.renamed, self.deleted, self.changed,
+                    self.added_songs, self.changed_songs, self.removed_songs])
+
+    def __str__(self):
+        return ('playlists: %d added, %d renamed, %d deleted, %d changed; '
+                'songs: %d added, %d changed, %d removed') % (
+            len(self.added), len(self.renamed), len(self.deleted),
+            len(self.changed), len(self.added_songs),
+            len(self.changed_songs), len(self.removed_songs))
+
+
+class LibraryStore(object):
+    """SQLite snapshot of the user's library"""
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(playlists)')]
+        if 'position' not in columns:
+            # stores created before playlists had a position
+            with self.db:
+                self.db.execute(
+                    'ALTER TABLE playlists ADD COLUMN position INTEGER')
+
+    def close(self):
+        """Close the database"""
+        with self.lock:
+            self.db.close()
+
+    # Sync #
+
+    def apply(self, playlists_data):
+        """
+        Bring the snapshot up to date with the given playlists (as returned by
+        Protocol.get_all_playlists) and return a SyncResult with the changes
+        """
+        result = SyncResult()
+        with self.lock:
+            with self.db:
+                playlists = dict(
+                    (playlist_id, (title, position))
+                    for playlist_id, title, position in self.db.execute(
+                        'SELECT id, title, position FROM playlists'))
+                songs = dict(self.db.execute('SELECT id, data FROM songs'))
+                seen_songs = set()
+                for position, playlist_data in enumerate(playlists_data):
+                    playlist_id = playlist_id_of(playlist_data)
+                    self._apply_playlist(playlist_id, position, playlist_data,
+                                         playlists, result)
+                    for song_data in playlist_data.get('playlist', []):
+                        song_id = str(song_data['id'])
+                        if song_id not in seen_songs:
+                            seen_songs.add(song_id)
+                            self._apply_song(song_id, song_data, songs,
+                                             result)
+                for playlist_id in playlists:
+                    result.deleted.append(str(playlist_id))
+                    self._delete_playlist(playlist_id)
+                for song_id in songs:
+                    if song_id not in seen_songs:
+                        result.removed_songs.append(str(song_id))
+                        self.db.execute('DELETE FROM songs WHERE id = ?',
+                                        (song_id,))
+                self.db.execute(
+                    'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                    ('last_sync', repr(time.time())))
+        return result
+
+    def _apply_playlist(self, playlist_id, position, playlist_data,
+                        playlists, result):
+        """Insert or update a playlist and its list of songs"""
+        title = playlist_data['title']
+        added = playlist_id not in playlists
+        if added:
+            result.added.append(playlist_id)
+            self.db.execute('INSERT INTO playlists VALUES (?, ?, ?)',
+                            (playlist_id, title, position))
+        else:
+            stored_title, stored_position = playlists.pop(playlist_id)
+            if stored_title != title:
+                result.renamed.append(playlist_id)
+            if (stored_title, stored_position) != (title, position):
+                self.db.execute(
+                    'UPDATE playlists SET title = ?, position = ? '
+                    'WHERE id = ?', (title, position, playlist_id))
+
+        song_ids = [str(song['id'])
+                    for song in playlist_data.get('playlist', [])]
+        stored_ids = [row[0] for row in self.db.execute(
+            'SELECT song_id FROM playlist_songs WHERE playlist_id = ? '
+            'ORDER BY position', (playlist_id,))]
+        if song_ids != stored_ids:
+            if not added:
+                result.changed.append(playlist_id)
+            self._set_playlist_songs(playlist_id, song_ids)
+
+    def _apply_song(self, song_id, song_data, songs, result):
+        """Insert or update a song"""
+        data = json.dumps(song_record(song_data), sort_keys=True)
+        stored = songs.get(song_id)
+        if stored == data:
+            return
+        if stored is None:
+            result.added_songs.append(song_id)
+        else:
+            result.changed_songs.append(song_id)
+        self.db.execute('INSERT OR REPLACE INTO songs VALUES (?, ?)',
+                        (song_id, data))
+
+    def _set_playlist_songs(self, playlist_id, song_ids):
+        """Replace the list of songs of a playlist"""
+        self.db.execute('DELETE FROM playlist_songs WHERE playlist_id = ?',
+                        (playlist_id,))
+        self.db.executemany(
+            'INSERT INTO playlist_songs VALUES (?, ?, ?)',
+            [(playlist_id, position, song_id)
+             for position, song_id in enumerate(song_ids)])
+
+    def _delete_playlist(self, playlist_id):
+        """Remove a playlist and its list of songs"""
+        self.db.execute('DELETE FROM playlists WHERE id = ?', (playlist_id,))
+        self.db.execute('DELETE FROM playlist_songs WHERE playlist_id = ?',
+                        (playlist_id,))
+
+    # Local changes #
+
+    def add_playlist(self, playlist_id, title, songs_data=None):
+        """
+        Record a playlist created through the client, after the others, with
+        the given songs' data (songs already in the store are kept as they
+        are)
+        """
+        songs_data = songs_data or []
+        with self.lock:
+            with self.db:
+                position, = self.db.execute(
+                    'SELECT COALESCE(MAX(position) + 1, 0) FROM playlists '
+                    'WHERE id != ?', (playlist_id,)).fetchone()
+                self.db.execute(
+                    'INSERT OR REPLACE INTO playlists VALUES (?, ?, ?)',
+                    (playlist_id, title, position))
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO songs VALUES (?, ?)',
+                    [(str(song_data['id']),
+                      json.dumps(song_record(song_data), sort_keys=True))
+                     for song_data in songs_data])
+                self._set_playlist_songs(
+                    playlist_id,
+                    [str(song_data['id']) for song_data in songs_data])
+
+    def rename_playlist(self, playlist_id, title):
+        """Record a playlist renamed through the client"""
+        with self.lock:
+            with self.db:
+                self.db.execute('UPDATE playlists SET title = ? WHERE id = ?',
+                                (title, playlist_id))
+
+    def delete_playlist(self, playlist_id):
+        """Record a playlist deleted through the client"""
+        with self.lock:
+            with self.db:
+                self._delete_playlist(playlist_id)
+
+    # Queries #
+
+    def last_sync(self):
+        """Return the timestamp of the last sync, or None"""
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                                  ('last_sync',)).fetchone()
+        if row:
+            return float(row[0])
+        return None
+
+    def get_playlists(self):
+        """
+        Return every playlist's data, with its songs, in the same format as
+        Protocol.get_all_playlists
+        """
+        with self.lock:
+            playlists = self.db.execute(
+                'SELECT id, title FROM playlists '
+                'ORDER BY position, rowid').fetchall()
+            entries = self.db.execute(
+                'SELECT playlist_songs.playlist_id, songs.data '
+                'FROM playlist_songs JOIN songs '
+                'ON songs.id = playlist_songs.song_id '
+                'ORDER BY playlist_songs.playlist_id, '
+                'playlist_songs.position').fetchall()
+        songs = {}
+        for playlist_id, data in entries:
+            songs.setdefault(playlist_id, []).append(json.loads(data))
+        return [{'playlistId': playlist_id, 'title': title,
+                 'playlist': songs.get(playlist_id, [])}
+                for playlist_id, title in playlists]
+
+    def get_playlist(self, playlist_id):
+        """Return a playlist's data, with its songs, or None"""
+        with self.lock:
+            row = self.db.execute('SELECT title FROM playlists WHERE id = ?',
+                                  (playlist_id,)).fetchone()
+            if not row:
+                return None
+            songs = self.db.execute(
+                'SELECT songs.data FROM playlist_songs JOIN songs '
+                'ON songs.id = playlist_songs.song_id '
+                'WHERE playlist_songs.playlist_id = ? '
+                'ORDER BY playlist_songs.position', (playlist_id,)).fetchall()
+        return {'playlistId': playlist_id, 'title': row[0],
+                'playlist': [json.loads(data) for data, in songs]}
+
+    def get_song(self, song_id):
+        """Return a song's data, or None"""
+        with self.lock:
+            row = self.db.execute('SELECT data FROM songs WHERE id = ?',
+                                  (song_id,)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def get_songs(self):
+        """Return the data of every song in the library"""
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM songs').fetchall()
+        return [json.loads(data) for data, in rows]
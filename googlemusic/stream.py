@@ -0,0 +1,481 @@
+"""
+Song streaming
+
+Seekable file-like streams of songs, filled by a background thread with
+range requests, so playback can start as soon as the first bytes arrive,
+and a queue that prefetches the stream URLs and first bytes of the songs
+coming next.
+"""
+__author__ = "Tirino"
+
+import httplib
+import socket
+import sys
+import threading
+import time
+import urllib2
+from collections import OrderedDict, deque
+
+from googlemusic.concurrency import Task, WorkerPool
+from googlemusic.request import IncompleteDownloadException, get_total_size
+
+class SongStream(object):
+    """
+    Read-only, seekable file-like object with the mp3 file of a song.
+    A background thread reads ahead of the current position, keeping up to
+    buffer_size bytes, and reads block until the bytes they ask for arrive.
+    Seeks within the buffered bytes are free; other seeks drop the buffer
+    and start a range request at the new position. `head` (the first bytes
+    of the file, e.g. prefetched by a SongStreamer) is kept and served from
+    memory, so the stream holds at most len(head) + buffer_size + chunk_size
+    bytes. Expired URLs are refreshed with resolve_url(), and transient
+    errors retried like WebRequest.download_file does; once the retries run
+    out, reads raise the last error.
+    """
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, web, url, resolve_url=None, head='', size=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.web = web
+        self.url = url
+        self.resolve_url = resolve_url
+        self.head = head
+        self.size = size
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.condition = threading.Condition()
+        self.position = 0
+        # buffered bytes, ending at the file offset `end`
+        self.chunks = deque()
+        self.buffered = 0
+        self.end = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+        # bumped on every restart, so stale fill threads stop
+        self.generation = 0
+        self.requests = 0
+        with self.condition:
+            self._restart(len(head))
+
+    # File interface #
+    def read(self, size=-1):
+        """
+        Read size bytes (or up to the end of the file, if size is negative),
+        waiting for them to arrive. Return fewer only at the end of the file.
+        """
+        parts = []
+        with self.condition:
+            self._check_open()
+            while size < 0 or size > 0:
+                if self.position < len(self.head):
+                    end = len(self.head) if size < 0 else \
+                        self.position + size
+                    data = self.head[self.position:end]
+                else:
+                    data = self._take(size)
+                    if not data:
+                        break
+                self.position += len(data)
+                if size > 0:
+                    size -= len(data)
+                parts.append(data)
+        return ''.join(parts)
+
+    def seek(self, offset, whence=0):
+        """Move to offset, relative to the start, position or end (0, 1, 2)"""
+        with self.condition:
+            self._check_open()
+            if whence == 1:
+                offset += self.position
+            elif whence == 2:
+                offset += self._wait_size()
+            if offset < 0:
+                raise IOError('Invalid seek offset: %d' % offset)
+            head = len(self.head)
+            start = self.end - self.buffered
+            if offset >= head and start <= offset <= self.end:
+                self._drop(offset - start)
+            elif offset < head:
+                # the head is in memory, keep reading ahead right after it
+                if start != head:
+                    self._restart(head)
+            else:
+                self._restart(offset)
+            self.position = offset
+
+    def tell(self):
+        """Return the current position"""
+        return self.position
+
+    def get_size(self):
+        """Return the size of the file, waiting for the server to tell it"""
+        with self.condition:
+            return self._wait_size()
+
+    def close(self):
+        """Stop reading ahead and drop the buffer"""
+        with self.condition:
+            self.closed = True
+            self.generation += 1
+            self.chunks.clear()
+            self.buffered = 0
+            self.condition.notify_all()
+
+    def readable(self):
+        """Streams can be read"""
+        return True
+
+    def seekable(self):
+        """Streams can be seeked"""
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Buffer (called with the condition held) #
+    def _check_open(self):
+        """Raise ValueError if the stream was closed"""
+        if self.closed:
+            raise ValueError('I/O operation on closed stream')
+
+    def _take(self, size):
+        """
+        Remove and return up to size bytes (all of the first chunk, if size
+        is negative) from the buffer, waiting for them. Return '' at the end
+        """
+        while not self.buffered:
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+            if self.eof:
+                return ''
+            self._check_open()
+            self.condition.wait()
+        chunk = self.chunks[0]
+        if 0 < size < len(chunk):
+            self.chunks[0] = chunk[size:]
+            chunk = chunk[:size]
+        else:
+            self.chunks.popleft()
+        self.buffered -= len(chunk)
+        self.condition.notify_all()
+        return chunk
+
+    def _drop(self, count):
+        """Discard count bytes from the start of the buffer"""
+        while count:
+            chunk = self.chunks[0]
+            if count < len(chunk):
+                self.chunks[0] = chunk[count:]
+                self.buffered -= count
+                break
+            self.chunks.popleft()
+            self.buffered -= len(chunk)
+            count -= len(chunk)
+        self.condition.notify_all()
+
+    def _wait_size(self):
+        """Return the size of the file, waiting for the first response"""
+        while self.size is None:
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+            if self.eof:
+                # the server didn't tell, but the whole file arrived
+                return self.end
+            self._check_open()
+            self.condition.wait()
+        return self.size
+
+    def _restart(self, offset):
+        """Drop the buffer and start reading ahead from offset"""
+        self.generation += 1
+        self.chunks.clear()
+        self.buffered = 0
+        self.end = offset
+        self.eof = False
+        self.error = None
+        self.condition.notify_all()
+        if self.size is not None and offset >= self.size:
+            self.eof = True
+            return
+        thread = threading.Thread(target=self._fill,
+                                  args=(self.generation, offset))
+        thread.daemon = True
+        thread.start()
+
+    def _current(self, generation):
+        """Return True if a fill thread of that generation should go on"""
+        return generation == self.generation and not self.closed
+
+    # Fill thread #
+    def _fill(self, generation, offset):
+        """Read the file from offset into the buffer, until the end"""
+        attempt = 0
+        while True:
+            source = None
+            try:
+                with self.condition:
+                    if not self._current(generation):
+                        return
+                    self.requests += 1
+                source = self.web.open_range(self.url, offset)
+                if offset and source.code != 206:
+                    # the server ignored the Range header
+                    self._skip(source, offset)
+                size = get_total_size(source.info(),
+                                      offset if source.code == 206 else 0)
+                with self.condition:
+                    if size is not None and self._current(generation):
+                        self.size = size
+                        self.condition.notify_all()
+                while True:
+                    with self.condition:
+                        while self.buffered >= self.buffer_size and \
+                                self._current(generation):
+                            self.condition.wait()
+                        if not self._current(generation):
+                            return
+                    chunk = source.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    with self.condition:
+                        if not self._current(generation):
+                            return
+                        self.chunks.append(chunk)
+                        self.buffered += len(chunk)
+                        self.end += len(chunk)
+                        self.condition.notify_all()
+                    offset += len(chunk)
+                    attempt = 0
+                if size is not None and offset < size:
+                    raise IncompleteDownloadException(
+                        'Got %d of %d bytes' % (offset, size))
+                with self.condition:
+                    if self._current(generation):
+                        self.eof = True
+                        self.condition.notify_all()
+                return
+            except urllib2.HTTPError, error:
+                # release its connection
+                error.close()
+                if error.code == 416:
+                    # nothing left after offset
+                    self._finish(generation)
+                    return
+                elif attempt >= self.web.DOWNLOAD_RETRIES:
+                    self._fail(generation)
+                    return
+                elif error.code in self.web.EXPIRED_URL_CODES and \
+                        self.resolve_url:
+                    try:
+                        self.url = self.resolve_url()
+                    except Exception:
+                        self._fail(generation)
+                        return
+                elif error.code >= 500:
+                    time.sleep(self.web.DOWNLOAD_RETRY_DELAY * (attempt + 1))
+                else:
+                    self._fail(generation)
+                    return
+            except (urllib2.URLError, socket.error, httplib.HTTPException,
+                    IncompleteDownloadException):
+                if attempt >= self.web.DOWNLOAD_RETRIES:
+                    self._fail(generation)
+                    return
+                time.sleep(self.web.DOWNLOAD_RETRY_DELAY * (attempt + 1))
+            except Exception:
+                # anything else (e.g. a bad Content-Length) would otherwise
+                # end the thread and leave the reads waiting forever
+                self._fail(generation)
+                return
+            finally:
+                if source is not None:
+                    source.close()
+            attempt += 1
+
+    def _skip(self, source, count):
+        """Read and discard count bytes of a response"""
+        while count:
+            data = source.read(min(count, self.chunk_size))
+            if not data:
+                raise IncompleteDownloadException(
+                    'Response ended before the requested offset')
+            count -= len(data)
+
+    def _finish(self, generation):
+        """Mark the end of the file as reached"""
+        with self.condition:
+            if self._current(generation):
+                self.eof = True
+                self.condition.notify_all()
+
+    def _fail(self, generation):
+        """Make reads raise the exception being handled"""
+        with self.condition:
+            if self._current(generation):
+                self.error = sys.exc_info()
+                self.condition.notify_all()
+
+
+class SongStreamer(object):
+    """
+    Opens SongStreams through a Protocol and a WebRequest (so it uses the
+    client's keep-alive connections), and prefetches the stream URL and the
+    first head_size bytes of songs about to be played, up to `workers` at a
+    time. At most max_prefetched heads are kept (the oldest are dropped).
+    """
+    DEFAULT_WORKERS = 2
+    DEFAULT_HEAD_SIZE = 256 * 1024
+    DEFAULT_MAX_PREFETCHED = 4
+
+    def __init__(self, protocol, web, workers=DEFAULT_WORKERS,
+                 buffer_size=SongStream.DEFAULT_BUFFER_SIZE,
+                 head_size=DEFAULT_HEAD_SIZE,
+                 max_prefetched=DEFAULT_MAX_PREFETCHED):
+        self.protocol = protocol
+        self.web = web
+        self.buffer_size = buffer_size
+        self.head_size = head_size
+        self.max_prefetched = max_prefetched
+        self.pool = WorkerPool(workers)
+        self.lock = threading.Lock()
+        # song id -> (head, size)
+        self.heads = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, song, buffer_size=None):
+        """
+        Return a SongStream of the given Song, starting with its prefetched
+        head if there is one (waiting for it if it's being fetched)
+        """
+        with self.lock:
+            task = self.pending.get(song.id)
+        if task:
+            task.wait()
+        with self.lock:
+            head, size = self.heads.pop(song.id, ('', None))
+            if head:
+                self.hits += 1
+            else:
+                self.misses += 1
+        url = self.protocol.get_stream_url(song.id)['url']
+        resolve_url = lambda: self.protocol.get_stream_url(
+            song.id, refresh=True)['url']
+        return SongStream(self.web, url, resolve_url, head, size,
+                          buffer_size or self.buffer_size)
+
+    def prefetch(self, songs):
+        """
+        Start fetching the stream URLs and heads of the given Songs in the
+        background, and return their Tasks
+        """
+        tasks = []
+        with self.lock:
+            for song in songs:
+                if song.id in self.heads:
+                    tasks.append(Task.from_value(song.id))
+                    continue
+                task = self.pending.get(song.id)
+                if task is None:
+                    task = self.pool.submit(self._fetch_head, song.id)
+                    self.pending[song.id] = task
+                tasks.append(task)
+        return tasks
+
+    def _fetch_head(self, song_id):
+        """Fetch the stream URL and the first bytes of a song"""
+        try:
+            url = self.protocol.get_stream_url(song_id)['url']
+            try:
+                source = self.web.open_range(url, 0, self.head_size - 1)
+            except urllib2.HTTPError, error:
+                error.close()
+                raise
+            try:
+                # bounded even if the server ignores the range
+                head = source.read(self.head_size)
+                size = get_total_size(source.info())
+            finally:
+                source.close()
+            with self.lock:
+                self.heads[song_id] = (head, size)
+                while len(self.heads) > self.max_prefetched:
+                    self.heads.popitem(last=False)
+            return song_id
+        finally:
+            with self.lock:
+                del self.pending[song_id]
+
+    def stats(self):
+        """Return the streamer counters, for monitoring"""
+        return {
+          'hits': self.hits, 'misses': self.misses,
+          'pending': len(self.pending), 'prefetched': len(self.heads)
+        }
+
+    def close(self):
+        """Wait for the pending prefetches and stop the workers"""
+        self.pool.shutdown()
+
+
+class SongQueue(object):
+    """
+    Songs to be played in order. next() returns a SongStream of the next
+    song, closing the previous one, while the `ahead` songs after it are
+    prefetched in the background.
+    """
+    def __init__(self, streamer, songs=(), ahead=2):
+        self.streamer = streamer
+        self.songs = deque(songs)
+        self.ahead = ahead
+        self.current = None
+        self.lock = threading.Lock()
+        self._prefetch()
+
+    def add(self, songs):
+        """Add songs to the end of the queue"""
+        with self.lock:
+            self.songs.extend(songs)
+        self._prefetch()
+
+    def next(self):
+        """Return a SongStream of the next song (StopIteration at the end)"""
+        with self.lock:
+            if self.current:
+                self.current.close()
+                self.current = None
+            if not self.songs:
+                raise StopIteration
+            song = self.songs.popleft()
+        self._prefetch()
+        stream = self.streamer.open(song)
+        with self.lock:
+            self.current = stream
+        return stream
+
+    def _prefetch(self):
+        """Prefetch the songs coming next"""
+        with self.lock:
+            upcoming = list(self.songs)[:self.ahead]
+        if upcoming:
+            self.streamer.prefetch(upcoming)
+
+    def close(self):
+        """Close the current stream"""
+        with self.lock:
+            if self.current:
+                self.current.close()
+                self.current = None
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __iter__(self):
+        return self
@@ -4,12 +4,19 @@ Utility functions
 __author__ = "Tirino"
 
 MAC_ADDRESS_SEPARATOR = ':'
+# suffix of the files write_file() writes before renaming them
+TEMP_SUFFIX = '.tmp'
 
 import os
 import re
 import subprocess
+import tempfile
 import uuid
 
+# the umask can only be read by changing it, so it's read once
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 def get_from_text(what, where):
     """Find regular expression [what] in [where] and return it"""
     return re.search(what, where, re.MULTILINE).group(1)
@@ -44,6 +51,30 @@ def get_computer_name():
                 pass
     return name
 
+def replace_file(source, target):
+    """Rename source to target, replacing target if it exists"""
+    if os.name == 'nt' and os.path.exists(target):
+        # rename() can't replace files on Windows
+        os.remove(target)
+    os.rename(source, target)
+
+def write_file(path, data, mode=0666):
+    """
+    Write data to path atomically: readers see either the old file or the
+    new one. The file gets mode (less the umask)
+    """
+    descriptor, temp = tempfile.mkstemp(TEMP_SUFFIX, '.',
+                                        os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            output.write(data)
+        # mkstemp() files are private until they get their mode
+        os.chmod(temp, mode & ~UMASK)
+        replace_file(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
 def get_mac_address():
     """Return the computer main MAC address"""
     mac = '%012x' % uuid.getnode()
@@ -0,0 +1,7 @@
+"""
+Tests
+
+Run them from the project's root:
+
+    python -m unittest discover
+"""
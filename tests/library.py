@@ -0,0 +1,67 @@
+"""
+Synthetic Google Music libraries for the tests and benchmarks
+"""
+__author__ = "Tirino"
+
+import random
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+SONGS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 4
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa',
+             'don', 'gar', 'lin', 'mor', 'sel', 'tan', 'vir', 'bel', 'cor',
+             'fen', 'har', 'jul', 'kes', 'quin']
+
+def make_words(seed, count):
+    """Return count pseudo-random (but deterministic) words"""
+    rand = random.Random(seed)
+    return u' '.join(u''.join(rand.choice(SYLLABLES)
+                              for _ in xrange(rand.randint(2, 3)))
+                     for _ in xrange(count)).title()
+
+def make_song(index):
+    """Return the data of a song, as the server sends it"""
+    album = index // SONGS_PER_ALBUM
+    artist = album // ALBUMS_PER_ARTIST
+    title = make_words(index, 1 + index % 4)
+    artist_name = make_words(-1 - artist, 1 + artist % 2)
+    return {
+      'id': '%08x-0000-4000-8000-%012x' % (index, index),
+      'name': title, 'title': title,
+      'artist': artist_name, 'albumArtist': artist_name,
+      'album': make_words(1 << 30 | album, 1 + album % 3),
+      'track': index % SONGS_PER_ALBUM + 1,
+      'albumArtUrl': '//lh3.googleusercontent.com/art%d=s130' % album,
+      'genre': u'Rock', 'durationMillis': 180000 + index % 120000,
+      'playCount': index % 50, 'rating': 0, 'type': 2, 'year': 2012,
+      'comment': u'', 'composer': u'', 'disc': 1, 'totalDiscs': 1,
+      'totalTracks': SONGS_PER_ALBUM, 'lastPlayed': 1345000000000000,
+      'creationDate': 1340000000000000,
+    }
+
+def make_library(playlists, songs_per_playlist, library_size=None, seed=0):
+    """
+    Return the data of a library with the given number of playlists, each
+    with songs_per_playlist songs picked from a library_size songs library
+    """
+    library_size = library_size or playlists * songs_per_playlist
+    rand = random.Random(seed)
+    result = []
+    for index in xrange(playlists):
+        first = rand.randint(0, max(0, library_size - songs_per_playlist))
+        result.append({
+          'playlistId': '%08x-1111-4000-8000-%012x' % (index, index),
+          'title': u'Playlist %d' % index,
+          'playlist': [make_song(song) for song in
+                       xrange(first, first + songs_per_playlist)],
+        })
+    return result
+
+def make_payload(playlists, songs_per_playlist, library_size=None):
+    """Return a loadplaylist response body, as a JSON string"""
+    return json.dumps({'playlists': make_library(playlists, songs_per_playlist,
+                                                 library_size)})
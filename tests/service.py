@@ -0,0 +1,175 @@
+"""
+Local emulation of the Google Music service for the tests and benchmarks
+
+FakeGoogleMusic answers the requests a Client makes (ClientLogin,
+IssueAuthToken, TokenAuth, /music/services/*, /music/play and the stream
+files) from a synthetic library, with configurable latency, payload sizes
+and fault injection:
+
+    service = FakeGoogleMusic(playlists=10, songs_per_playlist=100).start()
+    service.install()
+    client = Client()
+    client.login('user@gmail.com', 'p4ssw0rd')
+    ...
+    service.stop()
+
+stop() points the endpoints back to where they were.
+"""
+__author__ = "Tirino"
+
+import ast
+import os
+import time
+import urlparse
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from googlemusic import protocol
+from tests.library import make_library
+from tests.stub import StubServer, faulty, gzipped, serve_bytes
+
+BAD_PASSWORD = 'wrong'
+SEARCH_LIMIT = 100
+URL_LIFETIME = 3600
+
+# (class, attribute, path) of the endpoints install() replaces
+ENDPOINTS = (
+  (protocol.Protocol, 'LOGIN_ENDPOINT', '/accounts/ClientLogin'),
+  (protocol.Protocol, 'SERVICE_ENDPOINT', '/music/services'),
+  (protocol.Protocol, 'PLAY_ENDPOINT', '/music/play'),
+  (protocol.MusicManagerClient, 'ISSUE_AUTH_URL', '/accounts/IssueAuthToken'),
+  (protocol.MusicManagerClient, 'TOKEN_AUTH_URL', '/accounts/TokenAuth'),
+)
+
+def install(url):
+    """
+    Point the Protocol endpoints to a FakeGoogleMusic server at url. Return
+    the endpoints they had, for uninstall()
+    """
+    previous = [(owner, name, getattr(owner, name))
+                for owner, name, _ in ENDPOINTS]
+    for owner, name, path in ENDPOINTS:
+        setattr(owner, name, url + path)
+    return previous
+
+def uninstall(previous):
+    """Give the Protocol endpoints back the values install() returned"""
+    for owner, name, value in previous:
+        setattr(owner, name, value)
+
+def read_payload(handler):
+    """Return the payload of an API request (the client sends a dict repr)"""
+    values = urlparse.parse_qs(handler.body).get('json')
+    return ast.literal_eval(values[0]) if values else {}
+
+
+class FakeGoogleMusic(StubServer):
+    """
+    Stub server emulating Google Music for a library of `playlists`
+    playlists of songs_per_playlist songs, picked from library_size songs.
+    Stream files are song_bytes long and, if stream_rate is given, sent at
+    that many bytes per second. The API and play requests fail with
+    error_rate probability, with one of the given codes (see faulty). If
+    compress is True, API responses are gzipped for clients that accept it.
+    """
+    def __init__(self, playlists=10, songs_per_playlist=100,
+                 library_size=None, song_bytes=256 * 1024, latency=0,
+                 error_rate=0, codes=(503,), stream_rate=None,
+                 compress=False):
+        StubServer.__init__(self, latency)
+        self.stream_rate = stream_rate
+        self.library = make_library(playlists, songs_per_playlist,
+                                    library_size)
+        self.playlist_bodies = dict((data['playlistId'], json.dumps(data))
+                                    for data in self.library)
+        self.all_playlists = json.dumps({'playlists': self.library})
+        songs = {}
+        for data in self.library:
+            for song in data['playlist']:
+                songs[song['id']] = song
+        self.songs = sorted(songs.values(), key=lambda song: song['id'])
+        self.audio = os.urandom(song_bytes)
+        self.logins = 0
+        # the endpoints install() replaced
+        self.installed = None
+
+        self.add_route('/accounts/ClientLogin', self.client_login)
+        self.add_route('/accounts/IssueAuthToken',
+                       lambda handler: (200, {}, 'token\n'))
+        self.add_route('/accounts/TokenAuth', lambda handler: (
+            200, {'Set-Cookie': 'xt=stub; Path=/'}, 'ok'))
+        routes = {
+          '/music/services/loadplaylist': self.load_playlist,
+          '/music/services/search': self.search,
+          '/music/services/loadsettings': lambda handler: (
+              200, {}, '{"settings": {"labs": []}}'),
+          '/music/play': self.play,
+        }
+        for path, route in routes.items():
+            if compress and path.startswith('/music/services/'):
+                route = gzipped(route)
+            if error_rate:
+                route = faulty(route, error_rate, codes)
+            self.add_route(path, route)
+        self.add_route('/stream', self.stream)
+
+    def install(self):
+        """Point the Protocol endpoints to this server"""
+        if self.installed is None:
+            self.installed = install(self.url)
+
+    def uninstall(self):
+        """Point the Protocol endpoints back to where they were"""
+        if self.installed is not None:
+            uninstall(self.installed)
+            self.installed = None
+
+    def stop(self):
+        """Stop serving requests and uninstall the server"""
+        self.uninstall()
+        StubServer.stop(self)
+
+    # Routes #
+    def client_login(self, handler):
+        """Answer with auth tokens, unless the password is BAD_PASSWORD"""
+        form = urlparse.parse_qs(handler.body)
+        if form.get('Passwd') == [BAD_PASSWORD]:
+            return 403, {}, 'Error=BadAuthentication\n'
+        self.logins += 1
+        return 200, {}, 'SID=sid\nLSID=lsid\nAuth=auth\n'
+
+    def load_playlist(self, handler):
+        """Answer with every playlist, or the one asked for"""
+        payload = read_payload(handler)
+        if 'id' not in payload:
+            return 200, {}, self.all_playlists
+        body = self.playlist_bodies.get(payload['id'])
+        if body is None:
+            return 200, {}, '{"success": false}'
+        return 200, {}, body
+
+    def search(self, handler):
+        """Answer with the songs whose title or artist has the query"""
+        query = read_payload(handler).get('q', '').lower()
+        found = []
+        for song in self.songs:
+            if query in song['title'].lower() or \
+                    query in song['artist'].lower():
+                found.append(song)
+                if len(found) == SEARCH_LIMIT:
+                    break
+        return 200, {}, json.dumps({'results': {'albums': [],
+                                                'songs': found}})
+
+    def play(self, handler):
+        """Answer with a signed, expiring stream URL"""
+        url = '%s/stream?id=%s&expire=%d' % (
+            self.url, handler.query.get('songid', ''),
+            time.time() + URL_LIFETIME)
+        return 200, {}, json.dumps({'url': url})
+
+    def stream(self, handler):
+        """Serve the song file"""
+        return serve_bytes(handler, self.audio, self.stream_rate)
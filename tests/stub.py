@@ -0,0 +1,241 @@
+"""
+Local HTTP stub server used by the tests and benchmarks
+"""
+__author__ = "Tirino"
+
+import BaseHTTPServer
+import random
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+import zlib
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Dispatch requests to the routes registered on the server"""
+    protocol_version = 'HTTP/1.1'
+    # buffer the whole response so it isn't split in several small packets
+    wbufsize = -1
+
+    def do_GET(self):
+        """Handle GET requests"""
+        self.dispatch()
+
+    def do_POST(self):
+        """Handle POST requests"""
+        self.dispatch()
+
+    def dispatch(self):
+        """Find the route for the requested path and send its response"""
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else ''
+        if self.headers.getheader('Content-Encoding') == 'gzip':
+            self.body = zlib.decompress(self.body, 16 + zlib.MAX_WBITS)
+        url = urlparse.urlparse(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        route = self.server.routes.get(url.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        response = route(self) if route else (404, {}, 'Not Found')
+        if response is None:
+            # drop the connection without answering
+            self.close_connection = 1
+            return
+        status, headers, body = response
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if isinstance(body, str):
+            self.wfile.write(body)
+        else:
+            # streamed body, the route must set the Content-Length
+            for piece in body:
+                self.wfile.write(piece)
+                self.wfile.flush()
+
+    def log_message(self, format, *args):
+        """Keep the output of the tests and benchmarks clean"""
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP/1.1 server, listening on a random local port.
+    Register routes with add_route(path, callback): the callback gets the
+    request handler and must return a (status, headers, body) tuple, or None
+    to drop the connection. The body can be a string or an iterable of
+    strings (sent as they're produced).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.routes = {}
+        self.latency = latency
+        self.connections = 0
+        self.thread = None
+
+    def add_route(self, path, callback):
+        """Register a callback for the given path"""
+        self.routes[path] = callback
+
+    def handle_error(self, request, client_address):
+        """Clients dropping their connections is expected"""
+        pass
+
+    def get_request(self):
+        """Count the accepted TCP connections"""
+        self.connections += 1
+        connection, address = BaseHTTPServer.HTTPServer.get_request(self)
+        # like real servers, don't let Nagle's algorithm hold the last
+        # packet of a response until the client acknowledges the others
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, address
+
+    @property
+    def url(self):
+        """Base URL of the server"""
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests"""
+        self.shutdown()
+        self.server_close()
+
+
+def serve_bytes(handler, data, rate=None, ranges=True):
+    """
+    Return a response for data, honoring the request's Range header if ranges
+    is True. If given, every connection is throttled to rate bytes/second.
+    """
+    start, end = 0, len(data)
+    status = 200
+    headers = {'Content-Type': 'audio/mpeg'}
+    byte_range = handler.headers.getheader('Range')
+    if ranges:
+        headers['Accept-Ranges'] = 'bytes'
+        match = re.match(r'bytes=(\d+)-(\d*)', byte_range or '')
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)) + 1, len(data))
+            if start >= len(data):
+                return 416, {'Content-Range': 'bytes */%d' % len(data)}, ''
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1,
+                                                           len(data))
+    headers['Content-Length'] = str(end - start)
+    body = data[start:end]
+    if rate:
+        body = throttle(body, rate)
+    return status, headers, body
+
+def throttle(body, rate, piece_size=16 * 1024):
+    """Yield body in pieces, at no more than rate bytes/second"""
+    delay = piece_size / float(rate)
+    for start in xrange(0, len(body), piece_size):
+        yield body[start:start + piece_size]
+        time.sleep(delay)
+
+def timed(func, iterations):
+    """Call func() the given number of times and return the elapsed time"""
+    started = time.time()
+    for _ in xrange(iterations):
+        func()
+    return time.time() - started
+
+def faulty(route, error_rate, codes=(503,), retry_after=None, seed=0):
+    """
+    Wrap a route so a fraction (error_rate) of its requests fail with one of
+    the given status codes (None drops the connection instead)
+    """
+    rand = random.Random(seed)
+    lock = threading.Lock()
+    def handle(handler):
+        with lock:
+            fail = rand.random() < error_rate
+            code = rand.choice(codes)
+        if not fail:
+            return route(handler)
+        if code is None:
+            return None
+        headers = {}
+        if retry_after is not None:
+            headers['Retry-After'] = str(retry_after)
+        return code, headers, 'Injected error'
+    return handle
+
+def rate_limited(route, rate):
+    """
+    Wrap a route so requests above rate per second (in one second windows)
+    are answered with 429
+    """
+    lock = threading.Lock()
+    window = [0, 0]
+    def handle(handler):
+        with lock:
+            second = int(time.time())
+            if window[0] != second:
+                window[:] = [second, 0]
+            window[1] += 1
+            throttled = window[1] > rate
+        if throttled:
+            return 429, {'Retry-After': '1'}, 'Slow down'
+        return route(handler)
+    return handle
+
+def gzipped(route, level=6, cache_size=16):
+    """
+    Wrap a route so its responses are gzipped for clients that accept it.
+    The last cache_size compressed bodies are kept, so big responses aren't
+    compressed on every request.
+    """
+    cache = {}
+    lock = threading.Lock()
+    def handle(handler):
+        response = route(handler)
+        accepted = handler.headers.getheader('Accept-Encoding') or ''
+        if response is None or 'gzip' not in accepted or \
+                not isinstance(response[2], str):
+            return response
+        status, headers, body = response
+        with lock:
+            compressed = cache.get(body)
+        if compressed is None:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(body) + compressor.flush()
+            with lock:
+                if len(cache) >= cache_size:
+                    cache.clear()
+                cache[body] = compressed
+        headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        return status, headers, compressed
+    return handle
+
+def throttled(route, rate):
+    """Wrap a route so its responses are sent at rate bytes/second"""
+    def handle(handler):
+        response = route(handler)
+        if response is None or not isinstance(response[2], str):
+            return response
+        status, headers, body = response
+        headers = dict(headers, **{'Content-Length': str(len(body))})
+        return status, headers, throttle(body, rate)
+    return handle
@@ -0,0 +1,71 @@
+"""
+Tests of googlemusic.artwork
+"""
+__author__ = "Tirino"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from googlemusic.artwork import ArtworkCache
+
+class ArtworkCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def url_files(self):
+        return len(os.listdir(os.path.join(self.folder, 'urls')))
+
+    def test_shared_images_are_stored_once(self):
+        cache = ArtworkCache(self.folder)
+        first = cache.set('http://a/1', 'cover')
+        self.assertEqual(cache.set('http://a/2', 'cover'), first)
+        self.assertEqual(cache.get('http://a/2'), first)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(self.url_files(), 2)
+
+    def test_eviction_removes_url_files(self):
+        cache = ArtworkCache(self.folder, max_bytes=10)
+        for index in xrange(20):
+            cache.set('http://a/%d' % index, 'image %02d' % (index // 2))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(self.url_files(), 2)
+        self.assertEqual(cache.get('http://a/0'), None)
+        self.assertTrue(cache.get('http://a/19'))
+
+    def test_moved_url_is_not_removed_with_its_old_image(self):
+        cache = ArtworkCache(self.folder, max_bytes=20)
+        cache.set('http://a/1', 'old image')
+        cache.set('http://a/1', 'new image')
+        cache.set('http://a/2', 'other image')
+        self.assertTrue(cache.get('http://a/1'))
+        self.assertEqual(self.url_files(), 2)
+
+    def test_orphan_url_files_are_removed_on_load(self):
+        cache = ArtworkCache(self.folder)
+        cache.set('http://a/1', 'cover')
+        os.remove(cache.image_file(next(iter(cache.sizes))))
+        cache = ArtworkCache(self.folder)
+        self.assertEqual(self.url_files(), 0)
+        self.assertEqual(cache.get('http://a/1'), None)
+
+    def test_interrupted_writes_are_removed_on_load(self):
+        cache = ArtworkCache(self.folder)
+        cache.set('http://a/1', 'cover')
+        for folder in ('images', 'urls'):
+            with open(os.path.join(self.folder, folder, '.abc.tmp'),
+                      'wb') as temp:
+                temp.write('partial')
+        cache = ArtworkCache(self.folder)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total, len('cover'))
+        self.assertEqual(self.url_files(), 1)
+        self.assertTrue(cache.get('http://a/1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
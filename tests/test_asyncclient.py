@@ -0,0 +1,144 @@
+"""
+Tests of googlemusic.asyncclient
+"""
+__author__ = "Tirino"
+
+import httplib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+from googlemusic.asyncclient import AsyncClient, DownloadSink
+from googlemusic.asynchttp import AsyncResponse
+from googlemusic.concurrency import WorkerPool
+from googlemusic.download import PartialDownload
+from tests.service import FakeGoogleMusic
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=2, songs_per_playlist=5,
+                                       song_bytes=200 * 1024)
+        self.service.start()
+        self.service.install()
+        self.folder = tempfile.mkdtemp()
+        self.client = AsyncClient(max_connections=8)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.folder)
+        self.service.stop()
+
+    def login(self, client=None, session_file=None):
+        client = client or self.client
+        return client.login('test@gmail.com', 'p4ssw0rd',
+                            session_file).result(10)
+
+    def test_login_and_playlists(self):
+        self.assertTrue(self.login())
+        playlists = self.client.get_all_playlists().result(10)
+        self.assertEqual(len(playlists), 2)
+        self.assertEqual(len(playlists[0].songs), 5)
+        playlist = playlists[1]
+        playlist.songs = []
+        self.client.load_playlist(playlist).result(10)
+        self.assertEqual(len(playlist.songs), 5)
+
+    def test_session_file_is_reused(self):
+        session_file = os.path.join(self.folder, 'session')
+        self.login(session_file=session_file)
+        self.assertEqual(self.service.logins, 1)
+        client = AsyncClient()
+        try:
+            self.login(client, session_file)
+            self.assertEqual(self.service.logins, 1)
+            self.assertEqual(len(client.get_all_playlists().result(10)), 2)
+        finally:
+            client.close()
+
+    def test_many_operations_at_once(self):
+        self.login()
+        query = self.service.songs[0]['title']
+        tasks = [self.client.search(query) for _ in xrange(200)]
+        for task in self.client.as_completed(tasks):
+            self.assertTrue(task.result()['Songs'])
+        self.assertTrue(self.client.http.created <= 8)
+
+    def test_rejected_session_is_renewed(self):
+        self.login()
+        search = self.service.routes['/music/services/search']
+        rejected = []
+        def reject_once(handler):
+            if not rejected:
+                rejected.append(handler)
+                return 401, {}, 'expired'
+            return search(handler)
+        self.service.routes['/music/services/search'] = reject_once
+        query = self.service.songs[0]['title']
+        self.assertTrue(self.client.search(query).result(10)['Songs'])
+        self.assertEqual(len(rejected), 1)
+
+    def test_download_and_stream(self):
+        self.login()
+        songs = self.client.get_all_playlists().result(10)[0].songs
+        tasks = self.client.map(self.client.download_song, songs,
+                                self.folder)
+        self.assertEqual([task.result(10) for task in tasks], [True] * 5)
+        for name in os.listdir(self.folder):
+            with open(os.path.join(self.folder, name), 'rb') as song_file:
+                self.assertEqual(song_file.read(), self.service.audio)
+        chunks = []
+        size = self.client.stream_song(songs[0], chunks.append).result(10)
+        self.assertEqual(size, len(self.service.audio))
+        self.assertEqual(''.join(chunks), self.service.audio)
+
+
+class DownloadSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.disk = WorkerPool(1)
+        self.partial = PartialDownload(os.path.join(self.folder, 'song.mp3'))
+
+    def tearDown(self):
+        self.disk.shutdown()
+        shutil.rmtree(self.folder)
+
+    def start(self, size, chunk_size=4):
+        sink = DownloadSink(self.partial, 0, chunk_size, self.disk)
+        headers = httplib.HTTPMessage(StringIO(
+            'Content-Length: %d\r\n\r\n' % size))
+        sink.start(AsyncResponse('http://example.com/song', 200, 'OK',
+                                 headers))
+        return sink
+
+    def test_writes_on_the_disk_thread(self):
+        threads = []
+        mark = self.partial.mark
+        def recording(start, end):
+            threads.append(threading.current_thread())
+            mark(start, end)
+        self.partial.mark = recording
+        sink = self.start(12)
+        self.assertEqual(sink.write('abcd'), None)
+        first = sink.write('efgh')
+        self.assertTrue(first is not None)
+        sink.write('ijkl')
+        sink.close().result(10)
+        self.assertTrue(first.done())
+        self.assertEqual(set(threads), set(self.disk.threads))
+        self.assertEqual(self.partial.done, [[0, 12]])
+        with open(self.partial.part, 'rb') as part:
+            self.assertEqual(part.read(), 'abcdefghijkl')
+
+    def test_close_fails_if_writing_failed(self):
+        os.mkdir(self.partial.part)
+        sink = self.start(8)
+        sink.write('abcd')
+        sink.write('efgh')
+        self.assertRaises(IOError, sink.close().result, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Tests of googlemusic.asynchttp
+"""
+__author__ = "Tirino"
+
+import socket
+import threading
+import time
+import unittest
+import urllib2
+
+from googlemusic.asynchttp import AsyncHTTPClient
+from googlemusic.compression import CompressionHandler
+from googlemusic.concurrency import Task
+from googlemusic.eventloop import EventLoop
+from tests.stub import StubServer, gzipped
+
+class AsyncHTTPTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.calls = 0
+        self.server.add_route('/ok', lambda handler: (200, {}, 'ok'))
+        self.server.add_route('/drop', self.drop_once)
+        self.loop = EventLoop().start()
+        self.http = AsyncHTTPClient(self.loop, max_per_host=4, timeout=5)
+
+    def tearDown(self):
+        self.loop.call_soon(self.http.close)
+        self.loop.close()
+        self.server.stop()
+
+    def drop_once(self, handler):
+        """Drop the connection the first time, answer afterwards"""
+        self.calls += 1
+        if self.calls == 1:
+            return None
+        return 200, {}, 'done'
+
+    def fetch(self, path, data=None, **kwargs):
+        request = urllib2.Request(self.server.url + path, data)
+        return self.http.fetch(request, **kwargs).result(10)
+
+    def test_keeps_connections_alive(self):
+        for _ in xrange(5):
+            self.assertEqual(self.fetch('/ok').read(), 'ok')
+        self.assertEqual(self.http.created, 1)
+        self.assertEqual(self.http.reused, 4)
+
+    def test_limits_connections_per_host(self):
+        self.server.add_route('/slow', lambda handler: (
+            time.sleep(0.05) or (200, {}, 'slow')))
+        tasks = [self.http.fetch(urllib2.Request(self.server.url + '/slow'))
+                 for _ in xrange(20)]
+        self.assertEqual([task.result(10).read() for task in tasks],
+                         ['slow'] * 20)
+        self.assertEqual(self.http.created, 4)
+
+    def test_chunked_and_streamed_body(self):
+        # Transfer-Encoding wins over the Content-Length the stub adds
+        self.server.add_route('/chunked', lambda handler: (
+            200, {'Transfer-Encoding': 'chunked'},
+            ['5\r\nhello\r\n', '6\r\n world\r\n', '0\r\n\r\n']))
+        self.assertEqual(self.fetch('/chunked').read(), 'hello world')
+        chunks = []
+        response = self.fetch('/chunked', on_chunk=chunks.append)
+        self.assertEqual(''.join(chunks), 'hello world')
+        self.assertEqual(response.read(), '')
+
+    def test_decodes_gzip(self):
+        self.server.add_route('/gzip', gzipped(
+            lambda handler: (200, {}, 'x' * 10000)))
+        self.http.compression = CompressionHandler()
+        response = self.fetch('/gzip')
+        self.assertEqual(response.read(), 'x' * 10000)
+        self.assertEqual(response.info().getheader('Content-Encoding'), None)
+
+    def test_errors_raise_http_error(self):
+        self.server.add_route('/missing', lambda handler: (404, {}, 'nope'))
+        try:
+            self.fetch('/missing')
+        except urllib2.HTTPError, error:
+            self.assertEqual(error.code, 404)
+            self.assertEqual(error.read(), 'nope')
+        else:
+            self.fail('No HTTPError')
+
+    def test_follows_redirects(self):
+        self.server.add_route('/moved', lambda handler: (
+            302, {'Location': '/ok'}, ''))
+        self.assertEqual(self.fetch('/moved').read(), 'ok')
+
+    def test_get_is_sent_again(self):
+        self.fetch('/ok')
+        self.assertEqual(self.fetch('/drop').read(), 'done')
+        self.assertEqual(self.calls, 2)
+
+    def test_post_is_not_sent_again(self):
+        self.fetch('/ok')
+        self.assertRaises(socket.error, self.fetch, '/drop', 'name=x')
+        self.assertEqual(self.calls, 1)
+
+    def test_timeout(self):
+        self.http.timeout = 0.2
+        self.server.add_route('/hang', lambda handler: (
+            time.sleep(1) or (200, {}, 'late')))
+        self.assertRaises(socket.timeout, self.fetch, '/hang')
+
+    def test_callbacks_run_on_the_loop_thread(self):
+        threads = set()
+        on_chunk = lambda data: threads.add(threading.current_thread())
+        tasks = [self.http.fetch(urllib2.Request(self.server.url + '/ok'),
+                                 on_chunk)
+                 for _ in xrange(50)]
+        for task in tasks:
+            task.result(10)
+        self.assertEqual(threads, set([self.loop.thread]))
+
+    def test_resolves_names_off_the_loop_thread(self):
+        threads = []
+        getaddrinfo = socket.getaddrinfo
+        def recording(host, *args):
+            if host == '127.0.0.1':
+                threads.append(threading.current_thread())
+            return getaddrinfo(host, *args)
+        socket.getaddrinfo = recording
+        try:
+            tasks = [self.http.fetch(urllib2.Request(self.server.url + '/ok'))
+                     for _ in xrange(8)]
+            for task in tasks:
+                task.result(10)
+            self.fetch('/ok')
+        finally:
+            socket.getaddrinfo = getaddrinfo
+        # one lookup, shared by the connections and cached afterwards
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], self.loop.thread)
+
+    def test_on_chunk_can_pause_the_body(self):
+        self.server.add_route('/big', lambda handler: (
+            200, {}, 'x' * 300000))
+        resume = Task(None, (), {})
+        chunks = []
+        def on_chunk(data):
+            chunks.append(data)
+            return resume
+        task = self.http.fetch(urllib2.Request(self.server.url + '/big'),
+                               on_chunk, chunk_size=1024)
+        time.sleep(0.2)
+        self.assertEqual(len(chunks), 1)
+        self.assertFalse(task.done())
+        resume.set_result(None)
+        task.result(10)
+        self.assertEqual(''.join(chunks), 'x' * 300000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests of googlemusic.batch
+"""
+__author__ = "Tirino"
+
+import threading
+import unittest
+
+from googlemusic.batch import BatchOperation, PlaylistBatch
+from googlemusic.model import Playlist
+
+class RecordingClient(object):
+    """Client that records the playlist changes sent"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def _record(self, *call):
+        with self.lock:
+            self.sent.append(call)
+
+    def add_playlist(self, title):
+        self._record('create', title)
+        return Playlist({'id': 'new-' + title, 'title': title})
+
+    def modify_playlist(self, playlist, title):
+        self._record('rename', playlist.id, title)
+        return True
+
+    def delete_playlist(self, playlist):
+        self._record('delete', playlist.id)
+        return True
+
+
+class PlaylistBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.client = RecordingClient()
+        self.batch = PlaylistBatch(self.client)
+        self.playlist = Playlist({'id': 'p1', 'title': 'Old'})
+
+    def test_renames_are_merged(self):
+        first = self.batch.modify_playlist(self.playlist, 'A')
+        last = self.batch.modify_playlist(self.playlist, 'B')
+        self.batch.commit()
+        self.assertEqual(self.client.sent, [('rename', 'p1', 'B')])
+        self.assertEqual(first.status, BatchOperation.MERGED)
+        self.assertTrue(first.success and last.success)
+
+    def test_created_playlist_gets_its_final_title(self):
+        create = self.batch.add_playlist('New')
+        self.batch.modify_playlist(create, 'Renamed')
+        self.batch.commit()
+        self.assertEqual(self.client.sent, [('create', 'Renamed')])
+        self.assertEqual(create.result.title, 'Renamed')
+
+    def test_created_and_deleted_playlist_is_not_sent(self):
+        create = self.batch.add_playlist('New')
+        delete = self.batch.delete_playlist(create)
+        rename = self.batch.modify_playlist(create, 'Renamed')
+        self.batch.commit()
+        self.assertEqual(self.client.sent, [])
+        self.assertEqual(create.status, BatchOperation.CANCELLED)
+        self.assertEqual(delete.status, BatchOperation.CANCELLED)
+        self.assertEqual(rename.status, BatchOperation.FAILED)
+        self.assertEqual(str(rename.error),
+                         'Playlist deleted earlier in the batch')
+        self.assertEqual(self.batch.failed, [rename])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Tests of googlemusic.cache
+"""
+__author__ = "Tirino"
+
+import threading
+import time
+import unittest
+
+from googlemusic.cache import ResponseCache, StreamUrlCache
+from googlemusic.client import Client
+from googlemusic.concurrency import WorkerPool
+from tests.service import FakeGoogleMusic
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(ttls={'search': 0})
+        self.sent = []
+
+    def send(self, result):
+        """Return a send() callback answering result"""
+        def send(headers):
+            self.sent.append(headers)
+            return result, FakeHeaders()
+        return send
+
+    def methods(self):
+        return sorted(key.split('-')[0] for key in self.cache.backend.keys())
+
+    def test_hits(self):
+        self.cache.call('loadsettings', {}, self.send({'a': 1}))
+        self.assertEqual(self.cache.call('loadsettings', {},
+                                         self.send({'a': 2})), {'a': 1})
+        self.assertEqual(len(self.sent), 1)
+
+    def test_uncached_methods_keep_entries(self):
+        self.cache.call('loadplaylist', {}, self.send({}))
+        self.cache.call('loadsettings', {}, self.send({}))
+        self.cache.call('search', {'q': 'a'}, self.send({}))
+        self.cache.call('someothermethod', {}, self.send({}))
+        self.assertEqual(self.methods(), ['loadplaylist', 'loadsettings'])
+
+    def test_mutations_invalidate(self):
+        self.cache.call('loadplaylist', {}, self.send({}))
+        self.cache.call('loadsettings', {}, self.send({}))
+        self.cache.call('addplaylist', {}, self.send({}))
+        self.assertEqual(self.methods(), ['loadsettings'])
+
+
+class FakeHeaders(object):
+    """Response headers without validators"""
+    def getheader(self, name, default=None):
+        return default
+
+
+class ProtocolCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=2, songs_per_playlist=5)
+        self.service.start()
+        self.service.install()
+        self.client = Client()
+        self.client.login('test@gmail.com', 'p4ssw0rd')
+        self.client.enable_response_cache()
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.service.stop()
+
+    def test_payload_not_modified(self):
+        payload = {'id': 'x'}
+        self.client.protocol._api_call('loadplaylist', payload)
+        self.assertEqual(payload, {'id': 'x'})
+
+    def test_key_survives_session_renewal(self):
+        protocol = self.client.protocol
+        playlist_id = self.service.library[0]['playlistId']
+        load = self.service.routes['/music/services/loadplaylist']
+        answers = [(401, {}, 'Unauthorized')]
+        def route(handler):
+            if answers:
+                return answers.pop(0)
+            return load(handler)
+        self.service.add_route('/music/services/loadplaylist', route)
+        protocol.load_playlist(playlist_id)
+        requests = self.service.logins
+        protocol.load_playlist(playlist_id)
+        self.assertEqual(protocol.response_cache.hits, 1)
+        self.assertEqual(self.service.logins, requests)
+
+
+class StreamUrlCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = StreamUrlCache(refresh_margin=60)
+        self.fetched = []
+        self.lifetime = 3600
+
+    def fetch(self, song_id):
+        """Answer with a URL expiring in self.lifetime seconds"""
+        self.fetched.append(song_id)
+        return {'url': 'http://stream/%s?expire=%d&n=%d' % (
+            song_id, time.time() + self.lifetime, len(self.fetched))}
+
+    def test_hits_until_shortly_before_expiry(self):
+        first = self.cache.get('a', self.fetch)
+        self.assertEqual(self.cache.get('a', self.fetch), first)
+        self.assertEqual(self.fetched, ['a'])
+        # expires within the refresh margin: fetched on every lookup
+        self.lifetime = 30
+        self.cache.invalidate('a')
+        self.cache.get('a', self.fetch)
+        self.cache.get('a', self.fetch)
+        self.assertEqual(self.fetched, ['a'] * 3)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+    def test_urls_without_expiry_use_the_default_ttl(self):
+        cache = StreamUrlCache(default_ttl=0)
+        fetch = lambda song_id: {'url': 'http://stream/' + song_id}
+        cache.get('a', fetch)
+        cache.get('a', fetch)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_invalidate(self):
+        first = self.cache.get('a', self.fetch)
+        self.cache.get('b', self.fetch)
+        self.cache.invalidate('a')
+        self.assertNotEqual(self.cache.get('a', self.fetch), first)
+        self.cache.get('b', self.fetch)
+        self.assertEqual(self.fetched, ['a', 'b', 'a'])
+
+    def test_concurrent_lookups_share_one_fetch(self):
+        release = threading.Event()
+        def slow_fetch(song_id):
+            release.wait(10)
+            return self.fetch(song_id)
+        with WorkerPool(10) as pool:
+            tasks = [pool.submit(self.cache.get, 'a', slow_fetch)
+                     for _ in xrange(10)]
+            deadline = time.time() + 10
+            while self.cache.stats()['shared'] < 9 and \
+                    time.time() < deadline:
+                time.sleep(0.01)
+            release.set()
+        results = [task.result(10) for task in tasks]
+        self.assertEqual(self.fetched, ['a'])
+        self.assertEqual(results, [results[0]] * 10)
+        stats = self.cache.stats()
+        self.assertEqual((stats['misses'], stats['shared']), (1, 9))
+
+    def test_errors_are_shared_but_not_cached(self):
+        def failing_fetch(song_id):
+            raise ValueError('no URL')
+        self.assertRaises(ValueError, self.cache.get, 'a', failing_fetch)
+        self.assertEqual(self.cache.pending, {})
+        self.cache.get('a', self.fetch)
+        self.assertEqual(self.fetched, ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
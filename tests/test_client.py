@@ -0,0 +1,87 @@
+"""
+Tests of googlemusic.client
+"""
+__author__ = "Tirino"
+
+import time
+import unittest
+import urllib2
+
+from googlemusic.client import Client
+from googlemusic.model import Playlist
+from tests.service import FakeGoogleMusic, read_payload
+
+class LoadPlaylistsTest(unittest.TestCase):
+    def setUp(self):
+        # 6 playlists of 10 songs out of 15: they share songs
+        self.service = FakeGoogleMusic(playlists=6, songs_per_playlist=10,
+                                       library_size=15)
+        self.service.start()
+        self.service.install()
+        self.load_playlist = self.service.routes[
+            '/music/services/loadplaylist']
+        self.client = Client()
+        self.client.login('test@gmail.com', 'p4ssw0rd')
+        self.playlists = [Playlist({'id': data['playlistId'],
+                                    'title': data['title']})
+                          for data in self.service.library]
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.service.stop()
+
+    def song_ids(self, playlist):
+        return [song.id for song in playlist.songs]
+
+    def expected_ids(self, playlist):
+        data, = [data for data in self.service.library
+                 if data['playlistId'] == playlist.id]
+        return [str(song['id']) for song in data['playlist']]
+
+    def test_ordered(self):
+        loaded = self.client.load_playlists(self.playlists, workers=3)
+        self.assertEqual(loaded, self.playlists)
+        for playlist in loaded:
+            self.assertEqual(self.song_ids(playlist),
+                             self.expected_ids(playlist))
+
+    def test_unordered_yields_as_loaded(self):
+        slow = self.playlists[0].id
+        def delay_first(handler):
+            if read_payload(handler).get('id') == slow:
+                time.sleep(0.3)
+            return self.load_playlist(handler)
+        self.service.add_route('/music/services/loadplaylist', delay_first)
+        loaded = list(self.client.load_playlists(self.playlists, workers=3,
+                                                 ordered=False))
+        self.assertEqual(sorted(loaded), sorted(self.playlists))
+        self.assertEqual(loaded[-1].id, slow)
+
+    def test_errors_reach_the_caller(self):
+        broken = self.playlists[2].id
+        def fail_one(handler):
+            if read_payload(handler).get('id') == broken:
+                return 400, {}, 'Bad request'
+            return self.load_playlist(handler)
+        self.service.add_route('/music/services/loadplaylist', fail_one)
+        self.assertRaises(urllib2.HTTPError, self.client.load_playlists,
+                          self.playlists)
+        loaded = self.client.load_playlists(self.playlists, ordered=False)
+        self.assertRaises(urllib2.HTTPError, list, loaded)
+
+    def test_songs_are_shared_between_playlists(self):
+        self.client.load_playlists(self.playlists, workers=4)
+        songs = {}
+        for playlist in self.playlists:
+            for song in playlist.songs:
+                self.assertTrue(songs.setdefault(song.id, song) is song)
+        self.assertEqual(len(songs), len(self.service.songs))
+
+    def test_no_playlists(self):
+        self.assertEqual(self.client.load_playlists([]), [])
+        self.assertEqual(list(self.client.load_playlists([], ordered=False)),
+                         [])
+
+
+if __name__ == '__main__':
+    unittest.main()
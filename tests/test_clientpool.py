@@ -0,0 +1,98 @@
+"""
+Tests of googlemusic.clientpool
+"""
+__author__ = "Tirino"
+
+import unittest
+import urllib2
+
+from googlemusic.client import Client
+from googlemusic.clientpool import ClientPool, session_filename
+from tests.service import BAD_PASSWORD, FakeGoogleMusic
+
+def fail(client):
+    """Task that breaks"""
+    raise ValueError('broken')
+
+
+class ClientPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=2, songs_per_playlist=3)
+        self.service.start()
+        self.service.install()
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool:
+            self.pool.close()
+        self.service.stop()
+
+    def make_pool(self, accounts=1, **kwargs):
+        self.pool = ClientPool(workers=4, **kwargs)
+        for index in xrange(accounts):
+            self.pool.add_account('user%d@gmail.com' % index, 'p4ssw0rd')
+        return self.pool
+
+    def run_task(self, username, func=Client.get_all_playlists):
+        return self.pool.submit(username, func).result(10)
+
+    def test_clients_are_reused(self):
+        pool = self.make_pool()
+        self.assertEqual(len(self.run_task('user0@gmail.com')), 2)
+        client = pool.client('user0@gmail.com')
+        self.assertEqual(len(self.run_task('user0@gmail.com')), 2)
+        self.assertTrue(pool.client('user0@gmail.com') is client)
+        stats = pool.stats()
+        self.assertEqual((stats['logins'], stats['clients']), (1, 1))
+        self.assertEqual(self.service.logins, 1)
+
+    def test_max_clients(self):
+        pool = self.make_pool(3, max_clients=2)
+        for index in (0, 1, 2, 0):
+            self.run_task('user%d@gmail.com' % index)
+        stats = pool.stats()
+        self.assertEqual(stats['clients'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        # the evicted account came back with its session, without a login
+        self.assertEqual((stats['logins'], stats['restores']), (3, 1))
+        self.assertEqual(self.service.logins, 3)
+
+    def test_idle_clients_are_evicted(self):
+        pool = self.make_pool(idle_timeout=0)
+        self.run_task('user0@gmail.com')
+        pool.evict_idle()
+        self.assertEqual(pool.stats()['clients'], 0)
+        self.run_task('user0@gmail.com')
+        self.assertEqual(pool.stats()['restores'], 1)
+
+    def test_failed_task_releases_its_client(self):
+        pool = self.make_pool(2, max_clients=1)
+        task = pool.submit('user0@gmail.com', fail)
+        self.assertTrue(isinstance(task.exception(10), ValueError))
+        self.assertEqual(pool.accounts['user0@gmail.com'].active, 0)
+        # the broken account's client can make room for another one
+        self.run_task('user1@gmail.com')
+        self.assertEqual(list(pool.live), ['user1@gmail.com'])
+
+    def test_failed_login_keeps_no_client(self):
+        pool = self.make_pool()
+        pool.add_account('bad@gmail.com', BAD_PASSWORD)
+        task = pool.submit('bad@gmail.com', Client.get_all_playlists)
+        self.assertTrue(isinstance(task.exception(10), urllib2.HTTPError))
+        self.assertEqual(pool.stats()['clients'], 0)
+        self.assertEqual(pool.accounts['bad@gmail.com'].active, 0)
+        self.assertEqual(len(self.run_task('user0@gmail.com')), 2)
+
+    def test_removed_account_cancels_its_tasks(self):
+        pool = self.make_pool()
+        pool.remove_account('user0@gmail.com')
+        self.assertRaises(KeyError, pool.submit, 'user0@gmail.com', fail)
+        self.assertEqual(pool.stats()['accounts'], 0)
+
+    def test_session_filename(self):
+        self.assertEqual(session_filename('a/b:c@gmail.com'),
+                         'a_b_c@gmail.com.session')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+"""
+Tests of googlemusic.download
+"""
+__author__ = "Tirino"
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from googlemusic.client import Client
+from googlemusic.download import PartialDownload, song_filename
+from googlemusic.request import CookieManager, WebRequest
+from tests.service import FakeGoogleMusic
+from tests.stub import StubServer, serve_bytes
+
+class PartialDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'song.mp3')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_part(self, data, size, done):
+        """Leave a .part file and its journal, as an interrupted download"""
+        with open(self.filename + PartialDownload.PART_SUFFIX, 'wb') as part:
+            part.write(data)
+        with open(self.filename + PartialDownload.JOURNAL_SUFFIX,
+                  'wb') as journal:
+            json.dump({'size': size, 'done': done}, journal)
+
+    def test_journal_round_trip(self):
+        partial = PartialDownload(self.filename)
+        partial.preallocate(300)
+        partial.mark(0, 100)
+        partial.mark(200, 300)
+        partial.mark(100, 150)
+        partial = PartialDownload(self.filename)
+        self.assertEqual(partial.size, 300)
+        self.assertEqual(partial.done, [[0, 150], [200, 300]])
+        self.assertEqual(partial.offset, 150)
+        self.assertEqual(partial.missing(30), [[150, 180], [180, 200]])
+        self.assertFalse(partial.complete())
+
+    def test_truncation_forgets_later_ranges(self):
+        self.write_part('x' * 300, 300, [[0, 100], [150, 300]])
+        partial = PartialDownload(self.filename)
+        partial.open(80).close()
+        self.assertEqual(partial.done, [[0, 80]])
+        self.assertEqual(PartialDownload(self.filename).done, [[0, 80]])
+        self.assertEqual(partial.missing(1000), [[80, 300]])
+
+    def test_ranges_past_the_end_of_the_file_are_missing(self):
+        self.write_part('x' * 200, 300, [[0, 300]])
+        partial = PartialDownload(self.filename)
+        self.assertEqual(partial.offset, 200)
+        self.assertEqual(partial.missing(1000), [[200, 300]])
+        self.assertFalse(partial.complete())
+
+
+class SegmentedDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'song.mp3')
+        self.data = os.urandom(300 * 1024)
+        self.ranges = []
+        self.server = StubServer().start()
+        self.server.add_route('/song', self.serve)
+        self.web = WebRequest(CookieManager())
+        self.web.segment_size = 64 * 1024
+        self.web.DOWNLOAD_RETRY_DELAY = 0
+
+    def tearDown(self):
+        self.web.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def serve(self, handler):
+        self.ranges.append(handler.headers.getheader('Range'))
+        return serve_bytes(handler, self.data)
+
+    def download(self, segments=4):
+        self.assertTrue(self.web.download_file(self.server.url + '/song',
+                                               self.filename,
+                                               segments=segments))
+        with open(self.filename, 'rb') as song_file:
+            self.assertEqual(song_file.read(), self.data)
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+        self.assertFalse(os.path.exists(self.filename + '.part.journal'))
+
+    def test_downloads_in_segments(self):
+        self.download()
+        # the probe and five segments
+        self.assertEqual(len(self.ranges), 6)
+
+    def test_resumes_only_the_missing_segments(self):
+        partial = PartialDownload(self.filename)
+        partial.preallocate(len(self.data))
+        with partial.open_at(0) as part:
+            part.write(self.data[:128 * 1024])
+        partial.mark(0, 128 * 1024)
+        self.download()
+        self.assertEqual(sorted(self.ranges[1:]), [
+            'bytes=131072-196607', 'bytes=196608-262143',
+            'bytes=262144-307199'])
+
+    def test_resumes_after_an_interrupted_serial_resume(self):
+        # segments journaled, then a serial resume truncated the file
+        half = len(self.data) // 2
+        with open(self.filename + '.part', 'wb') as part:
+            part.write(self.data[:half])
+        partial = PartialDownload(self.filename)
+        partial.reset(len(self.data))
+        partial.mark(0, len(self.data))
+        self.download()
+        self.assertEqual(min(self.ranges[1:]),
+                         'bytes=%d-%d' % (half, half + 64 * 1024 - 1))
+
+
+class BulkDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=1, songs_per_playlist=6,
+                                       song_bytes=64 * 1024)
+        self.service.start()
+        self.service.install()
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.missing = set()
+        self.service.add_route('/stream', self.stream)
+        self.folder = tempfile.mkdtemp()
+        self.client = Client()
+        self.client.web.DOWNLOAD_RETRY_DELAY = 0
+        self.client.login('test@gmail.com', 'p4ssw0rd')
+        self.songs = self.client.get_all_playlists()[0].songs
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.service.stop()
+        shutil.rmtree(self.folder)
+
+    def stream(self, handler):
+        """Serve the songs, slowly, except the missing ones"""
+        song_id = handler.query.get('id')
+        with self.lock:
+            self.requests.append((song_id, handler.headers.getheader('Range')))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(0.02)
+            if song_id in self.missing:
+                return 404, {}, 'Not found'
+            return serve_bytes(handler, self.service.audio)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def downloaded(self, song):
+        with open(song_filename(song, self.folder), 'rb') as song_file:
+            return song_file.read()
+
+    def test_downloads_in_parallel(self):
+        reports = []
+        report = self.client.download_songs(self.songs, self.folder,
+                                            workers=4, per_host=2,
+                                            progress=reports.append)
+        self.assertEqual((report.total, report.completed, report.failed),
+                         (6, 6, 0))
+        self.assertEqual(report.downloaded, 6 * len(self.service.audio))
+        for song in self.songs:
+            self.assertEqual(self.downloaded(song), self.service.audio)
+        self.assertTrue(reports)
+        self.assertEqual(self.max_active, 2)
+
+    def test_failures_are_reported_per_song(self):
+        self.missing.add(self.songs[1].id)
+        report = self.client.download_songs(self.songs, self.folder)
+        self.assertEqual((report.completed, report.failed), (6, 1))
+        failed, = report.errors
+        self.assertTrue(failed.song is self.songs[1])
+        self.assertTrue(isinstance(failed.error, urllib2.HTTPError))
+        self.assertEqual(len(report.succeeded), 5)
+        self.assertFalse(os.path.exists(failed.filename))
+
+    def test_interrupted_downloads_are_resumed(self):
+        song = self.songs[0]
+        partial = PartialDownload(song_filename(song, self.folder))
+        partial.reset(len(self.service.audio))
+        with partial.open(0) as part:
+            part.write(self.service.audio[:1000])
+        partial.mark(0, 1000)
+        report = self.client.download_songs([song], self.folder)
+        self.assertEqual(report.failed, 0)
+        self.assertEqual(self.downloaded(song), self.service.audio)
+        self.assertEqual(self.requests, [(song.id, 'bytes=1000-')])
+
+
+if __name__ == '__main__':
+    unittest.main()
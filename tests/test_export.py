@@ -0,0 +1,64 @@
+"""
+Tests of googlemusic.export
+"""
+__author__ = "Tirino"
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+from googlemusic import export
+
+class FakeClient(object):
+    """Client whose saved session is usable if `account` is set"""
+    def __init__(self, account=None):
+        self.account = account
+        self.logins = []
+
+    @property
+    def protocol(self):
+        return self
+
+    def resume_session(self, session_file):
+        return self.account is not None
+
+    def login(self, username, password, session_file=None):
+        self.logins.append(username)
+
+
+class LoginTest(unittest.TestCase):
+    def setUp(self):
+        os.environ[export.PASSWORD_VARIABLE] = 'p4ssw0rd'
+
+    def tearDown(self):
+        del os.environ[export.PASSWORD_VARIABLE]
+
+    def login(self, client, *argv):
+        return export.login(client, export.parse_args(list(argv)))
+
+    def test_resumes_the_saved_session(self):
+        client = FakeClient('test@gmail.com')
+        self.assertTrue(self.login(client, '--session-file', 'session'))
+        self.assertEqual(client.logins, [])
+
+    def test_logs_in_as_another_user(self):
+        client = FakeClient('other@gmail.com')
+        self.assertTrue(self.login(client, '--session-file', 'session',
+                                   '--user', 'test@gmail.com'))
+        self.assertEqual(client.logins, ['test@gmail.com'])
+
+    def test_needs_user_without_a_usable_session(self):
+        client = FakeClient()
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertFalse(self.login(client, '--session-file', 'session'))
+            message = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(client.logins, [])
+        self.assertIn('--user is required', message)
+
+
+if __name__ == '__main__':
+    unittest.main()
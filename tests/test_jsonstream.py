@@ -0,0 +1,35 @@
+"""
+Tests of googlemusic.jsonstream
+"""
+__author__ = "Tirino"
+
+import json
+import unittest
+from StringIO import StringIO
+
+from googlemusic.jsonstream import iter_array
+
+DOCUMENT = ('{"total": 12.5e-3, "name": "a \\"b\\"", "offset": -0.25, '
+            '"playlists": [1.5, 2, {"songs": [1e5, "x", 10]}, -3.25E+2, '
+            'true, null, [], 0, 123456789], "after": 1}')
+
+class IterArrayTest(unittest.TestCase):
+    def test_every_chunk_size(self):
+        expected = json.loads(DOCUMENT)['playlists']
+        for chunk_size in xrange(1, len(DOCUMENT) + 1):
+            self.assertEqual(
+                list(iter_array(StringIO(DOCUMENT), 'playlists', chunk_size)),
+                expected, 'chunk size %d' % chunk_size)
+
+    def test_missing_key(self):
+        self.assertRaises(KeyError, list,
+                          iter_array(StringIO(DOCUMENT), 'songs', 8))
+        self.assertRaises(KeyError, list, iter_array(StringIO('{}'), 'a'))
+
+    def test_number_at_the_end(self):
+        self.assertEqual(list(iter_array(StringIO('{"a":[1.5,2]}'), 'a', 4)),
+                         [1.5, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
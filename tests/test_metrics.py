@@ -0,0 +1,53 @@
+"""
+Tests of googlemusic.metrics
+"""
+__author__ = "Tirino"
+
+import unittest
+import urllib2
+
+from googlemusic.compression import CompressionHandler, gzip_data
+from googlemusic.metrics import Metrics
+from tests.stub import StubServer, gzipped
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.lengths = []
+        self.server.add_route('/echo', self.echo)
+        self.server.add_route('/gzip', gzipped(self.echo))
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def echo(self, handler):
+        """Answer with a big body, remembering the request's length"""
+        self.lengths.append(int(handler.headers.getheader('Content-Length')))
+        return 200, {}, 'x' * 10000
+
+    def fetch(self, path, data, opener):
+        request = urllib2.Request(self.server.url + path, data)
+        response = self.metrics.open(opener, request)
+        body = response.read()
+        response.close()
+        return body
+
+    def test_counts_plain_bytes(self):
+        opener = urllib2.build_opener()
+        self.assertEqual(self.fetch('/echo', 'y' * 5000, opener), 'x' * 10000)
+        stats = self.metrics.snapshot()['http.echo']
+        self.assertEqual(stats['bytes_in'], 10000)
+        self.assertEqual(stats['bytes_out'], 5000)
+
+    def test_counts_compressed_bytes(self):
+        opener = urllib2.build_opener(CompressionHandler(min_request_size=10))
+        self.assertEqual(self.fetch('/gzip', 'y' * 5000, opener), 'x' * 10000)
+        stats = self.metrics.snapshot()['http.gzip']
+        self.assertEqual(stats['bytes_in'], len(gzip_data('x' * 10000)))
+        self.assertEqual(stats['bytes_out'], self.lengths[0])
+        self.assertTrue(stats['bytes_out'] < 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
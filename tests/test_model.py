@@ -0,0 +1,60 @@
+"""
+Tests of googlemusic.model
+"""
+__author__ = "Tirino"
+
+import unittest
+
+from googlemusic.model import Playlist, SongRegistry, StringPool
+from tests.library import make_library
+
+SONG_ATTRIBUTES = ('id', 'name', 'title', 'artist', 'album', 'album_artist',
+                   'track', 'artwork_url')
+
+def attributes(song):
+    return tuple(getattr(song, name) for name in SONG_ATTRIBUTES)
+
+
+class StringPoolTest(unittest.TestCase):
+    def test_shares_equal_strings(self):
+        pool = StringPool()
+        first = pool.intern(''.join(['art', 'ist']))
+        second = pool.intern(''.join(['arti', 'st']))
+        self.assertTrue(first is second)
+        self.assertEqual(pool.intern(None), None)
+
+    def test_bounded(self):
+        pool = StringPool(max_size=10)
+        for index in xrange(100):
+            pool.intern('value %d' % index)
+        self.assertTrue(len(pool) <= 10)
+
+
+class PlaylistTest(unittest.TestCase):
+    def setUp(self):
+        self.data = make_library(3, 20)
+
+    def test_lazy_songs_match_eager(self):
+        for data in self.data:
+            eager = Playlist(data)
+            lazy = Playlist(data, lazy=True)
+            self.assertEqual(lazy.song_count, len(eager.songs))
+            self.assertEqual([attributes(song) for song in lazy.songs],
+                             [attributes(song) for song in eager.songs])
+
+    def test_lazy_keeps_no_decoded_dicts(self):
+        playlist = Playlist(self.data[0], lazy=True)
+        self.assertTrue(all(isinstance(values, tuple)
+                            for values in playlist._songs_data))
+
+    def test_registry_strings(self):
+        first, second = SongRegistry(), SongRegistry()
+        songs = Playlist(self.data[0], registry=first).songs
+        Playlist(self.data[0], lazy=True, registry=second).songs
+        self.assertTrue(songs[0].artist in first.strings.strings)
+        self.assertTrue(songs[0].artist in second.strings.strings)
+        self.assertFalse(first.strings is second.strings)
+
+
+if __name__ == '__main__':
+    unittest.main()
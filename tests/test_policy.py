@@ -0,0 +1,232 @@
+"""
+Tests of googlemusic.policy, with a fake clock and sleep
+"""
+__author__ = "Tirino"
+
+import errno
+import socket
+import unittest
+import urllib2
+from StringIO import StringIO
+from mimetools import Message
+
+from googlemusic.client import Client
+from googlemusic.policy import Backoff, CircuitBreaker, CircuitOpenException
+from googlemusic.policy import RequestPolicy, TokenBucket, retry_after
+from tests.service import FakeGoogleMusic
+
+class FakeClock(object):
+    """Clock that only moves when slept on (or advanced)"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class MaxRandom(object):
+    """random.Random stand-in whose uniform() returns the upper bound"""
+    def uniform(self, low, high):
+        return high
+
+
+def http_error(code, headers=''):
+    """Return an HTTPError with the given status and raw headers"""
+    return urllib2.HTTPError('http://example.com/', code, 'Error',
+                             Message(StringIO(headers)), StringIO(''))
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=3, clock=clock, sleep=clock.sleep)
+        for _ in xrange(3):
+            self.assertEqual(bucket.try_acquire(), 0)
+        self.assertAlmostEqual(bucket.try_acquire(), 0.5)
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [0.5])
+        # half a second more gives a single token
+        clock.now += 0.5
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertTrue(bucket.try_acquire() > 0)
+
+    def test_tokens_never_exceed_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, burst=2, clock=clock, sleep=clock.sleep)
+        clock.now += 3600
+        self.assertEqual(bucket.try_acquire(2), 0)
+        self.assertTrue(bucket.try_acquire() > 0)
+
+
+class BackoffTest(unittest.TestCase):
+    def test_exponential_and_capped(self):
+        backoff = Backoff(base=0.5, factor=2, maximum=3, rand=MaxRandom())
+        self.assertEqual([backoff.delay(attempt) for attempt in xrange(5)],
+                         [0.5, 1, 2, 3, 3])
+
+    def test_jitter_within_ceiling(self):
+        backoff = Backoff(base=1, factor=2, maximum=30)
+        for attempt in xrange(8):
+            delay = backoff.delay(attempt)
+            self.assertTrue(0 <= delay <= min(30, 2 ** attempt))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=clock)
+        breaker.before()
+        breaker.failure()
+        breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenException, breaker.before)
+
+    def test_single_trial_after_timeout(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=1, reset_timeout=10, clock=clock)
+        breaker.failure()
+        clock.now += 10
+        breaker.before()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # only one call goes through while the trial is running
+        self.assertRaises(CircuitOpenException, breaker.before)
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before()
+
+    def test_failed_trial_opens_again(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=3, reset_timeout=10, clock=clock)
+        for _ in xrange(3):
+            breaker.failure()
+        clock.now += 10
+        breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenException, breaker.before)
+
+
+class RequestPolicyTest(unittest.TestCase):
+    def test_retry_after(self):
+        self.assertEqual(retry_after(http_error(429, 'Retry-After: 7\n')), 7)
+        self.assertEqual(retry_after(http_error(503)), None)
+        self.assertEqual(retry_after(http_error(503, 'Retry-After: x\n')),
+                         None)
+
+    def test_can_retry(self):
+        policy = RequestPolicy()
+        refused = urllib2.URLError(socket.error(errno.ECONNREFUSED, 'no'))
+        reset = urllib2.URLError(socket.error(errno.ECONNRESET, 'reset'))
+        self.assertTrue(policy.can_retry('search', http_error(503)))
+        self.assertTrue(policy.can_retry('search', reset))
+        self.assertTrue(policy.can_retry('addplaylist', http_error(429)))
+        self.assertTrue(policy.can_retry('addplaylist', refused))
+        self.assertFalse(policy.can_retry('addplaylist', http_error(503)))
+        self.assertFalse(policy.can_retry('addplaylist', reset))
+
+    def test_retries_transient_errors(self):
+        clock = FakeClock()
+        errors = [http_error(503), http_error(502)]
+        def func():
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+        retried = []
+        policy = RequestPolicy(retries=3, sleep=clock.sleep,
+                               backoff=Backoff(base=1, rand=MaxRandom()))
+        self.assertEqual(policy.call('search', func, (),
+                                     lambda name, error: retried.append(
+                                         error.code)), 'ok')
+        self.assertEqual(retried, [503, 502])
+        self.assertEqual(clock.sleeps, [1, 2])
+
+    def test_gives_up(self):
+        clock = FakeClock()
+        calls = []
+        def func():
+            calls.append(1)
+            raise http_error(503)
+        policy = RequestPolicy(retries=2, sleep=clock.sleep)
+        self.assertRaises(urllib2.HTTPError, policy.call, 'search', func)
+        self.assertEqual(len(calls), 3)
+
+    def test_permanent_errors_not_retried(self):
+        calls = []
+        def func():
+            calls.append(1)
+            raise http_error(400)
+        policy = RequestPolicy(retries=5, sleep=FakeClock().sleep)
+        self.assertRaises(urllib2.HTTPError, policy.call, 'search', func)
+        self.assertEqual(len(calls), 1)
+
+
+class PolicyServiceTest(unittest.TestCase):
+    """RequestPolicy applied to a Client talking to FakeGoogleMusic"""
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=1, songs_per_playlist=5)
+        self.service.start()
+        self.service.install()
+        self.client = Client()
+        self.client.login('test@gmail.com', 'p4ssw0rd')
+        self.search = self.service.routes['/music/services/search']
+        self.answers = []
+        self.requests = 0
+        self.service.add_route('/music/services/search', self.scripted)
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.service.stop()
+
+    def scripted(self, handler):
+        """Answer with the scripted errors first, then search"""
+        self.requests += 1
+        if self.answers:
+            return self.answers.pop(0)
+        return self.search(handler)
+
+    def set_policy(self, retries=3, breaker=None):
+        self.client.set_policy(RequestPolicy(
+            retries=retries, breaker=breaker, sleep=self.clock.sleep,
+            backoff=Backoff(base=0.25, maximum=10, rand=MaxRandom())))
+
+    def test_retry(self):
+        self.set_policy()
+        self.answers = [(503, {}, 'Unavailable'), (500, {}, 'Error')]
+        self.client.search('a')
+        self.assertEqual(self.requests, 3)
+        self.assertEqual(self.clock.sleeps, [0.25, 0.5])
+
+    def test_retry_after(self):
+        self.set_policy()
+        self.answers = [(429, {'Retry-After': '4'}, 'Slow down')]
+        self.client.search('a')
+        self.assertEqual(self.clock.sleeps, [4])
+        # capped at the backoff maximum
+        self.answers = [(429, {'Retry-After': '3600'}, 'Slow down')]
+        self.client.search('a')
+        self.assertEqual(self.clock.sleeps, [4, 10])
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30,
+                                 clock=self.clock)
+        self.set_policy(retries=0, breaker=breaker)
+        self.answers = [(503, {}, 'Unavailable')] * 2
+        for _ in xrange(2):
+            self.assertRaises(urllib2.HTTPError, self.client.search, 'a')
+        self.assertRaises(CircuitOpenException, self.client.search, 'a')
+        self.assertEqual(self.requests, 2)
+        self.clock.now += 30
+        self.client.search('a')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.requests, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+Tests of googlemusic.protocol sessions
+"""
+__author__ = "Tirino"
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from googlemusic.asyncclient import AsyncClient
+from googlemusic.client import Client
+from googlemusic.protocol import AuthenticationException, Protocol
+from tests.service import FakeGoogleMusic
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=2, songs_per_playlist=3)
+        self.service.start()
+        self.service.install()
+        self.token_auths = 0
+        token_auth = self.service.routes['/accounts/TokenAuth']
+        def count(handler):
+            self.token_auths += 1
+            return token_auth(handler)
+        self.service.add_route('/accounts/TokenAuth', count)
+        self.folder = tempfile.mkdtemp()
+        self.session_file = os.path.join(self.folder, 'session')
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.pool.close()
+        shutil.rmtree(self.folder)
+        self.service.stop()
+
+    def client(self):
+        client = Client()
+        self.clients.append(client)
+        return client
+
+    def expire_xt_cookie(self):
+        """Make the saved xt cookie expired, as after a long time"""
+        with open(self.session_file, 'rb') as session_file:
+            data = json.load(session_file)
+        for cookie in data['cookies']:
+            if cookie['name'] == 'xt':
+                cookie['expires'] = int(time.time()) - 60
+        with open(self.session_file, 'wb') as session_file:
+            json.dump(data, session_file)
+
+    def test_saved_session_is_restored(self):
+        self.client().login('test@gmail.com', 'p4ssw0rd', self.session_file)
+        client = self.client()
+        self.assertTrue(client.resume_session(self.session_file))
+        self.assertEqual(client.protocol.account, 'test@gmail.com')
+        self.assertEqual(len(client.get_all_playlists()), 2)
+        self.assertEqual((self.service.logins, self.token_auths), (1, 1))
+
+    def test_session_of_another_user_is_not_restored(self):
+        self.client().login('test@gmail.com', 'p4ssw0rd', self.session_file)
+        client = self.client()
+        client.login('other@gmail.com', 'p4ssw0rd', self.session_file)
+        self.assertEqual(self.service.logins, 2)
+        self.assertEqual(client.protocol.account, 'other@gmail.com')
+
+    def test_expired_xt_cookie_is_renewed(self):
+        self.client().login('test@gmail.com', 'p4ssw0rd', self.session_file)
+        self.expire_xt_cookie()
+        client = self.client()
+        self.assertTrue(client.resume_session(self.session_file))
+        self.assertFalse(client.protocol.has_session_cookie())
+        self.assertEqual(len(client.get_all_playlists()), 2)
+        self.assertEqual((self.service.logins, self.token_auths), (1, 2))
+        # the renewed session was saved
+        self.assertTrue(self.client().resume_session(self.session_file))
+        self.assertTrue(self.clients[-1].protocol.has_session_cookie())
+
+    def test_expired_xt_cookie_is_renewed_asynchronously(self):
+        self.client().login('test@gmail.com', 'p4ssw0rd', self.session_file)
+        self.expire_xt_cookie()
+        client = AsyncClient()
+        try:
+            self.assertTrue(client.login('test@gmail.com', 'p4ssw0rd',
+                                         self.session_file).result(10))
+            playlists = client.get_all_playlists().result(10)
+        finally:
+            client.close()
+        self.assertEqual(len(playlists), 2)
+        self.assertEqual((self.service.logins, self.token_auths), (1, 2))
+
+    def test_rejected_session_is_renewed(self):
+        client = self.client()
+        client.login('test@gmail.com', 'p4ssw0rd')
+        load_playlist = self.service.routes['/music/services/loadplaylist']
+        rejected = []
+        def reject_once(handler):
+            if not rejected:
+                rejected.append(handler)
+                return 401, {}, 'expired'
+            return load_playlist(handler)
+        self.service.add_route('/music/services/loadplaylist', reject_once)
+        self.assertEqual(len(client.get_all_playlists()), 2)
+        self.assertEqual((self.service.logins, self.token_auths), (1, 2))
+
+    def test_renewal_without_credentials_fails_clearly(self):
+        self.client().login('test@gmail.com', 'p4ssw0rd', self.session_file)
+        self.expire_xt_cookie()
+        self.service.add_route('/accounts/TokenAuth', lambda handler: (
+            403, {}, 'denied'))
+        client = self.client()
+        client.resume_session(self.session_file)
+        self.assertRaises(AuthenticationException, client.get_all_playlists)
+
+
+class FakeServiceTest(unittest.TestCase):
+    def test_stop_restores_the_endpoints(self):
+        endpoint = Protocol.SERVICE_ENDPOINT
+        service = FakeGoogleMusic(playlists=1, songs_per_playlist=1).start()
+        try:
+            service.install()
+            self.assertEqual(Protocol.SERVICE_ENDPOINT,
+                             service.url + '/music/services')
+        finally:
+            service.stop()
+        self.assertEqual(Protocol.SERVICE_ENDPOINT, endpoint)
+
+
+if __name__ == '__main__':
+    unittest.main()
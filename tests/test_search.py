@@ -0,0 +1,84 @@
+"""
+Tests of googlemusic.search
+"""
+__author__ = "Tirino"
+
+import unittest
+
+from googlemusic.model import SongRegistry
+from googlemusic.search import InvertedIndex, SearchIndex
+
+def song_data(song_id, title, album, artist='Someartist'):
+    """Return the data of a song, as the server sends it"""
+    return {'id': song_id, 'name': title, 'title': title, 'artist': artist,
+            'album': album, 'track': 1}
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = SongRegistry()
+        self.index = SearchIndex()
+
+    def add(self, *args):
+        song = self.registry.song(song_data(*args))
+        self.index.add_songs([song])
+        return song
+
+    def album_names(self, query):
+        return [album.name for album in self.index.search(query)['Albums']]
+
+    def test_finds_songs_and_albums(self):
+        song = self.add('1', 'Hello', 'Greetings')
+        self.assertEqual(self.index.search('hel')['Songs'], [song])
+        self.assertEqual(self.album_names('greet'), ['Greetings'])
+
+    def test_updated_song_leaves_its_old_album(self):
+        self.add('1', 'Hello', 'Oldalbum')
+        # the registry updates the shared Song before it's indexed again
+        self.add('1', 'Hello', 'Newalbum')
+        self.assertEqual(self.album_names('Oldalbum'), [])
+        self.assertEqual(self.album_names('Newalbum'), ['Newalbum'])
+
+    def test_album_kept_while_it_has_songs(self):
+        self.add('1', 'Hello', 'Shared')
+        self.add('2', 'World', 'Shared')
+        self.add('1', 'Hello', 'Other')
+        self.assertEqual(self.album_names('Shared'), ['Shared'])
+        self.index.remove_songs(['2'])
+        self.assertEqual(self.album_names('Shared'), [])
+
+
+class InvertedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add('title', [('Hello there', 3), ('Other', 1)])
+        self.index.add('artist', [('Helloween', 2), ('Band', 1)])
+        self.index.add('album', [('Bands', 3), ('Hello', 1)])
+        self.index.add('typo', [('Helo', 3)])
+
+    def keys(self, query):
+        return [key for key, score in self.index.top(query, 10)]
+
+    def test_single_word_ranking_matches_full_scoring(self):
+        scores = self.index.search('hello')
+        ranked = self.index.top('hello', 10)
+        self.assertEqual(dict(ranked), scores)
+        self.assertEqual([score for key, score in ranked],
+                         sorted(scores.values(), reverse=True))
+        self.assertEqual(ranked[0][0], 'title')
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.top('hel', 2)), 2)
+        self.assertEqual(self.index.top('hel', 0), [])
+
+    def test_cached_completions_follow_changes(self):
+        self.assertEqual(self.keys('ban'), ['album', 'artist'])
+        self.index.remove('album')
+        self.assertEqual(self.keys('ban'), ['artist'])
+        self.index.add('new', [('Bandana', 2)])
+        self.assertEqual(self.keys('ban'), ['new', 'artist'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Tests of googlemusic.store
+"""
+__author__ = "Tirino"
+
+import copy
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from googlemusic.client import Client
+from googlemusic.model import Song
+from googlemusic.store import LibraryStore, song_record
+from tests.library import make_library, make_song
+from tests.service import FakeGoogleMusic
+
+def stored(playlists_data):
+    """Return playlists' data as the store gives it back"""
+    return [{'playlistId': data['playlistId'], 'title': data['title'],
+             'playlist': [song_record(song) for song in data['playlist']]}
+            for data in playlists_data]
+
+
+class LibraryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = LibraryStore()
+        self.library = make_library(4, 5, library_size=12)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_round_trip(self):
+        result = self.store.apply(self.library)
+        self.assertEqual(len(result.added), 4)
+        self.assertEqual(self.store.get_playlists(), stored(self.library))
+        playlist = self.library[2]
+        self.assertEqual(self.store.get_playlist(playlist['playlistId']),
+                         stored([playlist])[0])
+        self.assertTrue(self.store.last_sync())
+
+    def test_only_changes_are_written(self):
+        self.store.apply(self.library)
+        self.assertFalse(self.store.apply(self.library))
+        library = copy.deepcopy(self.library)
+        library[0]['title'] = u'Renamed'
+        library[1]['playlist'].reverse()
+        library[2]['playlist'][0]['title'] = u'New title'
+        removed = library.pop(3)
+        result = self.store.apply(library)
+        self.assertEqual(result.renamed, [library[0]['playlistId']])
+        self.assertEqual(result.changed, [library[1]['playlistId']])
+        self.assertEqual(result.changed_songs,
+                         [str(library[2]['playlist'][0]['id'])])
+        self.assertEqual(result.deleted, [removed['playlistId']])
+        self.assertEqual(self.store.get_playlists(), stored(library))
+
+    def test_playlists_keep_the_server_order(self):
+        self.store.apply(self.library)
+        library = self.library[::-1]
+        library[0] = dict(library[0], title=u'Renamed')
+        self.store.apply(library)
+        self.assertEqual(self.store.get_playlists(), stored(library))
+
+    def test_added_playlist_keeps_its_songs_and_place(self):
+        self.store.apply(self.library)
+        new_song = make_song(1000)
+        songs = [new_song, self.library[0]['playlist'][0]]
+        self.store.add_playlist('new', u'New', songs)
+        # replaced, as when the server answers again for the same playlist
+        self.store.add_playlist('new', u'New', songs)
+        playlists = self.store.get_playlists()
+        self.assertEqual([data['playlistId'] for data in playlists[:-1]],
+                         [data['playlistId'] for data in self.library])
+        self.assertEqual(playlists[-1], {
+          'playlistId': 'new', 'title': u'New',
+          'playlist': [song_record(song) for song in songs]})
+        self.store.rename_playlist('new', u'Renamed')
+        self.assertEqual(self.store.get_playlists()[-1]['title'], u'Renamed')
+
+
+class OldStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'library.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stores_without_positions_are_upgraded(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE playlists (id TEXT PRIMARY KEY, title TEXT)')
+        db.execute("INSERT INTO playlists VALUES ('old', 'Old')")
+        db.commit()
+        db.close()
+        store = LibraryStore(self.path)
+        try:
+            library = make_library(2, 3)
+            result = store.apply(library)
+            self.assertEqual(result.deleted, ['old'])
+            self.assertEqual(store.get_playlists(), stored(library))
+        finally:
+            store.close()
+
+
+class ClientSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=3, songs_per_playlist=4)
+        self.service.start()
+        self.service.install()
+        self.client = Client()
+        self.client.login('test@gmail.com', 'p4ssw0rd')
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.service.stop()
+
+    def test_sync_then_read_locally(self):
+        result = self.client.sync()
+        self.assertEqual(len(result.added), 3)
+        self.assertEqual(len(result.added_songs), len(self.service.songs))
+        self.assertFalse(self.client.sync())
+        # answered by the store, without the server
+        self.service.add_route('/music/services/loadplaylist',
+                               lambda handler: (500, {}, 'offline'))
+        playlists = self.client.get_all_playlists()
+        self.assertEqual([playlist.title for playlist in playlists],
+                         [data['title'] for data in self.service.library])
+        self.assertEqual(
+            [[song.id for song in playlist.songs] for playlist in playlists],
+            [[song['id'] for song in data['playlist']]
+             for data in self.service.library])
+
+    def test_song_data_round_trip(self):
+        data = song_record(make_song(7))
+        self.assertEqual(Song(data).data(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Tests of googlemusic.stream
+"""
+__author__ = "Tirino"
+
+import unittest
+
+from googlemusic.client import Client
+from googlemusic.concurrency import WorkerPool
+from tests.service import FakeGoogleMusic
+
+class SongStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGoogleMusic(playlists=1, songs_per_playlist=2)
+        self.service.start()
+        self.service.install()
+        self.client = Client()
+        self.client.login('test@gmail.com', 'p4ssw0rd')
+        self.song = self.client.get_all_playlists()[0].songs[0]
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.service.stop()
+
+    def test_reads_the_song(self):
+        with self.client.open_song(self.song) as stream:
+            self.assertEqual(stream.read(), self.service.audio)
+
+    def test_unexpected_errors_reach_the_reader(self):
+        self.service.add_route('/stream', lambda handler: (
+            200, {'Content-Length': 'garbage'}, self.service.audio))
+        with WorkerPool(1) as pool:
+            with self.client.open_song(self.song) as stream:
+                task = pool.submit(stream.read, 1024)
+                self.assertTrue(isinstance(task.exception(10), ValueError))
+
+
+if __name__ == '__main__':
+    unittest.main()
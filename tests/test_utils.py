@@ -0,0 +1,55 @@
+"""
+Tests of googlemusic.utils
+"""
+__author__ = "Tirino"
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from googlemusic.utils import UMASK, write_file
+
+class WriteFileTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_replaces_the_file(self):
+        write_file(self.path, 'old')
+        write_file(self.path, 'new')
+        with open(self.path, 'rb') as written:
+            self.assertEqual(written.read(), 'new')
+        self.assertEqual(os.listdir(self.folder), ['file'])
+
+    @unittest.skipIf(os.name == 'nt', 'no POSIX permissions')
+    def test_creates_with_mode(self):
+        write_file(self.path, 'secret', 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    @unittest.skipIf(os.name == 'nt', 'no POSIX permissions')
+    def test_leftover_temp_file_is_not_reused(self):
+        leftover = self.path + '.tmp'
+        with open(leftover, 'wb') as temp:
+            temp.write('old')
+        os.chmod(leftover, 0666)
+        write_file(self.path, 'secret', 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    @unittest.skipIf(os.name == 'nt', 'no POSIX permissions')
+    def test_default_mode_follows_the_umask(self):
+        write_file(self.path, 'data')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode),
+                         0666 & ~UMASK)
+
+    def test_failed_write_leaves_no_temp_file(self):
+        self.assertRaises(TypeError, write_file, self.path, None)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+if __name__ == '__main__':
+    unittest.main()